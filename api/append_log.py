@@ -0,0 +1,63 @@
+from database import get_db_connection, Counters, in_chunks
+
+# Append-only tabs for records that never change once made: stock
+# adjustments and payments. A push only appends them, in batches, without
+# reading or rewriting the tab as upsert_rows does. The ids already written
+# are kept per spreadsheet and tab in append_log_seen (the seen-set), so a
+# record sent again (a retried sync, a second device) is dropped before the
+# append. Ids are claimed before the append and released if it fails, so
+# the push can be resent; a tab the sync has to recreate starts a new set.
+
+_counts = Counters("appended", "duplicates", "released")
+
+def claim_new(spreadsheet_id, tab, rows):
+    """The rows (id first) not written to the tab before, first of each id,
+    now marked as written"""
+    fresh, ids = [], set()
+    for row in rows:
+        if not row or row[0] in (None, ''): continue
+        entity_id = str(row[0])
+        if entity_id in ids: continue
+        ids.add(entity_id)
+        fresh.append(row)
+    conn = get_db_connection()
+    try:
+        new = [row for row in fresh if conn.execute('INSERT OR IGNORE INTO append_log_seen (spreadsheet_id, tab, entity_id) VALUES (?, ?, ?)',
+                                                    (spreadsheet_id, tab, str(row[0]))).rowcount]
+        conn.commit()
+    finally:
+        conn.close()
+    _counts.add("appended", len(new))
+    _counts.add("duplicates", len(rows) - len(new))
+    return new
+
+def release(spreadsheet_id, tab, rows):
+    """Claimed rows that were not written after all: a later push writes them"""
+    ids = [str(row[0]) for row in rows]
+    conn = get_db_connection()
+    try:
+        for chunk, placeholders in in_chunks(ids):
+            conn.execute(f"DELETE FROM append_log_seen WHERE spreadsheet_id = ? AND tab = ? AND entity_id IN ({placeholders})",
+                         [spreadsheet_id, tab] + chunk)
+        conn.commit()
+    finally:
+        conn.close()
+    _counts.add("appended", -len(ids))
+    _counts.add("released", len(ids))
+
+def forget_tab(spreadsheet_id, tab):
+    """The tab was (re)created empty: every id is new to it"""
+    conn = get_db_connection()
+    try:
+        conn.execute('DELETE FROM append_log_seen WHERE spreadsheet_id = ? AND tab = ?', (spreadsheet_id, tab))
+        conn.commit()
+    finally:
+        conn.close()
+
+def append_log_stats():
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('SELECT tab, COUNT(*) AS n FROM append_log_seen GROUP BY tab').fetchall()
+    finally:
+        conn.close()
+    return {"seen": {r['tab']: r['n'] for r in rows}, **_counts.snapshot()}
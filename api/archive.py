@@ -0,0 +1,176 @@
+import datetime
+
+from database import get_db_connection, in_chunks
+from schema import ORDER_HEADERS, LINE_HEADERS
+import row_index
+
+# Hot/cold split for orders. Closed orders (delivered, fully paid, older than
+# N days) move with their lines into monthly archive tabs, so the live Orders
+# and OrderLines sheets that every sync reads and rewrites stay bounded.
+# order_archive_index maps each archived order to its month for lookups.
+
+DEFAULT_ARCHIVE_AFTER_DAYS = 90
+ORDERS_ARCHIVE_PREFIX = 'Orders Archive '
+LINES_ARCHIVE_PREFIX = 'OrderLines Archive '
+
+def archive_tab_names(partition):
+    return f"{ORDERS_ARCHIVE_PREFIX}{partition}", f"{LINES_ARCHIVE_PREFIX}{partition}"
+
+def _parse_date(value):
+    try: return datetime.date.fromisoformat(str(value)[:10])
+    except ValueError: return None
+
+def select_closed_orders(order_rows, older_than_days, today=None):
+    """Maps order_id -> partition ('YYYY-MM') for every order eligible for archiving"""
+    cutoff = (today or datetime.date.today()) - datetime.timedelta(days=older_than_days)
+    closed = {}
+    for row in order_rows[1:]:
+        if not row or not row[0]: continue
+        row = row + [''] * (len(ORDER_HEADERS) - len(row))
+        if str(row[13]).lower() != 'delivered' or str(row[12]).lower() != 'paid': continue
+        order_date = _parse_date(row[3])
+        if order_date is None or order_date >= cutoff: continue
+        closed[str(row[0])] = order_date.strftime('%Y-%m')
+    return closed
+
+# --- Index ---
+
+def record_archived(spreadsheet_id, partitions_by_order):
+    conn = get_db_connection()
+    try:
+        conn.executemany('INSERT OR REPLACE INTO order_archive_index (spreadsheet_id, order_id, partition) VALUES (?, ?, ?)',
+                         [(spreadsheet_id, oid, part) for oid, part in partitions_by_order.items()])
+        conn.commit()
+    finally:
+        conn.close()
+
+def archived_ids(spreadsheet_id, order_ids):
+    if not order_ids: return set()
+    conn = get_db_connection()
+    try:
+        found = set()
+        for chunk, placeholders in in_chunks(order_ids):
+            rows = conn.execute(f'SELECT order_id FROM order_archive_index WHERE spreadsheet_id = ? AND order_id IN ({placeholders})',
+                                [spreadsheet_id] + chunk).fetchall()
+            found.update(r['order_id'] for r in rows)
+        return found
+    finally:
+        conn.close()
+
+def lookup_partition(spreadsheet_id, order_id):
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT partition FROM order_archive_index WHERE spreadsheet_id = ? AND order_id = ?',
+                           (spreadsheet_id, str(order_id))).fetchone()
+        return row['partition'] if row else None
+    finally:
+        conn.close()
+
+def partitions_of(spreadsheet_id, order_ids):
+    """{partition: {order ids}} for the archived ones among order_ids"""
+    partitions = {}
+    conn = get_db_connection()
+    try:
+        for chunk, placeholders in in_chunks([str(oid) for oid in order_ids]):
+            for r in conn.execute(f'SELECT order_id, partition FROM order_archive_index WHERE spreadsheet_id = ? AND order_id IN ({placeholders})',
+                                  [spreadsheet_id] + chunk):
+                partitions.setdefault(r['partition'], set()).add(r['order_id'])
+        return partitions
+    finally:
+        conn.close()
+
+def unarchive_ids(spreadsheet_id, order_ids):
+    """Drops index entries for orders a client pushed again; the live copy wins"""
+    if not order_ids: return
+    conn = get_db_connection()
+    try:
+        conn.executemany('DELETE FROM order_archive_index WHERE spreadsheet_id = ? AND order_id = ?',
+                         [(spreadsheet_id, str(oid)) for oid in order_ids])
+        conn.commit()
+    finally:
+        conn.close()
+
+def archived_partitions(spreadsheet_id):
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('SELECT DISTINCT partition FROM order_archive_index WHERE spreadsheet_id = ? ORDER BY partition',
+                            (spreadsheet_id,)).fetchall()
+        return [r['partition'] for r in rows]
+    finally:
+        conn.close()
+
+# --- Pipeline ---
+
+def archive_closed_orders(backend, spreadsheet_id, older_than_days=DEFAULT_ARCHIVE_AFTER_DAYS, dry_run=False, today=None):
+    """backend: the spreadsheet's StorageBackend (storage.py). The live tabs'
+    locks are held from the read through the trim, so a /sync of this process
+    cannot write a row in between that the trim would then drop."""
+    with row_index.tab_locks(spreadsheet_id, ('Orders', 'OrderLines')):
+        return _archive_closed_orders(backend, spreadsheet_id, older_than_days, dry_run, today)
+
+def _archive_closed_orders(backend, spreadsheet_id, older_than_days, dry_run, today):
+    order_rows, line_rows = backend.read_ranges(spreadsheet_id, ['Orders', 'OrderLines'])
+
+    closed = select_closed_orders(order_rows, older_than_days, today)
+    summary = {"archived_orders": len(closed), "archived_lines": 0, "partitions": {}, "dry_run": dry_run}
+    if not closed:
+        summary.update({"live_orders": max(0, len(order_rows) - 1), "live_lines": max(0, len(line_rows) - 1)})
+        return summary
+
+    archived_orders, live_orders = {}, []
+    for row in order_rows[1:]:
+        oid = str(row[0]) if row else ''
+        if oid in closed: archived_orders.setdefault(closed[oid], []).append(row)
+        elif row: live_orders.append(row)
+    archived_lines, live_lines = {}, []
+    for row in line_rows[1:]:
+        oid = str(row[1]) if len(row) > 1 else ''
+        if oid in closed: archived_lines.setdefault(closed[oid], []).append(row)
+        elif row: live_lines.append(row)
+
+    for partition, rows in archived_orders.items():
+        summary["partitions"][partition] = len(rows)
+    summary["archived_lines"] = sum(len(r) for r in archived_lines.values())
+    summary.update({"live_orders": len(live_orders), "live_lines": len(live_lines)})
+    if dry_run:
+        return summary
+
+    # 1. Copy to the archive tabs. Orders already indexed were copied by an
+    #    earlier run that stopped before trimming the live sheets.
+    already = archived_ids(spreadsheet_id, closed.keys())
+    headers = {}
+    for partition in archived_orders:
+        orders_tab, lines_tab = archive_tab_names(partition)
+        headers.update({orders_tab: ORDER_HEADERS, lines_tab: LINE_HEADERS})
+    backend.ensure_tabs(spreadsheet_id, sorted(headers), headers)
+    for partition in sorted(archived_orders):
+        orders_tab, lines_tab = archive_tab_names(partition)
+        rows = [r for r in archived_orders[partition] if str(r[0]) not in already]
+        lines = [r for r in archived_lines.get(partition, []) if str(r[1]) not in already]
+        if rows: backend.append_rows(spreadsheet_id, orders_tab, rows)
+        if lines: backend.append_rows(spreadsheet_id, lines_tab, lines)
+
+    # 2. Index, then 3. trim the live sheets: only the archived rows are
+    #    deleted, so a failed trim leaves them live rather than the tab empty.
+    #    Lines go first: a rerun still finds their orders and finishes the job.
+    record_archived(spreadsheet_id, closed)
+    backend.delete_rows(spreadsheet_id, 'OrderLines', closed.keys(), 1)
+    backend.delete_rows(spreadsheet_id, 'Orders', closed.keys())
+    return summary
+
+def split_archived_rows(order_rows, line_rows, order_ids):
+    """(order rows, line rows) an archive partition keeps without order_ids,
+    and the line rows of order_ids; the tabs' rows come header first"""
+    kept_orders = [r for r in order_rows[1:] if r and str(r[0]) not in order_ids]
+    kept_lines, taken_lines = [], []
+    for r in line_rows[1:]:
+        if not r: continue
+        (taken_lines if len(r) > 1 and str(r[1]) in order_ids else kept_lines).append(r)
+    return kept_orders, kept_lines, taken_lines
+
+def read_archived_order_rows(backend, spreadsheet_id, order_id, partition):
+    """(order_rows, line_rows) for one archived order, header row included"""
+    order_rows, line_rows = backend.read_ranges(spreadsheet_id, list(archive_tab_names(partition)))
+    oid = str(order_id)
+    return ([ORDER_HEADERS] + [r for r in order_rows[1:] if r and str(r[0]) == oid],
+            [LINE_HEADERS] + [r for r in line_rows[1:] if len(r) > 1 and str(r[1]) == oid])
@@ -0,0 +1,445 @@
+import os
+import sys
+import json
+import functools
+import contextlib
+import traceback
+
+# --- Vercel Compatibility Fix ---
+CURRENT_DIR = os.path.dirname(__file__)
+if CURRENT_DIR not in sys.path:
+    sys.path.append(CURRENT_DIR)
+
+import anyio
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, JSONResponse, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from google.oauth2 import service_account
+
+# The Flask app's helpers; the /sync pipeline itself is shared through sync_pipeline.py
+from index import (API_KEY, SCOPES, get_google_config, health_status, observe_request, STOCK_ACTIONS, run_stock_action, run_bulk_users,
+                   run_snapshots, run_snapshot_csv, run_snapshot_diff, snapshot_filename)
+from sheet_rows import SYNC_BODY_ENCODERS
+from sync_pipeline import sync_steps, chunked
+from database import create_user, authenticate_user, update_user_password
+from metrics import span, begin_trace, end_trace, render_prometheus
+from wire import COLUMNAR_MIME, JSON_MIME, wants_columnar
+from sync_body import read_sync_body, SyncBodyError, MAX_SYNC_BODY_BYTES
+from sheets_async import AsyncSheets, SheetsError
+import row_index
+from storage import (APPEND_CHUNK_ROWS, SHEET_FIELDS, merge_sheet_rows, backend_name, open_backend, sheet_catalog,
+                     add_to_catalog, schema_version_requests, rows_by_id, row_ranges, rows_at, cell_ranges, rewritten_rows)
+import stock_ledger
+
+# Async entry point for /sync, /stock, /snapshots, /login, /register,
+# /users/bulk, /change-password, /health and /metrics, with the same request and response contract
+# as index.py:
+#
+#   uvicorn asgi:app --app-dir api --port 5000
+#
+# Sheets calls go through AsyncSheets, so a sync waiting on Google holds no
+# thread; other storage backends (storage.py) run in the worker pool. SQLite, body parsing and row encoding run in a bounded worker pool
+# (PARTFLOW_ASGI_THREADS) and password hashing in a CPU-sized one
+# (PARTFLOW_ASGI_HASH_THREADS), so the event loop only ever waits on sockets.
+# /users/bulk hashes in provisioning.py's process pool.
+# /sync runs the same steps as the Flask app (sync_pipeline.py), driven by
+# run_steps below. Profiling (X-Partflow-Profile) is only available on the Flask app.
+
+BLOCKING_THREADS = int(os.environ.get('PARTFLOW_ASGI_THREADS', '40'))
+HASH_THREADS = int(os.environ.get('PARTFLOW_ASGI_HASH_THREADS', str(os.cpu_count() or 2)))
+
+_limiters = {}
+
+def _limiter(name, tokens):
+    # Created on first use: anyio limiters need a running event loop
+    if name not in _limiters: _limiters[name] = anyio.CapacityLimiter(tokens)
+    return _limiters[name]
+
+async def blocking(fn, *args):
+    """Runs fn(*args) in the worker pool (SQLite, parsing, encoding)"""
+    return await anyio.to_thread.run_sync(functools.partial(fn, *args), limiter=_limiter('blocking', BLOCKING_THREADS))
+
+async def hashing(fn, *args):
+    """Runs fn(*args) in the password hashing pool"""
+    return await anyio.to_thread.run_sync(functools.partial(fn, *args), limiter=_limiter('hashing', HASH_THREADS))
+
+_sheets = None
+
+def get_sheets_client():
+    """The process-wide AsyncSheets, so every request shares one connection pool and token"""
+    global _sheets
+    if _sheets is None:
+        config, _ = get_google_config()
+        if not config:
+            raise FileNotFoundError("Service account credentials not found in Environment or File.")
+        missing = [f for f in ('client_email', 'private_key', 'token_uri') if f not in config]
+        if missing:
+            raise ValueError(f"Missing required fields in service account JSON: {', '.join(missing)}")
+        _sheets = AsyncSheets(service_account.Credentials.from_service_account_info(config, scopes=SCOPES))
+    return _sheets
+
+def authorized(request):
+    return request.headers.get('X-API-KEY') == API_KEY
+
+def error(message, status, **extra):
+    return JSONResponse({"success": False, "message": message, **extra}, status_code=status)
+
+async def read_json(request):
+    """The JSON body as a dict ({} when empty); None when it does not parse"""
+    body = await request.body()
+    if not body: return {}
+    try: data = json.loads(body)
+    except ValueError: return None
+    return data if isinstance(data, dict) else None
+
+class _BodyStream:
+    """File-like view of the request body for read_sync_body, which runs in a
+    worker thread: each read() pulls the next chunks from the event loop"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+        self._buf = bytearray()
+        self._done = False
+
+    async def _next(self):
+        try: return await self._chunks.__anext__()
+        except StopAsyncIteration: return None
+
+    def read(self, size=-1):
+        while not self._done and (size < 0 or len(self._buf) < size):
+            chunk = anyio.from_thread.run(self._next)
+            if chunk is None: self._done = True
+            else: self._buf += chunk
+        size = len(self._buf) if size < 0 else min(size, len(self._buf))
+        out = bytes(self._buf[:size])
+        del self._buf[:size]
+        return out
+
+# --- Storage (async counterparts of storage.py) ---
+
+_tab_locks = {}
+
+def tab_lock(spreadsheet_id, tab):
+    """row_index.tab_lock on the event loop: held across awaits, so an anyio.Lock"""
+    return _tab_locks.setdefault((spreadsheet_id, tab), anyio.Lock())
+
+class AsyncSheetsBackend:
+    """storage.SheetsBackend's operations over AsyncSheets"""
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+        self._catalogs = {}
+
+    async def _catalog(self, spreadsheet_id, refresh=False):
+        if refresh or spreadsheet_id not in self._catalogs:
+            self._catalogs[spreadsheet_id] = sheet_catalog(await self.sheets.get(spreadsheet_id, SHEET_FIELDS))
+        return self._catalogs[spreadsheet_id]
+
+    async def ensure_tabs(self, spreadsheet_id, tabs, headers=None):
+        """Adds the missing tabs with one get and at most one batchUpdate"""
+        catalog = await self._catalog(spreadsheet_id, refresh=True)
+        missing = [tab for tab in tabs if tab not in catalog]
+        if missing:
+            reply = await self.sheets.batch_update(spreadsheet_id, {'requests': [{'addSheet': {'properties': {'title': tab}}} for tab in missing]})
+            add_to_catalog(catalog, reply)
+            for tab in missing: await blocking(row_index.forget, spreadsheet_id, tab)
+            data = [{'range': f"'{tab}'!A1", 'values': [headers[tab]]} for tab in missing if headers and tab in headers]
+            if data: await self.sheets.values_batch_update(spreadsheet_id, {'valueInputOption': 'RAW', 'data': data})
+        return missing
+
+    async def schema_versions(self, spreadsheet_id):
+        catalog = await self._catalog(spreadsheet_id)
+        return {tab: info['version'] for tab, info in catalog.items() if info['version'] is not None}
+
+    async def set_schema_versions(self, spreadsheet_id, versions):
+        catalog = await self._catalog(spreadsheet_id)
+        await self.sheets.batch_update(spreadsheet_id, {'requests': schema_version_requests(catalog, versions)})
+        for tab, version in versions.items(): catalog[tab]['version'] = version
+
+    async def read_tabs(self, spreadsheet_id, tabs):
+        result = await self.sheets.values_batch_get(spreadsheet_id, [f"'{t}'!A:Z" for t in tabs])
+        value_ranges = result.get('valueRanges', [])
+        return {t: (value_ranges[i].get('values', []) if i < len(value_ranges) else []) for i, t in enumerate(tabs)}
+
+    async def upsert_rows(self, spreadsheet_id, tab, headers, rows, id_column_index=0):
+        if not rows: return
+        async with tab_lock(spreadsheet_id, tab):
+            await self._upsert(spreadsheet_id, tab, headers, rows, id_column_index)
+
+    async def _upsert(self, spreadsheet_id, tab, headers, rows, id_column_index):
+        plan = await blocking(row_index.plan_upsert, spreadsheet_id, tab, headers, rows) if id_column_index == 0 else None
+        if plan is not None:
+            if plan.matches(await self.sheets.values_batch_get(spreadsheet_id, plan.ranges)):
+                await self.sheets.values_batch_update(spreadsheet_id, plan.body)
+                await blocking(plan.commit)
+                return
+            await blocking(plan.drifted)
+        try:
+            current = (await self.sheets.values_get(spreadsheet_id, f"'{tab}'!A1:Z")).get('values', [])
+        except SheetsError as e:
+            # Only a missing/unreadable tab starts empty (see storage.SheetsBackend)
+            if e.status != 400: raise
+            current = []
+        existing_rows = len(current)
+        merged = await blocking(merge_sheet_rows, tab, current, headers, rows, id_column_index)
+        await self.sheets.values_update(spreadsheet_id, f"'{tab}'!A1", merged)
+        if existing_rows > len(merged):
+            await self.sheets.values_clear(spreadsheet_id, f"'{tab}'!A{len(merged) + 1}:Z")
+        if id_column_index == 0: await blocking(row_index.rebuild, spreadsheet_id, tab, merged)
+
+    async def read_rows_by_id(self, spreadsheet_id, tab, ids, width=None):
+        """See storage.SheetsBackend.read_rows_by_id"""
+        if not ids: return {}
+        located = await blocking(row_index.locate, spreadsheet_id, tab, ids)
+        if located is not None:
+            found = rows_at(located, await self.sheets.values_batch_get(spreadsheet_id, row_ranges(tab, located.values(), width or 26)))
+            if found is not None: return found
+            await blocking(row_index.drifted, spreadsheet_id, tab)
+        async with tab_lock(spreadsheet_id, tab):
+            current = (await self.sheets.values_get(spreadsheet_id, f"'{tab}'!A1:Z")).get('values', [])
+            await blocking(row_index.rebuild, spreadsheet_id, tab, current)
+        return rows_by_id(current, ids)
+
+    async def write_cells(self, spreadsheet_id, tab, cells):
+        await self.sheets.values_batch_update(spreadsheet_id, {'valueInputOption': 'USER_ENTERED', 'data': cell_ranges(tab, cells)})
+
+    async def append_rows(self, spreadsheet_id, tab, rows):
+        async with tab_lock(spreadsheet_id, tab):
+            await blocking(row_index.forget, spreadsheet_id, tab)
+            for start in range(0, len(rows), APPEND_CHUNK_ROWS):
+                await self.sheets.values_append(spreadsheet_id, f"'{tab}'!A2", rows[start:start + APPEND_CHUNK_ROWS])
+
+    async def replace_rows(self, spreadsheet_id, tab, headers, rows):
+        """Header row, then clear and append in APPEND_CHUNK_ROWS pieces"""
+        async with tab_lock(spreadsheet_id, tab):
+            await blocking(row_index.forget, spreadsheet_id, tab)
+            await self.sheets.values_update(spreadsheet_id, f"'{tab}'!A1", [headers], 'RAW')
+            await self.sheets.values_clear(spreadsheet_id, f"'{tab}'!A2:Z")
+            for start in range(0, len(rows), APPEND_CHUNK_ROWS):
+                await self.sheets.values_append(spreadsheet_id, f"'{tab}'!A2", rows[start:start + APPEND_CHUNK_ROWS])
+            await blocking(row_index.rebuild, spreadsheet_id, tab, [headers] + list(rows))
+
+    async def rewrite_rows(self, spreadsheet_id, tab, headers, rows, current):
+        """See storage.SheetsBackend.rewrite_rows"""
+        values = rewritten_rows(headers, rows, current)
+        async with tab_lock(spreadsheet_id, tab):
+            await blocking(row_index.forget, spreadsheet_id, tab)
+            await self.sheets.values_batch_update(spreadsheet_id, {'valueInputOption': 'USER_ENTERED', 'data': [{'range': f"'{tab}'!A1", 'values': values}]})
+            if len(current) > len(values):
+                await self.sheets.values_clear(spreadsheet_id, f"'{tab}'!A{len(values) + 1}:Z")
+            await blocking(row_index.rebuild, spreadsheet_id, tab, [headers] + list(rows))
+
+class ThreadedBackend:
+    """A blocking StorageBackend (e.g. SQLite) with each operation run in the worker pool"""
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def __getattr__(self, name):
+        fn = getattr(self._backend, name)
+
+        async def call(*args):
+            return await blocking(fn, *args)
+        return call
+
+async def open_storage(spreadsheet_id):
+    """The spreadsheet's backend (storage.backend_name); Sheets goes through AsyncSheets"""
+    if backend_name(spreadsheet_id) == 'sheets':
+        sheets = get_sheets_client()
+        await sheets.authorize()
+        return AsyncSheetsBackend(sheets)
+    return ThreadedBackend(open_backend(spreadsheet_id))
+
+async def run_steps(steps):
+    """sync_pipeline.run_steps on the event loop: store ops are awaited on the
+    spreadsheet's async backend, work runs in the worker pool"""
+    backend, send = None, functools.partial(steps.send, None)
+    while True:
+        try:
+            op = send()
+        except StopIteration as done:
+            return done.value
+        try:
+            if op[0] == 'open': result = backend = await open_storage(op[1])
+            elif op[0] == 'store': result = await getattr(backend, op[1])(*op[2])
+            else: result = await blocking(op[1])
+        except Exception as e:
+            send = functools.partial(steps.throw, e)
+        else:
+            send = functools.partial(steps.send, result)
+
+# --- API Routes ---
+
+async def metrics(request):
+    if not authorized(request): return error("Unauthorized", 401)
+    return Response(render_prometheus(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+async def health(request):
+    return JSONResponse(await blocking(health_status))
+
+async def register(request):
+    data = await read_json(request)
+    if data is None: return error("Invalid JSON body", 400)
+    username, password, full_name = data.get('username'), data.get('password'), data.get('full_name')
+    if not username or not password:
+        return error("Username and password required", 400)
+    if await hashing(create_user, username, password, full_name):
+        return JSONResponse({"success": True, "message": "User registered successfully"})
+    return error("Username already exists", 400)
+
+async def bulk_users(request):
+    if not authorized(request): return error("Unauthorized", 401)
+    data = await read_json(request)
+    if data is None: return error("Invalid JSON body", 400)
+    try:
+        # Waits on the hashing processes (provisioning.py), not on this thread's CPU
+        body, status = await blocking(run_bulk_users, data)
+        return JSONResponse(body, status_code=status)
+    except Exception as e:
+        traceback.print_exc()
+        return error(str(e), 500)
+
+async def login(request):
+    data = await read_json(request)
+    if data is None: return error("Invalid JSON body", 400)
+    user = await hashing(authenticate_user, data.get('username'), data.get('password'))
+    if user: return JSONResponse({"success": True, "user": user, "token": API_KEY})
+    return error("Invalid credentials", 401)
+
+async def change_password(request):
+    if not authorized(request): return error("Unauthorized API Access", 401)
+    data = await read_json(request)
+    if data is None: return error("Invalid JSON body", 400)
+    user_id, old_password, new_password = data.get('userId'), data.get('oldPassword'), data.get('newPassword')
+    if not all([user_id, old_password, new_password]):
+        return error("Missing required fields", 400)
+    success, message = await hashing(update_user_password, user_id, old_password, new_password)
+    if success: return JSONResponse({"success": True, "message": message})
+    return error(message, 400)
+
+async def stock(request):
+    if not authorized(request): return error("Unauthorized", 401)
+    spreadsheet_id = request.query_params.get('spreadsheetId')
+    if not spreadsheet_id: return error("Spreadsheet ID is required", 400)
+    item_ids = [i for i in request.query_params.get('itemIds', '').split(',') if i]
+    if not item_ids: return error("itemIds is required", 400)
+    try:
+        return JSONResponse({"success": True, "stock": await blocking(stock_ledger.stock_levels, spreadsheet_id, item_ids)})
+    except Exception as e:
+        traceback.print_exc()
+        return error(str(e), 500)
+
+async def stock_action(request):
+    if not authorized(request): return error("Unauthorized", 401)
+    action = request.path_params['action']
+    if action not in STOCK_ACTIONS: return error("Not found", 404)
+    data = await read_json(request)
+    if data is None: return error("Invalid JSON body", 400)
+    try:
+        body, status = await blocking(run_stock_action, action, data)
+        return JSONResponse(body, status_code=status)
+    except Exception as e:
+        traceback.print_exc()
+        return error(str(e), 500)
+
+async def snapshots(request):
+    if not authorized(request): return error("Unauthorized", 401)
+    try:
+        body, status = await blocking(run_snapshots, request.query_params)
+        return JSONResponse(body, status_code=status)
+    except Exception as e:
+        traceback.print_exc()
+        return error(str(e), 500)
+
+async def snapshot_diff(request):
+    if not authorized(request): return error("Unauthorized", 401)
+    try:
+        body, status = await blocking(run_snapshot_diff, request.query_params)
+        return JSONResponse(body, status_code=status)
+    except Exception as e:
+        traceback.print_exc()
+        return error(str(e), 500)
+
+async def snapshot_download(request):
+    if not authorized(request): return error("Unauthorized", 401)
+    snapshot_id = request.path_params['snapshot_id']
+    try:
+        body, status = await blocking(run_snapshot_csv, snapshot_id, request.query_params)
+        if status != 200: return JSONResponse(body, status_code=status)
+    except Exception as e:
+        traceback.print_exc()
+        return error(str(e), 500)
+    # A sync iterator: Starlette advances it in worker threads
+    return StreamingResponse(body, media_type='text/csv',
+                             headers={'Content-Disposition': f'attachment; filename="{snapshot_filename(snapshot_id, request.query_params)}"'})
+
+async def sync(request):
+    if not authorized(request): return error("Unauthorized", 401)
+    if int(request.headers.get('content-length') or 0) > MAX_SYNC_BODY_BYTES:
+        return error(f"Request body exceeds {MAX_SYNC_BODY_BYTES / (1024 * 1024):.1f} MB", 413)
+    try:
+        with span('sync.read_body'):
+            data, rows, body_hash = await blocking(read_sync_body, _BodyStream(request.stream()), SYNC_BODY_ENCODERS)
+    except SyncBodyError as e:
+        return error(str(e), e.status)
+
+    columnar = wants_columnar(parse_accept_header(request.headers.get('accept'), MIMEAccept))
+    body, status, headers = await run_steps(sync_steps(data, rows, request.headers.get('idempotency-key'), body_hash, columnar))
+    if status != 200: return JSONResponse(body, status_code=status, headers=headers)
+    # A sync iterator: Starlette advances it in worker threads
+    return StreamingResponse(chunked(body), media_type=COLUMNAR_MIME if columnar else JSON_MIME, headers={'Vary': 'Accept', **headers})
+
+# --- Request Metrics ---
+
+class RequestMetrics:
+    """Same request histograms as the Flask hooks; recorded once the body is sent"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        begin_trace()
+        sent = [0]
+
+        async def counting_send(message):
+            if message['type'] == 'http.response.body':
+                sent[0] += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, counting_send)
+        finally:
+            observe_request(end_trace(), getattr(scope.get('endpoint'), '__name__', 'unknown'), sent[0])
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    if _sheets is not None: await _sheets.aclose()
+
+app = Starlette(
+    routes=[
+        Route('/metrics', metrics, methods=['GET']),
+        Route('/health', health, methods=['GET']),
+        Route('/register', register, methods=['POST']),
+        Route('/users/bulk', bulk_users, methods=['POST']),
+        Route('/login', login, methods=['POST']),
+        Route('/change-password', change_password, methods=['POST']),
+        Route('/sync', sync, methods=['POST']),
+        Route('/stock', stock, methods=['GET']),
+        Route('/stock/{action}', stock_action, methods=['POST']),
+        Route('/snapshots', snapshots, methods=['GET']),
+        Route('/snapshots/diff', snapshot_diff, methods=['GET']),
+        Route('/snapshots/{snapshot_id:int}/csv', snapshot_download, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+        Middleware(RequestMetrics),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,164 @@
+from database import get_db_connection, Counters, in_chunks, to_float
+
+# Customer outstanding balances, rolled up on the server from pushed orders
+# and the Payments log rather than taken from whichever device pushed its
+# Customers row last.
+#
+# order_balances keeps, per order, its customer, net total, whether it
+# counts toward the balance (not a draft, not failed or cancelled, as the
+# app's recalcCustomerBalance) and what it has been paid. Payments are only
+# ever added, so an order's paid amount is the larger of the Paid cell seen
+# for it and the sum of its logged payments (order_payments, one row per
+# payment id, so a payment is counted once however often it is pushed).
+# A customer's balance is the sum of net total - paid over their counting
+# orders, kept in customer_balances and recomputed only for the customers a
+# push touches, through an index on customer.
+#
+# The rollup is seeded from the Orders tab by the first pull of a
+# spreadsheet (and again after an overwrite push). Orders that are not on
+# the tab stop counting: archived orders are paid in full.
+
+CUSTOMER_ID, BALANCE_CELL = 0, 7  # in CUSTOMER_HEADERS
+
+_counts = Counters("payments", "written_back")
+
+def _order_entry(row):
+    """(order_id, customer_id, net total, counts, paid) of an Orders row"""
+    row = list(row) + [''] * (16 - len(row))
+    counts = str(row[15]).lower() != 'draft' and str(row[13]).lower() not in ('failed', 'cancelled')
+    return str(row[0]), str(row[1] or ''), to_float(row[9]), 1 if counts else 0, to_float(row[10])
+
+def _customers_of(conn, spreadsheet_id, order_ids):
+    found = set()
+    for chunk, placeholders in in_chunks(order_ids):
+        found.update(r[0] for r in conn.execute(f"SELECT customer_id FROM order_balances WHERE spreadsheet_id = ? AND order_id IN ({placeholders})",
+                                                [spreadsheet_id] + chunk))
+    return found
+
+_ROLLUP = """SELECT spreadsheet_id, customer_id, ROUND(SUM(CASE WHEN counts THEN net_total - MAX(row_paid, logged_paid) ELSE 0 END), 2)
+             FROM order_balances WHERE spreadsheet_id = ? AND customer_id != ''"""
+
+def _refresh(conn, spreadsheet_id, customer_ids=None):
+    """Recomputes the balances of the given customers (all when None)"""
+    if customer_ids is None:
+        conn.execute('DELETE FROM customer_balances WHERE spreadsheet_id = ?', (spreadsheet_id,))
+        conn.execute(f'INSERT INTO customer_balances (spreadsheet_id, customer_id, balance) {_ROLLUP} GROUP BY customer_id', (spreadsheet_id,))
+        return
+    ids = [c for c in customer_ids if c]
+    for chunk, placeholders in in_chunks(ids):
+        conn.execute(f'DELETE FROM customer_balances WHERE spreadsheet_id = ? AND customer_id IN ({placeholders})', [spreadsheet_id] + chunk)
+        conn.execute(f'INSERT INTO customer_balances (spreadsheet_id, customer_id, balance) {_ROLLUP} AND customer_id IN ({placeholders}) GROUP BY customer_id',
+                     [spreadsheet_id] + chunk)
+
+def _upsert_orders(conn, spreadsheet_id, entries, replace_paid=False):
+    paid = 'excluded.row_paid' if replace_paid else 'MAX(row_paid, excluded.row_paid)'
+    conn.executemany(f'''INSERT INTO order_balances (spreadsheet_id, order_id, customer_id, net_total, counts, row_paid) VALUES (?, ?, ?, ?, ?, ?)
+                         ON CONFLICT (spreadsheet_id, order_id) DO UPDATE SET customer_id = excluded.customer_id, net_total = excluded.net_total,
+                         counts = excluded.counts, row_paid = {paid}''',
+                     [(spreadsheet_id, *entry) for entry in entries])
+
+def record_orders(spreadsheet_id, order_rows):
+    """Takes pushed Orders rows into the rollup"""
+    entries = {}
+    for row in order_rows:
+        if row and row[0] not in (None, ''):
+            entry = _order_entry(row)
+            entries[entry[0]] = entry
+    if not entries: return
+    conn = get_db_connection()
+    try:
+        touched = _customers_of(conn, spreadsheet_id, entries) | {e[1] for e in entries.values()}
+        _upsert_orders(conn, spreadsheet_id, entries.values())
+        _refresh(conn, spreadsheet_id, touched)
+        conn.commit()
+    finally:
+        conn.close()
+
+def record_payments(spreadsheet_id, payment_rows):
+    """Takes Payments log rows (id, order, customer, date, amount, ...) into the
+    rollup; a payment id already counted is skipped"""
+    conn = get_db_connection()
+    try:
+        added, touched = 0, set()
+        for row in payment_rows:
+            if not row or row[0] in (None, '') or len(row) < 5 or not row[1]: continue
+            payment_id, order_id, customer_id, amount = str(row[0]), str(row[1]), str(row[2] or ''), to_float(row[4])
+            if not conn.execute('INSERT OR IGNORE INTO order_payments (spreadsheet_id, payment_id, order_id, amount) VALUES (?, ?, ?, ?)',
+                                (spreadsheet_id, payment_id, order_id, amount)).rowcount:
+                continue
+            # An order not pushed yet starts with just its payments
+            conn.execute('''INSERT INTO order_balances (spreadsheet_id, order_id, customer_id, logged_paid) VALUES (?, ?, ?, ?)
+                            ON CONFLICT (spreadsheet_id, order_id) DO UPDATE SET logged_paid = logged_paid + excluded.logged_paid,
+                            customer_id = CASE WHEN customer_id = '' THEN excluded.customer_id ELSE customer_id END''',
+                         (spreadsheet_id, order_id, customer_id, amount))
+            touched |= _customers_of(conn, spreadsheet_id, [order_id])
+            added += 1
+        if added: _refresh(conn, spreadsheet_id, touched)
+        conn.commit()
+    finally:
+        conn.close()
+    _counts.add("payments", added)
+    return added
+
+def is_seeded(spreadsheet_id):
+    conn = get_db_connection()
+    try:
+        return conn.execute('SELECT 1 FROM balances_seeded WHERE spreadsheet_id = ?', (spreadsheet_id,)).fetchone() is not None
+    finally:
+        conn.close()
+
+def reconcile_balances(spreadsheet_id, order_rows, replace_paid=False):
+    """Brings the rollup in line with a full Orders tab read (header first);
+    replace_paid (overwrite pushes) takes the tab's Paid cells as they are"""
+    entries = {}
+    for row in order_rows[1:]:
+        if row and row[0] not in (None, ''):
+            entry = _order_entry(row)
+            entries[entry[0]] = entry
+    conn = get_db_connection()
+    try:
+        conn.execute('UPDATE order_balances SET counts = 0 WHERE spreadsheet_id = ?', (spreadsheet_id,))
+        _upsert_orders(conn, spreadsheet_id, entries.values(), replace_paid)
+        _refresh(conn, spreadsheet_id)
+        conn.execute('INSERT OR REPLACE INTO balances_seeded (spreadsheet_id) VALUES (?)', (spreadsheet_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def _balances(spreadsheet_id):
+    conn = get_db_connection()
+    try:
+        return dict(conn.execute('SELECT customer_id, balance FROM customer_balances WHERE spreadsheet_id = ?', (spreadsheet_id,)).fetchall())
+    finally:
+        conn.close()
+
+def take_pushed_balances(spreadsheet_id, rows):
+    """Pushed Customers rows get the rolled-up balance (in place) when the rollup has the customer"""
+    # Until the first pull seeds it the rollup only has this push's orders
+    if not rows or not is_seeded(spreadsheet_id): return
+    balances = _balances(spreadsheet_id)
+    for row in rows:
+        if row and str(row[CUSTOMER_ID]) in balances:
+            row[BALANCE_CELL] = balances[str(row[CUSTOMER_ID])]
+
+def overlay_balances(spreadsheet_id, rows):
+    """Sets the Balance of pulled Customers rows (header first) to the rolled-up
+    one, in place. Returns the rows the sheet has wrong, to be written back."""
+    balances, stale = _balances(spreadsheet_id), []
+    for row in rows[1:]:
+        if not row or str(row[CUSTOMER_ID]) not in balances: continue
+        balance = balances[str(row[CUSTOMER_ID])]
+        if len(row) <= BALANCE_CELL or abs(to_float(row[BALANCE_CELL]) - balance) >= 0.005:
+            row.extend([''] * (BALANCE_CELL + 1 - len(row)))
+            row[BALANCE_CELL] = balance
+            stale.append(row)
+    _counts.add("written_back", len(stale))
+    return stale
+
+def balance_stats():
+    conn = get_db_connection()
+    try:
+        customers = conn.execute('SELECT COUNT(*) FROM customer_balances').fetchone()[0]
+    finally:
+        conn.close()
+    return {"customers": customers, **_counts.snapshot()}
@@ -0,0 +1,153 @@
+import os
+import ssl
+import time
+import socket
+import threading
+import functools
+
+import httplib2
+
+# Circuit breaker around the Sheets backend.
+# Consecutive failures (429, 5xx, timeouts, connection errors, or calls slower
+# than PARTFLOW_BREAKER_SLOW_SECONDS) open it; while open, calls fail at once
+# with SheetsUnavailable instead of waiting out Google. After the cooldown the
+# next call goes through as a probe: success closes the breaker, failure opens
+# it again with the cooldown doubled (up to PARTFLOW_BREAKER_MAX_OPEN_SECONDS).
+# /sync falls back to the last good pull and the retry queue meanwhile.
+
+FAILURE_THRESHOLD = int(os.environ.get('PARTFLOW_BREAKER_FAILURES', '5'))
+OPEN_SECONDS = float(os.environ.get('PARTFLOW_BREAKER_OPEN_SECONDS', '30'))
+MAX_OPEN_SECONDS = float(os.environ.get('PARTFLOW_BREAKER_MAX_OPEN_SECONDS', '300'))
+SLOW_CALL_SECONDS = float(os.environ.get('PARTFLOW_BREAKER_SLOW_SECONDS', '10'))
+# Per-request timeout of every Sheets call (both clients)
+SHEETS_TIMEOUT_SECONDS = float(os.environ.get('PARTFLOW_SHEETS_TIMEOUT', '30'))
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+class SheetsUnavailable(Exception):
+    """Raised instead of calling Sheets while the breaker is open"""
+    def __init__(self, retry_after):
+        super().__init__(f"Google Sheets is unavailable, retrying in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+def is_outage(exc):
+    """True for errors that say Sheets is down or overloaded, not that the request was wrong"""
+    if isinstance(exc, SheetsUnavailable): return True
+    status = getattr(exc, 'status', None) or getattr(getattr(exc, 'resp', None), 'status', None)
+    if status is not None:
+        status = int(status)
+        return status == 429 or status >= 500
+    if isinstance(exc, (TimeoutError, ConnectionError, socket.gaierror, ssl.SSLError, httplib2.HttpLib2Error)): return True
+    # httpx transport errors (async client)
+    return type(exc).__module__.split('.')[0] == 'httpx'
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, open_seconds=OPEN_SECONDS, max_open_seconds=MAX_OPEN_SECONDS,
+                 slow_call_seconds=SLOW_CALL_SECONDS, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._failures = 0
+        self._cooldown = open_seconds
+        self._open_until = 0.0
+        self._probing = False
+        self.opened_at = None
+        self.last_error = None
+        self.rejected = 0
+
+    def retry_after(self):
+        return max(0.0, self._open_until - self._clock())
+
+    def before_call(self):
+        """Raises SheetsUnavailable unless the call may go to Sheets"""
+        with self._lock:
+            if self.state == CLOSED: return
+            if self.state == OPEN and self._clock() >= self._open_until:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+            raise SheetsUnavailable(max(self.retry_after(), 1.0))
+
+    def record(self, seconds, exc=None):
+        """Outcome of a call let through by before_call"""
+        if exc is not None and not isinstance(exc, Exception):
+            # Interrupted (e.g. a cancelled request): says nothing about Sheets
+            with self._lock: self._probing = False
+            return
+        if exc is not None and is_outage(exc):
+            self._failure(f"{type(exc).__name__}: {exc}"[:300])
+        elif exc is None and seconds > self.slow_call_seconds:
+            self._failure(f"slow call ({seconds:.1f}s)")
+        else:
+            self._success()
+
+    def _success(self):
+        with self._lock:
+            if self.state == OPEN: return
+            if self.state == HALF_OPEN:
+                print(f"Sheets circuit closed after {time.time() - self.opened_at:.0f}s")
+                self.opened_at = None
+            self.state = CLOSED
+            self._failures = 0
+            self._cooldown = self.open_seconds
+            self._probing = False
+
+    def _failure(self, reason):
+        with self._lock:
+            self.last_error = reason
+            if self.state == OPEN: return
+            self._failures += 1
+            if self.state == HALF_OPEN:
+                # Failed probe: stay away for longer
+                self._cooldown = min(self._cooldown * 2, self.max_open_seconds)
+            elif self._failures < self.failure_threshold:
+                return
+            else:
+                self.opened_at = time.time()
+            print(f"Sheets circuit open for {self._cooldown:.0f}s: {reason}")
+            self.state = OPEN
+            self._probing = False
+            self._open_until = self._clock() + self._cooldown
+
+    def call(self, fn, *args, **kwargs):
+        self.before_call()
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.record(time.perf_counter() - start, e)
+            raise
+        self.record(time.perf_counter() - start)
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self._failures, "rejected": self.rejected,
+                    "retry_after_seconds": round(self.retry_after(), 1) if self.state != CLOSED else 0,
+                    "open_since": self.opened_at, "last_error": self.last_error}
+
+class _Guarded:
+    def __init__(self, target, breaker):
+        self._target = target
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name == 'execute': return functools.partial(self._breaker.call, attr)
+        if not callable(attr): return attr
+
+        def call(*args, **kwargs):
+            return _Guarded(attr(*args, **kwargs), self._breaker)
+        return call
+
+def guarded_service(service, breaker=None):
+    """Wraps a Sheets service so every .execute() goes through the breaker"""
+    return _Guarded(service, breaker or sheets_breaker)
+
+sheets_breaker = CircuitBreaker()
@@ -1,18 +1,57 @@
 import sqlite3
 import os
+import threading
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from metrics import TracedConnection
+
 # Use /tmp for SQLite if on Vercel, as it's the only writable directory
-if os.environ.get('VERCEL'):
+if os.environ.get('PARTFLOW_DB_PATH'):
+    DB_PATH = os.environ['PARTFLOW_DB_PATH']
+elif os.environ.get('VERCEL'):
     DB_PATH = '/tmp/partflow.db'
 else:
     DB_PATH = os.path.join(os.path.dirname(__file__), 'partflow.db')
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, factory=TracedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
+# SQLite host-parameter limit per IN (...) lookup
+LOOKUP_CHUNK = 500
+
+def in_chunks(values, size=LOOKUP_CHUNK):
+    """(chunk, placeholders) per slice of values small enough for one
+    IN (...) list: f"... IN ({placeholders})" with the chunk as its parameters"""
+    values = list(values)
+    for start in range(0, len(values), size):
+        chunk = values[start:start + size]
+        yield chunk, ','.join('?' * len(chunk))
+
+class Counters:
+    """Named running totals for a module's /health stats, safe across threads"""
+
+    def __init__(self, *names):
+        self._counts = dict.fromkeys(names, 0)
+        self._lock = threading.Lock()
+
+    def add(self, name, n=1):
+        with self._lock: self._counts[name] += n
+
+    def snapshot(self):
+        with self._lock: return dict(self._counts)
+
+def to_int(value, default=0):
+    """A sheet cell as an int; blank or unreadable gives default"""
+    try: return int(float(value)) if value not in (None, '') else default
+    except (TypeError, ValueError): return default
+
+def to_float(value, default=0.0):
+    """A sheet cell as a float; blank or unreadable gives default"""
+    try: return float(value) if value not in (None, '') else default
+    except (TypeError, ValueError): return default
+
 def init_db():
     conn = get_db_connection()
     conn.execute('''
@@ -26,6 +65,255 @@ def init_db():
         )
     ''')
     
+    # Low-stock index: items ordered by how far they are below threshold
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS low_stock_index (
+            spreadsheet_id TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            deficit REAL NOT NULL,
+            item_display_name TEXT,
+            item_number TEXT,
+            current_stock_qty INTEGER,
+            low_stock_threshold INTEGER,
+            is_out_of_stock INTEGER DEFAULT 0,
+            updated_at TEXT,
+            PRIMARY KEY (spreadsheet_id, item_id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_low_stock_order ON low_stock_index (spreadsheet_id, deficit DESC, item_id)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS low_stock_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            spreadsheet_id TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            event TEXT NOT NULL,
+            deficit REAL,
+            current_stock_qty INTEGER,
+            low_stock_threshold INTEGER,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_low_stock_changes ON low_stock_changes (spreadsheet_id, seq)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS low_stock_seeded (
+            spreadsheet_id TEXT PRIMARY KEY,
+            seeded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Archived (closed) orders: which monthly archive tab each one lives in
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_archive_index (
+            spreadsheet_id TEXT NOT NULL,
+            order_id TEXT NOT NULL,
+            partition TEXT NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (spreadsheet_id, order_id)
+        )
+    ''')
+    
+    # /sync pushes waiting for Sheets to come back (retry_queue.py)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_retry_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            spreadsheet_id TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            last_error TEXT,
+            queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sync_retry_queue ON sync_retry_queue (spreadsheet_id, status, id)')
+
+    # Sheet row of every entity id, per tab, for upserts without a full read (row_index.py)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sheet_row_index (
+            spreadsheet_id TEXT NOT NULL,
+            tab TEXT NOT NULL,
+            entity_id TEXT NOT NULL,
+            row_num INTEGER NOT NULL,
+            PRIMARY KEY (spreadsheet_id, tab, entity_id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sheet_row_index_row ON sheet_row_index (spreadsheet_id, tab, row_num)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sheet_row_counts (
+            spreadsheet_id TEXT NOT NULL,
+            tab TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            PRIMARY KEY (spreadsheet_id, tab)
+        )
+    ''')
+
+    # /sync pushes by Idempotency-Key (idempotency.py)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_idempotency (
+            spreadsheet_id TEXT NOT NULL,
+            idem_key TEXT NOT NULL,
+            status TEXT NOT NULL,
+            outcome TEXT,
+            claimed_at REAL NOT NULL,
+            completed_at REAL,
+            body_hash TEXT,
+            PRIMARY KEY (spreadsheet_id, idem_key)
+        )
+    ''')
+    # Databases created before keys were tied to the request body
+    if 'body_hash' not in {row['name'] for row in conn.execute('PRAGMA table_info(sync_idempotency)')}:
+        conn.execute('ALTER TABLE sync_idempotency ADD COLUMN body_hash TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sync_idempotency_claimed ON sync_idempotency (claimed_at)')
+
+    # Stock ledger (stock_ledger.py): levels are the sum of the ledger entries
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stock_levels (
+            spreadsheet_id TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            on_hand INTEGER NOT NULL,
+            reserved INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (spreadsheet_id, item_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stock_holds (
+            spreadsheet_id TEXT NOT NULL,
+            ref TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            held INTEGER NOT NULL DEFAULT 0,
+            committed INTEGER NOT NULL DEFAULT 0,
+            expires_at REAL,
+            PRIMARY KEY (spreadsheet_id, ref, item_id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_holds_expiry ON stock_holds (spreadsheet_id, item_id, expires_at) WHERE held > 0')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stock_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            spreadsheet_id TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            ref TEXT,
+            kind TEXT NOT NULL,
+            on_hand_delta INTEGER NOT NULL DEFAULT 0,
+            reserved_delta INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_stock_ledger_item ON stock_ledger (spreadsheet_id, item_id, id)')
+    # An adjustment is applied once
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_stock_ledger_adjust ON stock_ledger (spreadsheet_id, ref) WHERE kind = 'adjust'")
+
+    # Ids already appended to the append-only tabs (append_log.py)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS append_log_seen (
+            spreadsheet_id TEXT NOT NULL,
+            tab TEXT NOT NULL,
+            entity_id TEXT NOT NULL,
+            PRIMARY KEY (spreadsheet_id, tab, entity_id)
+        )
+    ''')
+
+    # Customer balances rolled up from orders and payments (balances.py)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_balances (
+            spreadsheet_id TEXT NOT NULL,
+            order_id TEXT NOT NULL,
+            customer_id TEXT NOT NULL DEFAULT '',
+            net_total REAL NOT NULL DEFAULT 0,
+            counts INTEGER NOT NULL DEFAULT 0,
+            row_paid REAL NOT NULL DEFAULT 0,
+            logged_paid REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (spreadsheet_id, order_id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_order_balances_customer ON order_balances (spreadsheet_id, customer_id)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS order_payments (
+            spreadsheet_id TEXT NOT NULL,
+            payment_id TEXT NOT NULL,
+            order_id TEXT NOT NULL,
+            amount REAL NOT NULL,
+            PRIMARY KEY (spreadsheet_id, payment_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS customer_balances (
+            spreadsheet_id TEXT NOT NULL,
+            customer_id TEXT NOT NULL,
+            balance REAL NOT NULL,
+            PRIMARY KEY (spreadsheet_id, customer_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS balances_seeded (
+            spreadsheet_id TEXT PRIMARY KEY,
+            seeded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Auto SKU allocation (skus.py): highest number after each SKU prefix, and the SKUs taken
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sku_counters (
+            spreadsheet_id TEXT NOT NULL,
+            prefix TEXT NOT NULL,
+            last_number INTEGER NOT NULL,
+            PRIMARY KEY (spreadsheet_id, prefix)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sku_used (
+            spreadsheet_id TEXT NOT NULL,
+            sku TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            PRIMARY KEY (spreadsheet_id, sku)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sku_used_item ON sku_used (spreadsheet_id, item_id)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sku_seeded (
+            spreadsheet_id TEXT PRIMARY KEY,
+            digest TEXT NOT NULL
+        )
+    ''')
+
+    # Snapshots of the pulled tabs (snapshots.py): compressed chunks stored once by digest
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            spreadsheet_id TEXT NOT NULL,
+            new_chunks INTEGER NOT NULL DEFAULT 0,
+            new_bytes INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_snapshots_spreadsheet ON snapshots (spreadsheet_id, id)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS snapshot_tabs (
+            snapshot_id INTEGER NOT NULL,
+            tab TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            header TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            PRIMARY KEY (snapshot_id, tab)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS snapshot_parts (
+            snapshot_id INTEGER NOT NULL,
+            tab TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            chunk TEXT NOT NULL,
+            PRIMARY KEY (snapshot_id, tab, seq)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_snapshot_parts_chunk ON snapshot_parts (chunk)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS snapshot_chunks (
+            digest TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            row_count INTEGER NOT NULL
+        )
+    ''')
+
     # Create default admin if not exists
     admin = conn.execute('SELECT * FROM users WHERE username = ?', ('admin',)).fetchone()
     if not admin:
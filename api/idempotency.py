@@ -0,0 +1,96 @@
+import os
+import json
+import time
+
+from database import get_db_connection, Counters
+
+# Completed /sync pushes by Idempotency-Key, so a client that lost the
+# response (connection dropped after the server wrote) can resend the same
+# push without it being written again: the retry gets the recorded outcome
+# with a fresh pull. A key is claimed before the push starts. A second
+# request with it while the first is still running is told to retry
+# (409) unless the claim is older than PARTFLOW_IDEMPOTENCY_LEASE_SECONDS,
+# in which case the first is taken to have died and the push runs again.
+# Pushes that fail release their key. Each key keeps the hash of the body
+# it was claimed with: the same key with a different body is refused (422)
+# rather than answered with another push's outcome. Completed keys expire
+# after PARTFLOW_IDEMPOTENCY_TTL_SECONDS, and at most
+# PARTFLOW_IDEMPOTENCY_MAX_KEYS are kept (oldest dropped first).
+
+IDEMPOTENCY_TTL_SECONDS = float(os.environ.get('PARTFLOW_IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('PARTFLOW_IDEMPOTENCY_MAX_KEYS', '10000'))
+IDEMPOTENCY_LEASE_SECONDS = float(os.environ.get('PARTFLOW_IDEMPOTENCY_LEASE_SECONDS', '120'))
+MAX_KEY_LENGTH = 255
+
+NEW, IN_PROGRESS, DONE, MISMATCH = 'new', 'in_progress', 'done', 'mismatch'
+
+_counts = Counters("replayed", "in_progress", "mismatched")
+
+def valid_key(key):
+    return 0 < len(key) <= MAX_KEY_LENGTH and key.isprintable()
+
+def claim(spreadsheet_id, key, body_hash=None):
+    """(NEW, None) when this request owns the push, (DONE, outcome) when it
+    already went through, (IN_PROGRESS, None) while another request runs it,
+    (MISMATCH, None) when the key is live with a different body_hash"""
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        cur = conn.execute("INSERT OR IGNORE INTO sync_idempotency (spreadsheet_id, idem_key, status, claimed_at, body_hash) "
+                           "VALUES (?, ?, 'in_progress', ?, ?)", (spreadsheet_id, key, now, body_hash))
+        if cur.rowcount == 1:
+            conn.commit()
+            return NEW, None
+        row = conn.execute('SELECT status, outcome, claimed_at, completed_at, body_hash FROM sync_idempotency '
+                           'WHERE spreadsheet_id = ? AND idem_key = ?', (spreadsheet_id, key)).fetchone()
+        live = (row['completed_at'] > now - IDEMPOTENCY_TTL_SECONDS if row['status'] == 'done'
+                else row['claimed_at'] > now - IDEMPOTENCY_LEASE_SECONDS)
+        # Keys recorded before bodies were hashed have none to compare
+        if live and row['body_hash'] and body_hash and row['body_hash'] != body_hash:
+            _counts.add("mismatched")
+            return MISMATCH, None
+        if live and row['status'] == 'done':
+            _counts.add("replayed")
+            return DONE, json.loads(row['outcome'])
+        if live:
+            _counts.add("in_progress")
+            return IN_PROGRESS, None
+        # Expired, or abandoned mid-push: claim it again (unless another retry just did)
+        cur = conn.execute("UPDATE sync_idempotency SET status = 'in_progress', outcome = NULL, claimed_at = ?, completed_at = NULL, body_hash = ? "
+                           "WHERE spreadsheet_id = ? AND idem_key = ? AND claimed_at = ?", (now, body_hash, spreadsheet_id, key, row['claimed_at']))
+        conn.commit()
+        return (NEW, None) if cur.rowcount == 1 else (IN_PROGRESS, None)
+    finally:
+        conn.close()
+
+def complete(spreadsheet_id, key, outcome):
+    """Records the push as done; outcome is what a retry is answered with"""
+    now = time.time()
+    conn = get_db_connection()
+    try:
+        conn.execute("UPDATE sync_idempotency SET status = 'done', outcome = ?, completed_at = ? WHERE spreadsheet_id = ? AND idem_key = ?",
+                     (json.dumps(outcome, separators=(',', ':')), now, spreadsheet_id, key))
+        conn.execute('''DELETE FROM sync_idempotency WHERE (status = 'done' AND completed_at < ?)
+                        OR rowid IN (SELECT rowid FROM sync_idempotency ORDER BY claimed_at DESC LIMIT -1 OFFSET ?)''',
+                     (now - IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_KEYS))
+        conn.commit()
+    finally:
+        conn.close()
+
+def release(spreadsheet_id, key):
+    """The push failed: a retry with the key runs it again"""
+    conn = get_db_connection()
+    try:
+        conn.execute("DELETE FROM sync_idempotency WHERE spreadsheet_id = ? AND idem_key = ? AND status = 'in_progress'",
+                     (spreadsheet_id, key))
+        conn.commit()
+    finally:
+        conn.close()
+
+def idempotency_stats():
+    conn = get_db_connection()
+    try:
+        keys = conn.execute('SELECT COUNT(*) FROM sync_idempotency').fetchone()[0]
+    finally:
+        conn.close()
+    return {"keys": keys, **_counts.snapshot()}
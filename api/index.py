@@ -5,6 +5,7 @@ import json
 import traceback
 import datetime
 import base64
+import time
 
 # --- Vercel Compatibility Fix ---
 # Add the 'api' directory to the path so we can import 'database.py'
@@ -12,15 +13,43 @@ CURRENT_DIR = os.path.dirname(__file__)
 if CURRENT_DIR not in sys.path:
     sys.path.append(CURRENT_DIR)
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, make_response, send_file, stream_with_context
 from flask_cors import CORS
+import httplib2
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
 
 # Import from our local database.py
-from database import init_db, create_user, authenticate_user, DB_PATH
+from database import init_db, create_user, authenticate_user, update_user_password, DB_PATH
+from schema import ORDER_HEADERS, LINE_HEADERS
+from summary import refresh_summary, get_cached_summary, summary_for_rep
+from low_stock import reconcile_low_stock, is_seeded, list_low_stock, low_stock_changes_since, latest_change_seq
+from reorder import reorder_suggestions, DEFAULT_ALPHA, DEFAULT_LEAD_TIME_DAYS, DEFAULT_COVER_DAYS
+from metrics import (span, begin_trace, end_trace, current_trace, traced_service, render_prometheus,
+                     REQUEST_LATENCY, RESPONSE_BYTES, SYNC_API_CALLS, SYNC_ROWS_READ, SYNC_ROWS_WRITTEN)
+from profiling import (SyncProfile, should_profile, list_profiles, load_profile,
+                       sample_rate as profile_sample_rate, artifact_path as profile_artifact_path)
+from wire import COLUMNAR_MIME, JSON_MIME, wants_columnar
+from pull_cache import pull_cache
+from sync_body import read_sync_body, SyncBodyError, MAX_SYNC_BODY_BYTES
+from row_index import index_stats
+from storage import SheetsBackend, register_backend, open_backend
+from breaker import sheets_breaker, guarded_service, SHEETS_TIMEOUT_SECONDS
+from retry_queue import queue_stats
+from idempotency import idempotency_stats
+import stock_ledger
+import balances
+from append_log import append_log_stats
+from patches import patch_stats
+from provisioning import provision_users, provisioning_stats, MAX_BULK_USERS
+import skus
+from snapshots import list_snapshots, snapshot_csv, diff_snapshots, snapshot_stats
+from archive import (archive_closed_orders, lookup_partition, archived_partitions,
+                     read_archived_order_rows, archive_tab_names, DEFAULT_ARCHIVE_AFTER_DAYS)
+from sheet_rows import SYNC_BODY_ENCODERS, parse_inventory_rows, parse_order_rows
+from sync_pipeline import sync_steps, run_steps, chunked
 
 app = Flask(__name__)
 CORS(app)
@@ -39,6 +68,9 @@ def check_auth():
 SERVICE_ACCOUNT_FILE = os.path.join(CURRENT_DIR, 'config', 'service-account.json')
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
+# How many archived months the reorder forecast reads back
+REORDER_ARCHIVE_MONTHS = 6
+
 # --- Helper Functions ---
 
 def get_google_config():
@@ -109,89 +141,155 @@ def get_sheets_service():
 
         creds = service_account.Credentials.from_service_account_info(
             config, scopes=SCOPES)
-        return build('sheets', 'v4', credentials=creds)
+        # Bounded wait per call; the breaker (see sync_pipeline.py) handles the rest
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=SHEETS_TIMEOUT_SECONDS))
+        return traced_service(build('sheets', 'v4', http=http))
     except Exception as e:
         print("AUTHENTICATION ERROR TRACEBACK:")
         traceback.print_exc()
         raise e
 
-def ensure_headers(service, spreadsheet_id, sheet_name, headers):
-    try:
-        spreadsheet = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-        sheets = spreadsheet.get('sheets', [])
-        sheet_exists = any(s['properties']['title'] == sheet_name for s in sheets)
-
-        if not sheet_exists:
-            body = {'requests': [{'addSheet': {'properties': {'title': sheet_name}}}]}
-            service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
-    except Exception as err:
-        print(f"Error creating sheet {sheet_name}: {err}")
-        pass
-
-def upsert_rows(service, spreadsheet_id, sheet_name, headers, data, id_column_index=0):
-    # Fetch existing
-    range_name = f"'{sheet_name}'!A1:Z1000"
+# The Sheets backend goes through the breaker; looked up per request
+register_backend('sheets', lambda: SheetsBackend(guarded_service(get_sheets_service())))
+
+
+# --- Snapshots ---
+# /snapshots lists, downloads and diffs the snapshots each successful sync
+# takes (snapshots.py)
+
+def _snapshot_id(value, name):
+    try: return int(value)
+    except (TypeError, ValueError): raise ValueError(f"{name} must be a snapshot id")
+
+def run_snapshots(args):
+    """(body, status) of GET /snapshots; shared with the ASGI app"""
+    spreadsheet_id = args.get('spreadsheetId')
+    if not spreadsheet_id: return {"success": False, "message": "Spreadsheet ID is required"}, 400
+    try: limit = max(1, min(int(args.get('limit', 50)), 500))
+    except ValueError: return {"success": False, "message": "limit must be a number"}, 400
+    return {"success": True, "snapshots": list_snapshots(spreadsheet_id, limit)}, 200
+
+def run_snapshot_csv(snapshot_id, args):
+    """(CSV text generator, 200) of GET /snapshots/<id>/csv, or (error body, status)"""
+    spreadsheet_id = args.get('spreadsheetId')
+    if not spreadsheet_id: return {"success": False, "message": "Spreadsheet ID is required"}, 400
+    lines = snapshot_csv(spreadsheet_id, snapshot_id, args.get('tab') or 'Inventory')
+    if lines is None: return {"success": False, "message": "Snapshot or tab not found"}, 404
+    return lines, 200
+
+def run_snapshot_diff(args):
+    """(body, status) of GET /snapshots/diff; shared with the ASGI app"""
+    spreadsheet_id = args.get('spreadsheetId')
+    if not spreadsheet_id: return {"success": False, "message": "Spreadsheet ID is required"}, 400
     try:
-        result = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=range_name).execute()
-        rows = result.get('values', [])
-    except:
-        rows = []
-    
-    # 1. Force Header Match
-    if not rows or not rows[0]:
-        rows = [headers]
-    else:
-        # Case insensitive compare
-        current = [str(h).strip().lower() for h in rows[0]]
-        expected = [str(h).strip().lower() for h in headers]
-        
-        if current != expected:
-            print(f"HEADER MISMATCH in {sheet_name}. Expected {len(headers)} cols, found {len(rows[0])}.")
-            # Keep data, but reset headers
-            old_data = rows[1:]
-            rows = [headers]
-            for od in old_data:
-                # Pad/Truncate row to match new headers
-                new_r = od[:len(headers)]
-                while len(new_r) < len(headers): new_r.append('0')
-                rows.append(new_r)
-
-    # 2. Map Data
-    if data:
-        id_map = {str(row[id_column_index]): i for i, row in enumerate(rows) if i > 0 and len(row) > id_column_index}
-        for new_row in data:
-            nid = str(new_row[id_column_index])
-            if nid in id_map: rows[id_map[nid]] = new_row
-            else: rows.append(new_row)
-
-    # 3. Write back (Ensuring Row 1 is ALWAYS the headers we want)
-    rows[0] = headers
-    body = {'values': rows}
-    
-    # Clear first to ensure no stale columns/rows remain
-    service.spreadsheets().values().clear(spreadsheetId=spreadsheet_id, range=f"'{sheet_name}'!A1:Z").execute()
-    
-    service.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id, range=f"'{sheet_name}'!A1",
-        valueInputOption='USER_ENTERED', body=body).execute()
-    return True
+        from_id, to_id = _snapshot_id(args.get('from'), 'from'), _snapshot_id(args.get('to'), 'to')
+    except ValueError as e:
+        return {"success": False, "message": str(e)}, 400
+    tab = args.get('tab')
+    diff = diff_snapshots(spreadsheet_id, from_id, to_id, [tab] if tab else None)
+    if diff is None: return {"success": False, "message": "Snapshot not found"}, 404
+    return {"success": True, "from": from_id, "to": to_id, "tabs": diff}, 200
+
+def snapshot_filename(snapshot_id, args):
+    return f"{args.get('tab') or 'Inventory'}_snapshot_{snapshot_id}.csv"
 
 
+# --- Stock Ledger ---
+# Reservations and adjustments against the ledger's stock (stock_ledger.py);
+# the /sync write-back of its stock is in sync_pipeline.py
+
+STOCK_ACTIONS = ('reserve', 'commit', 'release', 'adjust')
+
+def run_stock_action(action, data):
+    """(body, status) of POST /stock/<action>; shared with the ASGI app"""
+    spreadsheet_id = data.get('spreadsheetId')
+    if not spreadsheet_id: return {"success": False, "message": "Spreadsheet ID is required"}, 400
+    try:
+        if action == 'adjust':
+            if not data.get('adjustmentId') or not data.get('itemId'): raise ValueError("adjustmentId and itemId are required")
+            result = stock_ledger.adjust(spreadsheet_id, str(data['adjustmentId']), str(data['itemId']), data.get('delta'))
+            if result is None: return {"success": False, "message": f"Item {data['itemId']} has no stock level yet; sync first"}, 404
+            return {"success": True, **result}, 200
+        order_id = data.get('orderId')
+        if not order_id: raise ValueError("orderId is required")
+        if action == 'reserve':
+            result = stock_ledger.reserve(spreadsheet_id, str(order_id), data.get('lines'), data.get('holdSeconds'))
+        elif action == 'commit':
+            result = stock_ledger.commit(spreadsheet_id, str(order_id), data.get('lines'))
+        else:
+            result = stock_ledger.release(spreadsheet_id, str(order_id))
+    except (TypeError, ValueError) as e:
+        return {"success": False, "message": str(e)}, 400
+    if result.get('shortfalls'):
+        return {"success": False, "message": f"Not enough stock for {len(result['shortfalls'])} item(s)", **result}, 409
+    return {"success": True, **result}, 200
+
+
+# --- Request Metrics ---
+
+@app.before_request
+def start_request_trace():
+    begin_trace()
+
+def observe_request(trace, endpoint, body_bytes):
+    if trace:
+        REQUEST_LATENCY.observe(time.perf_counter() - trace["started"], endpoint)
+        if endpoint == 'sync':
+            SYNC_API_CALLS.observe(trace["sheets_calls"])
+            SYNC_ROWS_READ.observe(trace["rows_read"])
+            SYNC_ROWS_WRITTEN.observe(trace["rows_written"])
+    RESPONSE_BYTES.observe(body_bytes, endpoint)
+
+def _counted(body, sent):
+    for chunk in body:
+        sent[0] += len(chunk)
+        yield chunk
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    if response.is_streamed:
+        # Streamed bodies (the /sync pull) are measured once fully sent
+        trace, sent = current_trace(), [0]
+        response.response = _counted(response.response, sent)
+        response.call_on_close(lambda: observe_request(trace, endpoint, sent[0]))
+        return response
+    observe_request(end_trace(), endpoint, response.calculate_content_length() or 0)
+    return response
 
 # --- API Routes ---
 
-@app.route('/health', methods=['GET'])
-def health():
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    return render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+def health_status():
     config, source = get_google_config()
     now = datetime.datetime.now(datetime.timezone.utc)
-    diag = {
+    return {
         "status": "ok",
         "version": "1.2.1-forced-header-v2",
         "server_time_utc": now.isoformat(),
         "credentials_source": source,
-        "config_check": {"customers": 11, "orders": 17}
+        "config_check": {"customers": 11, "orders": 17},
+        "pull_cache": pull_cache.stats(),
+        "sheets_breaker": sheets_breaker.stats(),
+        "retry_queue": queue_stats(),
+        "row_index": index_stats(),
+        "idempotency": idempotency_stats(),
+        "stock": stock_ledger.stock_stats(),
+        "append_log": append_log_stats(),
+        "balances": balances.balance_stats(),
+        "patches": patch_stats(),
+        "provisioning": provisioning_stats(),
+        "skus": skus.sku_stats(),
+        "snapshots": snapshot_stats()
     }
-    return jsonify(diag)
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify(health_status())
 
 @app.route('/debug-env', methods=['GET'])
 def debug_env():
@@ -212,6 +310,32 @@ def register():
         return jsonify({"success": True, "message": "User registered successfully"})
     return jsonify({"success": False, "message": "Username already exists"}), 400
 
+def run_bulk_users(data):
+    """(body, status) of a /users/bulk request. The API key is every rep's
+    token, so the caller also signs in as an admin (adminUsername, adminPassword)"""
+    if not isinstance(data, dict): data = {}
+    admin_name, admin_password = data.get('adminUsername'), data.get('adminPassword')
+    admin = authenticate_user(admin_name, admin_password) if admin_name and admin_password else None
+    if admin is None: return {"success": False, "message": "Admin credentials required"}, 401
+    if admin['role'] != 'admin': return {"success": False, "message": "Only admins can provision users"}, 403
+    users = data.get('users')
+    if not isinstance(users, list) or not users:
+        return {"success": False, "message": "users must be a non-empty list"}, 400
+    if len(users) > MAX_BULK_USERS:
+        return {"success": False, "message": f"At most {MAX_BULK_USERS} users per request"}, 413
+    results = provision_users(users)
+    return {"success": True, "created": sum(r["status"] == "created" for r in results), "results": results}, 200
+
+@app.route('/users/bulk', methods=['POST'])
+def bulk_users():
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    try:
+        body, status = run_bulk_users(request.get_json(silent=True))
+        return jsonify(body), status
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"success": False, "message": str(e)}), 500
+
 @app.route('/login', methods=['POST'])
 def login():
     data = request.json
@@ -219,173 +343,267 @@ def login():
     if user: return jsonify({"success": True, "user": user, "token": API_KEY})
     return jsonify({"success": False, "message": "Invalid credentials"}), 401
 
+@app.route('/change-password', methods=['POST'])
+def change_password():
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized API Access"}), 401
+    data = request.json
+    user_id, old_password, new_password = data.get('userId'), data.get('oldPassword'), data.get('newPassword')
+    if not all([user_id, old_password, new_password]):
+        return jsonify({"success": False, "message": "Missing required fields"}), 400
+    success, message = update_user_password(user_id, old_password, new_password)
+    if success: return jsonify({"success": True, "message": message})
+    return jsonify({"success": False, "message": message}), 400
+
 @app.route('/cron/keepalive', methods=['GET'])
 def keepalive():
     return jsonify({"status": "alive", "timestamp": datetime.datetime.now().isoformat()})
 
-@app.route('/sync', methods=['POST'])
-def sync():
+@app.route('/summary', methods=['GET'])
+def summary():
     if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
-    data = request.json
+    spreadsheet_id = request.args.get('spreadsheetId')
+    if not spreadsheet_id: return jsonify({"success": False, "message": "Spreadsheet ID is required"}), 400
+    day = request.args.get('date') or datetime.date.today().isoformat()
+    try:
+        cached = get_cached_summary(spreadsheet_id)
+        if cached is None:
+            # Cold cache (new instance): one batched read of the two tabs we need
+            item_rows, order_rows = open_backend(spreadsheet_id).read_ranges(spreadsheet_id, ['Inventory', 'Orders'])
+            cached = refresh_summary(spreadsheet_id, parse_inventory_rows(item_rows), parse_order_rows(order_rows, []))
+
+        payload, etag = summary_for_rep(cached, request.args.get('repId'), day)
+        resp = make_response(jsonify(payload))
+        resp.set_etag(etag)
+        resp.headers['Cache-Control'] = 'no-cache'
+        return resp.make_conditional(request)
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/inventory/low-stock', methods=['GET'])
+def inventory_low_stock():
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    spreadsheet_id = request.args.get('spreadsheetId')
+    if not spreadsheet_id: return jsonify({"success": False, "message": "Spreadsheet ID is required"}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), 500))
+        since = request.args.get('since')
+        if not is_seeded(spreadsheet_id):
+            item_rows = open_backend(spreadsheet_id).read_ranges(spreadsheet_id, ['Inventory'])[0]
+            reconcile_low_stock(spreadsheet_id, parse_inventory_rows(item_rows))
+
+        # Change feed mode: only what moved since the caller's cursor
+        if since is not None:
+            changes, next_since, reset = low_stock_changes_since(spreadsheet_id, int(since), limit)
+            return jsonify({"success": True, "changes": changes, "since": next_since, "reset": reset})
+
+        # Read the feed position first so nothing is missed between list and poll
+        latest = latest_change_seq(spreadsheet_id)
+        items, next_cursor, total = list_low_stock(spreadsheet_id, limit, request.args.get('cursor'))
+        return jsonify({"success": True, "items": items, "total": total, "nextCursor": next_cursor, "since": latest})
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/inventory/reorder-suggestions', methods=['GET'])
+def inventory_reorder_suggestions():
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    spreadsheet_id = request.args.get('spreadsheetId')
+    if not spreadsheet_id: return jsonify({"success": False, "message": "Spreadsheet ID is required"}), 400
+    try:
+        alpha = float(request.args.get('alpha', DEFAULT_ALPHA))
+        lead_time_days = float(request.args.get('leadTimeDays', DEFAULT_LEAD_TIME_DAYS))
+        cover_days = float(request.args.get('coverDays', DEFAULT_COVER_DAYS))
+        limit = max(1, min(int(request.args.get('limit', 200)), 5000))
+        if not 0 < alpha <= 1: raise ValueError("alpha must be in (0, 1]")
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    try:
+        # Archived months still count as demand history
+        ranges = [('OrderLines', 7), ('Orders', 4), 'Inventory']
+        for partition in archived_partitions(spreadsheet_id)[-REORDER_ARCHIVE_MONTHS:]:
+            orders_tab, lines_tab = archive_tab_names(partition)
+            ranges += [(lines_tab, 7), (orders_tab, 4)]
+        value_ranges = open_backend(spreadsheet_id).read_ranges(spreadsheet_id, ranges)
+        line_rows, order_rows, item_rows = value_ranges[0], value_ranges[1], value_ranges[2]
+        for k in range(3, len(ranges), 2):
+            line_rows = line_rows + value_ranges[k][1:]
+            order_rows = order_rows + value_ranges[k + 1][1:]
+
+        suggestions, stats = reorder_suggestions(
+            spreadsheet_id, line_rows, order_rows, parse_inventory_rows(item_rows),
+            alpha=alpha, lead_time_days=lead_time_days, cover_days=cover_days)
+        if request.args.get('all') != '1':
+            suggestions = [s for s in suggestions if s['suggested_order_qty'] > 0]
+        return jsonify({"success": True, "suggestions": suggestions[:limit], "total": len(suggestions), "stats": stats})
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/archive', methods=['POST'])
+def archive():
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    data = request.json or {}
     spreadsheet_id = data.get('spreadsheetId')
-    customers, orders, items = data.get('customers', []), data.get('orders', []), data.get('items', [])
-    mode = data.get('mode', 'upsert')
     if not spreadsheet_id: return jsonify({"success": False, "message": "Spreadsheet ID is required"}), 400
     try:
-        service = get_sheets_service()
-        customer_headers = ['ID', 'Shop Name', 'Address', 'Phone', 'City', 'Discount 1', 'Discount 2', 'Balance', 'Credit Period', 'Status', 'Last Updated']
-        inventory_headers = ['ID', 'Display Name', 'Internal Name', 'SKU', 'Vehicle', 'Brand/Origin', 'Category', 'Unit Value', 'Stock Qty', 'Low Stock Threshold', 'Out of Stock', 'Status', 'Last Updated']
-        order_headers = ['Order ID', 'Customer ID', 'Rep ID', 'Date', 'Gross Total', 'Disc 1 Rate', 'Disc 1 Value', 'Disc 2 Rate', 'Disc 2 Value', 'Net Total', 'Paid', 'Balance Due', 'Payment Status', 'Delivery Status', 'Credit Period', 'Status', 'Last Updated']
-        line_headers = ['Line ID', 'Order ID', 'Item ID', 'Item Name', 'Qty', 'Unit Price', 'Line Total']
-
-        ensure_headers(service, spreadsheet_id, 'Customers', customer_headers)
-        ensure_headers(service, spreadsheet_id, 'Inventory', inventory_headers)
-        ensure_headers(service, spreadsheet_id, 'Orders', order_headers)
-        ensure_headers(service, spreadsheet_id, 'OrderLines', line_headers)
-        if customers:
-            values = [[c['customer_id'], c['shop_name'], c['address'], c['phone'], c['city_ref'], c['discount_rate'], c.get('secondary_discount_rate', 0), c.get('outstanding_balance', 0), c.get('credit_period', 90), c['status'], c['updated_at']] for c in customers]
-            if mode == 'overwrite':
-                # Force update Row 1
-                service.spreadsheets().values().update(spreadsheetId=spreadsheet_id, range="'Customers'!A1", valueInputOption="RAW", body={"values": [customer_headers]}).execute()
-                # Clear all and append
-                service.spreadsheets().values().clear(spreadsheetId=spreadsheet_id, range="'Customers'!A2:Z").execute()
-                if values:
-                    service.spreadsheets().values().append(spreadsheetId=spreadsheet_id, range="'Customers'!A2", valueInputOption="USER_ENTERED", body={"values": values}).execute()
-            else: 
-                upsert_rows(service, spreadsheet_id, 'Customers', customer_headers, values, 0)
-        else:
-            # Even if no customers, ensure headers are correct
-            upsert_rows(service, spreadsheet_id, 'Customers', customer_headers, [], 0)
-
-        if items:
-            values = [[i['item_id'], i['item_display_name'], i['item_name'], i['item_number'], i['vehicle_model'], i['source_brand'], i.get('category', 'Uncategorized'), i['unit_value'], i['current_stock_qty'], i.get('low_stock_threshold', 10), i.get('is_out_of_stock', False), i['status'], i['updated_at']] for i in items]
-            if mode == 'overwrite':
-                service.spreadsheets().values().update(spreadsheetId=spreadsheet_id, range="'Inventory'!A1", valueInputOption="RAW", body={"values": [inventory_headers]}).execute()
-                service.spreadsheets().values().clear(spreadsheetId=spreadsheet_id, range="'Inventory'!A2:Z").execute()
-                service.spreadsheets().values().append(spreadsheetId=spreadsheet_id, range="'Inventory'!A2", valueInputOption="USER_ENTERED", body={"values": values}).execute()
-            else: upsert_rows(service, spreadsheet_id, 'Inventory', inventory_headers, values, 0)
-        else:
-            upsert_rows(service, spreadsheet_id, 'Inventory', inventory_headers, [], 0)
-
-        if orders:
-            order_values = [[o['order_id'], o['customer_id'], o.get('rep_id', ''), o['order_date'], o.get('gross_total', 0), o.get('discount_rate', 0), o.get('discount_value', 0), o.get('secondary_discount_rate', 0), o.get('secondary_discount_value', 0), o['net_total'], o.get('paid_amount', 0), o.get('balance_due', 0), o.get('payment_status', 'unpaid'), o.get('delivery_status', 'pending'), o.get('credit_period', 90), o['order_status'], o['updated_at']] for o in orders]
-            if mode == 'overwrite':
-                service.spreadsheets().values().update(spreadsheetId=spreadsheet_id, range="'Orders'!A1", valueInputOption="RAW", body={"values": [order_headers]}).execute()
-                service.spreadsheets().values().clear(spreadsheetId=spreadsheet_id, range="'Orders'!A2:Z").execute()
-                service.spreadsheets().values().append(spreadsheetId=spreadsheet_id, range="'Orders'!A2", valueInputOption="USER_ENTERED", body={"values": order_values}).execute()
-            else:
-                upsert_rows(service, spreadsheet_id, 'Orders', order_headers, order_values, 0)
-            
-            line_values = []
-            for o in orders:
-                for l in o.get('lines', []): line_values.append([l['line_id'], o['order_id'], l['item_id'], l['item_name'], l['quantity'], l['unit_value'], l['line_total']])
-            if line_values: upsert_rows(service, spreadsheet_id, 'OrderLines', line_headers, line_values, 0)
+        older_than_days = int(data.get('olderThanDays', DEFAULT_ARCHIVE_AFTER_DAYS))
+        if older_than_days < 0: raise ValueError("olderThanDays must not be negative")
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    try:
+        with pull_cache.writing(spreadsheet_id, 'orders'):
+            result = archive_closed_orders(open_backend(spreadsheet_id), spreadsheet_id, older_than_days, bool(data.get('dryRun')))
+        return jsonify({"success": True, **result})
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/snapshots', methods=['GET'])
+def snapshots():
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    try:
+        body, status = run_snapshots(request.args)
+        return jsonify(body), status
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/snapshots/diff', methods=['GET'])
+def snapshot_diff():
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    try:
+        body, status = run_snapshot_diff(request.args)
+        return jsonify(body), status
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/snapshots/<int:snapshot_id>/csv', methods=['GET'])
+def snapshot_download(snapshot_id):
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    try:
+        body, status = run_snapshot_csv(snapshot_id, request.args)
+        if status != 200: return jsonify(body), status
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"success": False, "message": str(e)}), 500
+    response = app.response_class(stream_with_context(body), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename="{snapshot_filename(snapshot_id, request.args)}"'
+    return response
+
+@app.route('/orders/<order_id>', methods=['GET'])
+def get_order(order_id):
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    spreadsheet_id = request.args.get('spreadsheetId')
+    if not spreadsheet_id: return jsonify({"success": False, "message": "Spreadsheet ID is required"}), 400
+    try:
+        backend = open_backend(spreadsheet_id)
+        partition = lookup_partition(spreadsheet_id, order_id)
+        if partition:
+            order_rows, line_rows = read_archived_order_rows(backend, spreadsheet_id, order_id, partition)
         else:
-            upsert_rows(service, spreadsheet_id, 'Orders', order_headers, [], 0)
-        # --- PULL ALL DATA ---
-        
-        # 1. Pull Inventory
-        result = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range="'Inventory'!A:Z").execute()
-        pulled_items = []
-        rows = result.get('values', [])
-        if len(rows) > 1:
-            for row in rows[1:]:
-                if not row or not row[0]: continue
-                while len(row) < 13: row.append('')
-                try: unit_val = float(row[7]) if row[7] else 0
-                except: unit_val = 0
-                pulled_items.append({
-                    "item_id": str(row[0]), "item_display_name": str(row[1]), "item_name": str(row[2] or row[1]),
-                    "item_number": str(row[3]), "vehicle_model": str(row[4]), "source_brand": str(row[5] or 'Unknown'),
-                    "category": str(row[6] or 'Uncategorized'), "unit_value": unit_val, "current_stock_qty": int(row[8]) if row[8] else 0,
-                    "low_stock_threshold": int(row[9]) if row[9] else 10, "is_out_of_stock": str(row[10]).lower() == 'true',
-                    "status": str(row[11] or 'active'), "updated_at": str(row[12] or ''), "sync_status": 'synced'
-                })
-
-        # 2. Pull Customers
-        result = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range="'Customers'!A:Z").execute()
-        pulled_customers = []
-        rows = result.get('values', [])
-        if len(rows) > 1:
-            for row in rows[1:]:
-                if not row or not row[0]: continue
-                while len(row) < 11: row.append('')
-                try: disc1 = float(row[5]) if row[5] else 0
-                except: disc1 = 0
-                try: disc2 = float(row[6]) if row[6] else 0
-                except: disc2 = 0
-                try: bal = float(row[7]) if row[7] else 0
-                except: bal = 0
-                try: cpd = int(row[8]) if row[8] else 90
-                except: cpd = 90
-                pulled_customers.append({
-                    "customer_id": str(row[0]), "shop_name": str(row[1]), "address": str(row[2]),
-                    "phone": str(row[3]), "city_ref": str(row[4]), 
-                    "discount_rate": disc1, "secondary_discount_rate": disc2,
-                    "outstanding_balance": bal, "credit_period": cpd, "status": str(row[9] or 'active'),
-                    "updated_at": str(row[10] or ''), "sync_status": 'synced'
-                })
-
-        # 3. Pull Orders & Lines
-        result_orders = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range="'Orders'!A:Z").execute()
-        result_lines = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range="'OrderLines'!A:Z").execute()
-        
-        pulled_orders = []
-        order_rows = result_orders.get('values', [])
-        line_rows = result_lines.get('values', [])
-        
-        # Map lines to orders
-        lines_by_order = {}
-        if len(line_rows) > 1:
-            for row in line_rows[1:]:
-                if len(row) < 7: continue
-                oid = str(row[1])
-                line = {
-                    "line_id": str(row[0]), "order_id": oid, "item_id": str(row[2]),
-                    "item_name": str(row[3]), "quantity": int(row[4]) if row[4] else 0,
-                    "unit_value": float(row[5]) if row[5] else 0, "line_total": float(row[6]) if row[6] else 0
-                }
-                if oid not in lines_by_order: lines_by_order[oid] = []
-                lines_by_order[oid].append(line)
-
-        if len(order_rows) > 1:
-            for row in order_rows[1:]:
-                if not row or not row[0]: continue
-                while len(row) < 17: row.append('')
-                oid = str(row[0])
-                pulled_orders.append({
-                    "order_id": oid, "customer_id": str(row[1]), "rep_id": str(row[2]),
-                    "order_date": str(row[3]), 
-                    "gross_total": float(row[4]) if row[4] else 0,
-                    "discount_rate": float(row[5]) if row[5] else 0,
-                    "discount_value": float(row[6]) if row[6] else 0,
-                    "secondary_discount_rate": float(row[7]) if row[7] else 0,
-                    "secondary_discount_value": float(row[8]) if row[8] else 0,
-                    "net_total": float(row[9]) if row[9] else 0,
-                    "paid_amount": float(row[10]) if row[10] else 0, 
-                    "balance_due": float(row[11]) if row[11] else 0,
-                    "payment_status": str(row[12] or 'unpaid'), 
-                    "delivery_status": str(row[13] or 'pending'),
-                    "credit_period": int(row[14]) if row[14] else 90,
-                    "order_status": str(row[15] or 'confirmed'), 
-                    "updated_at": str(row[16] or ''),
-                    "lines": lines_by_order.get(oid, []), "sync_status": 'synced'
-                })
-
-        return jsonify({
-            "success": True, 
-            "pulledItems": pulled_items,
-            "pulledCustomers": pulled_customers,
-            "pulledOrders": pulled_orders,
-            "debug": {
-                "customer_header_len": len(customer_headers),
-                "order_header_len": len(order_headers)
-            },
-            "message": f"Sync completed successfully ({mode} mode)"
-        })
+            order_rows, line_rows = backend.read_ranges(spreadsheet_id, ['Orders', 'OrderLines'])
+            order_rows = [ORDER_HEADERS] + [r for r in order_rows[1:] if r and str(r[0]) == order_id]
+            line_rows = [LINE_HEADERS] + [r for r in line_rows[1:] if len(r) > 1 and str(r[1]) == order_id]
+
+        found = parse_order_rows(order_rows, line_rows)
+        if not found: return jsonify({"success": False, "message": "Order not found"}), 404
+        return jsonify({"success": True, "order": found[0], "archived": partition is not None, "partition": partition})
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/stock', methods=['GET'])
+def stock():
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    spreadsheet_id = request.args.get('spreadsheetId')
+    if not spreadsheet_id: return jsonify({"success": False, "message": "Spreadsheet ID is required"}), 400
+    item_ids = [i for i in request.args.get('itemIds', '').split(',') if i]
+    if not item_ids: return jsonify({"success": False, "message": "itemIds is required"}), 400
+    try:
+        return jsonify({"success": True, "stock": stock_ledger.stock_levels(spreadsheet_id, item_ids)})
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"success": False, "message": str(e)}), 500
+
+@app.route('/stock/<action>', methods=['POST'])
+def stock_action(action):
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    if action not in STOCK_ACTIONS: return jsonify({"success": False, "message": "Not found"}), 404
+    try:
+        body, status = run_stock_action(action, request.json or {})
+        return jsonify(body), status
     except Exception as e:
         traceback.print_exc()
         return jsonify({"success": False, "message": str(e)}), 500
 
+@app.route('/debug/profiles', methods=['GET'])
+def debug_profiles():
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    return jsonify({"success": True, "sampleRate": profile_sample_rate(), "profiles": list_profiles()})
+
+@app.route('/debug/profiles/<profile_id>', methods=['GET'])
+def debug_profile(profile_id):
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    meta = load_profile(profile_id)
+    if not meta: return jsonify({"success": False, "message": "Profile not found"}), 404
+    return jsonify({"success": True, "profile": meta})
+
+@app.route('/debug/profiles/artifacts/<name>', methods=['GET'])
+def debug_profile_artifact(name):
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    path = profile_artifact_path(name)
+    if not path: return jsonify({"success": False, "message": "Artifact not found"}), 404
+    return send_file(path, mimetype='application/gzip', as_attachment=True, download_name=os.path.basename(path))
+
+@app.route('/sync', methods=['POST'])
+def sync():
+    if not check_auth(): return jsonify({"success": False, "message": "Unauthorized"}), 401
+    if (request.content_length or 0) > MAX_SYNC_BODY_BYTES:
+        return jsonify({"success": False, "message": f"Request body exceeds {MAX_SYNC_BODY_BYTES / (1024 * 1024):.1f} MB"}), 413
+    # Customers and items are encoded to sheet rows while the body is read
+    try:
+        with span('sync.read_body'):
+            data, rows, body_hash = read_sync_body(request.stream, SYNC_BODY_ENCODERS)
+    except SyncBodyError as e:
+        return jsonify({"success": False, "message": str(e)}), e.status
+
+    # Zero-cost unless asked for (header/body flag) or sampled
+    requested = request.headers.get('X-Partflow-Profile') == '1' or bool(data.get('profile'))
+    if not should_profile(requested):
+        return run_sync(data, rows, body_hash)
+
+    profile = SyncProfile(data.get('spreadsheetId'), 'requested' if requested else 'sampled')
+    profile.start()
+    response = None
+    try:
+        response = make_response(run_sync(data, rows, body_hash, profile))
+        return response
+    finally:
+        duration = profile.stop()
+        try:
+            profile.save(duration, response.status_code if response is not None else 500)
+            if response is not None: response.headers['X-Partflow-Profile-Id'] = profile.id
+        except Exception:
+            traceback.print_exc()
+
+def run_sync(data, rows, body_hash=None, profile=None):
+    # The pipeline is shared with the ASGI app (sync_pipeline.py); this is its Flask I/O
+    columnar = wants_columnar(request.accept_mimetypes)
+    body, status, headers = run_steps(sync_steps(data, rows, request.headers.get('Idempotency-Key'), body_hash, columnar, profile))
+    if status != 200: return jsonify(body), status, headers
+    mimetype = COLUMNAR_MIME if columnar else JSON_MIME
+    if profile is not None:
+        # Profiled runs encode up front so the profiler sees the whole request
+        with span('sync.serialize'):
+            response = app.response_class(b''.join(chunked(body)), mimetype=mimetype, headers=headers)
+    else:
+        response = app.response_class(stream_with_context(chunked(body)), mimetype=mimetype, headers=headers)
+    response.vary.add('Accept')
+    return response
+
 if __name__ == '__main__':
     app.run(port=5000, debug=True)
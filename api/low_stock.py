@@ -0,0 +1,188 @@
+import json
+import base64
+
+from database import get_db_connection, to_int
+
+# Server-side low-stock index, kept in SQLite next to the users table.
+# Rows are ordered by deficit (threshold - stock) through a B-tree index, so
+# each inventory upsert is a primary-key lookup plus one indexed write.
+# Every change is appended to low_stock_changes; its seq is the feed cursor.
+
+# Oldest feed entries beyond this are pruned per spreadsheet
+FEED_RETENTION = 5000
+
+def _to_bool(value):
+    if isinstance(value, str): return value.strip().lower() == 'true'
+    return bool(value)
+
+def low_stock_entry(item):
+    """Returns the index row for an item, or None if it is not low on stock"""
+    if str(item.get('status') or 'active') != 'active':
+        return None
+    stock = to_int(item.get('current_stock_qty'))
+    threshold = to_int(item.get('low_stock_threshold'), 10)
+    out_of_stock = _to_bool(item.get('is_out_of_stock'))
+    if stock > threshold and not out_of_stock:
+        return None
+    return {
+        "item_id": str(item['item_id']),
+        "deficit": float(threshold - stock),
+        "item_display_name": str(item.get('item_display_name') or ''),
+        "item_number": str(item.get('item_number') or ''),
+        "current_stock_qty": stock,
+        "low_stock_threshold": threshold,
+        "is_out_of_stock": 1 if out_of_stock else 0,
+        "updated_at": str(item.get('updated_at') or '')
+    }
+
+def _record_change(conn, spreadsheet_id, event, entry, item_id):
+    conn.execute(
+        'INSERT INTO low_stock_changes (spreadsheet_id, item_id, event, deficit, current_stock_qty, low_stock_threshold) VALUES (?, ?, ?, ?, ?, ?)',
+        (spreadsheet_id, item_id, event,
+         entry['deficit'] if entry else None,
+         entry['current_stock_qty'] if entry else None,
+         entry['low_stock_threshold'] if entry else None))
+
+def _apply(conn, spreadsheet_id, items, seen=None):
+    changed = 0
+    for item in items:
+        if not item or not item.get('item_id'): continue
+        item_id = str(item['item_id'])
+        if seen is not None: seen.add(item_id)
+        entry = low_stock_entry(item)
+        existing = conn.execute(
+            'SELECT deficit, current_stock_qty, low_stock_threshold, is_out_of_stock FROM low_stock_index WHERE spreadsheet_id = ? AND item_id = ?',
+            (spreadsheet_id, item_id)).fetchone()
+
+        if entry is None:
+            if existing:
+                conn.execute('DELETE FROM low_stock_index WHERE spreadsheet_id = ? AND item_id = ?', (spreadsheet_id, item_id))
+                _record_change(conn, spreadsheet_id, 'cleared', None, item_id)
+                changed += 1
+            continue
+
+        if existing and (existing['deficit'], existing['current_stock_qty'], existing['low_stock_threshold'], existing['is_out_of_stock']) == \
+                (entry['deficit'], entry['current_stock_qty'], entry['low_stock_threshold'], entry['is_out_of_stock']):
+            continue
+
+        conn.execute('''
+            INSERT OR REPLACE INTO low_stock_index
+                (spreadsheet_id, item_id, deficit, item_display_name, item_number, current_stock_qty, low_stock_threshold, is_out_of_stock, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (spreadsheet_id, item_id, entry['deficit'], entry['item_display_name'], entry['item_number'],
+              entry['current_stock_qty'], entry['low_stock_threshold'], entry['is_out_of_stock'], entry['updated_at']))
+        _record_change(conn, spreadsheet_id, 'updated' if existing else 'entered', entry, item_id)
+        changed += 1
+    return changed
+
+def _prune_feed(conn, spreadsheet_id):
+    conn.execute('''
+        DELETE FROM low_stock_changes WHERE spreadsheet_id = ? AND seq <= (
+            SELECT seq FROM low_stock_changes WHERE spreadsheet_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?
+        )
+    ''', (spreadsheet_id, spreadsheet_id, FEED_RETENTION))
+
+def apply_inventory_upserts(spreadsheet_id, items):
+    """Updates the index for pushed items only. Returns the number of index changes."""
+    if not items: return 0
+    conn = get_db_connection()
+    try:
+        changed = _apply(conn, spreadsheet_id, items)
+        if changed: _prune_feed(conn, spreadsheet_id)
+        conn.commit()
+        return changed
+    finally:
+        conn.close()
+
+def is_seeded(spreadsheet_id):
+    conn = get_db_connection()
+    try:
+        return conn.execute('SELECT 1 FROM low_stock_seeded WHERE spreadsheet_id = ?', (spreadsheet_id,)).fetchone() is not None
+    finally:
+        conn.close()
+
+def reconcile_low_stock(spreadsheet_id, items):
+    """Brings the index in line with a full inventory read (first use, overwrite syncs)"""
+    conn = get_db_connection()
+    try:
+        # One pass, so `items` can be a generator over the raw sheet rows
+        live_ids = set()
+        changed = _apply(conn, spreadsheet_id, items, live_ids)
+        stale = [r['item_id'] for r in conn.execute('SELECT item_id FROM low_stock_index WHERE spreadsheet_id = ?', (spreadsheet_id,))
+                 if r['item_id'] not in live_ids]
+        for item_id in stale:
+            conn.execute('DELETE FROM low_stock_index WHERE spreadsheet_id = ? AND item_id = ?', (spreadsheet_id, item_id))
+            _record_change(conn, spreadsheet_id, 'cleared', None, item_id)
+        changed += len(stale)
+        conn.execute('INSERT OR REPLACE INTO low_stock_seeded (spreadsheet_id) VALUES (?)', (spreadsheet_id,))
+        if changed: _prune_feed(conn, spreadsheet_id)
+        conn.commit()
+        return changed
+    finally:
+        conn.close()
+
+def encode_cursor(deficit, item_id):
+    raw = json.dumps([deficit, item_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        deficit, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return float(deficit), str(item_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def _entry_from_row(row):
+    return {
+        "item_id": row['item_id'], "item_display_name": row['item_display_name'], "item_number": row['item_number'],
+        "current_stock_qty": row['current_stock_qty'], "low_stock_threshold": row['low_stock_threshold'],
+        "deficit": row['deficit'], "is_out_of_stock": bool(row['is_out_of_stock']), "updated_at": row['updated_at']
+    }
+
+def list_low_stock(spreadsheet_id, limit=50, cursor=None):
+    """One page of low-stock items, worst first. Returns (items, next_cursor, total)."""
+    conn = get_db_connection()
+    try:
+        if cursor:
+            deficit, item_id = decode_cursor(cursor)
+            rows = conn.execute('''
+                SELECT * FROM low_stock_index
+                WHERE spreadsheet_id = ? AND (deficit < ? OR (deficit = ? AND item_id > ?))
+                ORDER BY deficit DESC, item_id LIMIT ?
+            ''', (spreadsheet_id, deficit, deficit, item_id, limit + 1)).fetchall()
+        else:
+            rows = conn.execute('SELECT * FROM low_stock_index WHERE spreadsheet_id = ? ORDER BY deficit DESC, item_id LIMIT ?',
+                                (spreadsheet_id, limit + 1)).fetchall()
+        total = conn.execute('SELECT COUNT(*) FROM low_stock_index WHERE spreadsheet_id = ?', (spreadsheet_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+    page = [_entry_from_row(r) for r in rows[:limit]]
+    next_cursor = encode_cursor(page[-1]['deficit'], page[-1]['item_id']) if len(rows) > limit else None
+    return page, next_cursor, total
+
+def low_stock_changes_since(spreadsheet_id, since=0, limit=500):
+    """Feed entries after the given seq. Returns (changes, next_since, reset).
+
+    reset is True when the cursor is older than the retained feed; the caller
+    should re-list the index instead of applying the changes.
+    """
+    conn = get_db_connection()
+    try:
+        oldest = conn.execute('SELECT MIN(seq) FROM low_stock_changes WHERE spreadsheet_id = ?', (spreadsheet_id,)).fetchone()[0]
+        rows = conn.execute('''
+            SELECT seq, item_id, event, deficit, current_stock_qty, low_stock_threshold, changed_at
+            FROM low_stock_changes WHERE spreadsheet_id = ? AND seq > ? ORDER BY seq LIMIT ?
+        ''', (spreadsheet_id, since, limit)).fetchall()
+    finally:
+        conn.close()
+    changes = [dict(r) for r in rows]
+    reset = since > 0 and oldest is not None and since < oldest - 1
+    return changes, (changes[-1]['seq'] if changes else since), reset
+
+def latest_change_seq(spreadsheet_id):
+    conn = get_db_connection()
+    try:
+        return conn.execute('SELECT COALESCE(MAX(seq), 0) FROM low_stock_changes WHERE spreadsheet_id = ?', (spreadsheet_id,)).fetchone()[0]
+    finally:
+        conn.close()
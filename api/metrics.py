@@ -0,0 +1,192 @@
+import time
+import sqlite3
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Lightweight request tracing and Prometheus metrics.
+# span(name) times a block into the current request's trace and into a
+# per-stage histogram. Sheets calls (through traced_service) and SQLite
+# statements (through TracedConnection) record their own spans, so a /sync
+# breaks down into auth, headers, each upsert, each pull and the encoding.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+ROW_BUCKETS = (0, 10, 100, 1000, 5000, 10000, 50000, 100000)
+BYTE_BUCKETS = (256, 1024, 10240, 102400, 1048576, 5242880, 20971520)
+
+_trace = contextvars.ContextVar('partflow_trace', default=None)
+_lock = threading.Lock()
+
+class Histogram:
+    def __init__(self, name, help_text, buckets, label=None):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.label = label
+        self.series = {}
+
+    def observe(self, value, label_value=''):
+        with _lock:
+            entry = self.series.setdefault(label_value, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound: entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            series = {k: ([*v[0]], v[1], v[2]) for k, v in self.series.items()}
+        for label_value, (counts, total, n) in sorted(series.items()):
+            base = f'{self.label}="{_escape(label_value)}",' if self.label else ''
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{base}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{base}le="+Inf"}} {n}')
+            labels = f'{{{base[:-1]}}}' if base else ''
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {n}')
+        return lines
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+STAGE_LATENCY = Histogram('partflow_stage_duration_seconds', 'Time spent per request stage, Sheets call and SQLite statement.', LATENCY_BUCKETS, 'stage')
+REQUEST_LATENCY = Histogram('partflow_request_duration_seconds', 'End-to-end request latency per endpoint.', LATENCY_BUCKETS, 'endpoint')
+SYNC_API_CALLS = Histogram('partflow_sync_sheets_calls', 'Sheets API calls made by one /sync.', COUNT_BUCKETS)
+SYNC_ROWS_READ = Histogram('partflow_sync_rows_read', 'Sheet rows read by one /sync.', ROW_BUCKETS)
+SYNC_ROWS_WRITTEN = Histogram('partflow_sync_rows_written', 'Sheet rows written by one /sync.', ROW_BUCKETS)
+RESPONSE_BYTES = Histogram('partflow_response_bytes', 'Response body size per endpoint.', BYTE_BUCKETS, 'endpoint')
+
+ALL_HISTOGRAMS = (STAGE_LATENCY, REQUEST_LATENCY, SYNC_API_CALLS, SYNC_ROWS_READ, SYNC_ROWS_WRITTEN, RESPONSE_BYTES)
+
+# --- Per-request trace ---
+
+def begin_trace():
+    trace = {"spans": {}, "sheets_calls": 0, "rows_read": 0, "rows_written": 0, "started": time.perf_counter()}
+    _trace.set(trace)
+    return trace
+
+def current_trace():
+    return _trace.get()
+
+def end_trace():
+    trace = _trace.get()
+    _trace.set(None)
+    return trace
+
+def record_span(name, seconds):
+    STAGE_LATENCY.observe(seconds, name)
+    trace = _trace.get()
+    if trace is not None:
+        entry = trace["spans"].setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+def breakdown(trace):
+    """JSON-friendly summary of a trace for the /sync response"""
+    if not trace: return None
+    return {
+        "total_ms": round((time.perf_counter() - trace["started"]) * 1000, 2),
+        "sheets_calls": trace["sheets_calls"],
+        "rows_read": trace["rows_read"],
+        "rows_written": trace["rows_written"],
+        "spans": {name: {"count": n, "ms": round(total * 1000, 2)} for name, (n, total) in sorted(trace["spans"].items())}
+    }
+
+# --- Sheets instrumentation ---
+
+def _rows_in_result(result):
+    if not isinstance(result, dict): return 0
+    if 'valueRanges' in result:
+        return sum(len(vr.get('values', [])) for vr in result['valueRanges'])
+    return len(result.get('values', []))
+
+def _rows_in_body(body):
+    body = body or {}
+    if 'values' in body: return len(body['values'])
+    if 'data' in body: return sum(len(d.get('values', [])) for d in body['data'])
+    return 0
+
+def record_sheets_call(name, seconds, result=None, body=None):
+    """Books one Sheets call into its span and the current trace; result is
+    None when the call failed. Shared by traced_service and the async client."""
+    record_span(f"sheets.{name}", seconds)
+    trace = _trace.get()
+    if trace is None: return
+    trace["sheets_calls"] += 1
+    if result is None: return
+    if name in ('values.get', 'values.batchGet'):
+        trace["rows_read"] += _rows_in_result(result)
+    else:
+        trace["rows_written"] += _rows_in_body(body)
+
+class _TracedRequest:
+    def __init__(self, request, name, kwargs):
+        self._request = request
+        self._name = name
+        self._kwargs = kwargs
+
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = None
+        try:
+            result = self._request.execute(*args, **kwargs)
+            return result
+        finally:
+            record_sheets_call(self._name, time.perf_counter() - start, result, self._kwargs.get('body'))
+
+    def __getattr__(self, name):
+        return getattr(self._request, name)
+
+class _TracedResource:
+    def __init__(self, resource, path):
+        self._resource = resource
+        self._path = path
+
+    def __getattr__(self, name):
+        attr = getattr(self._resource, name)
+        if not callable(attr): return attr
+        path = f"{self._path}.{name}" if self._path else name
+
+        def call(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if hasattr(result, 'execute'):
+                return _TracedRequest(result, path.replace('spreadsheets.values.', 'values.'), kwargs)
+            return _TracedResource(result, path)
+        return call
+
+def traced_service(service):
+    """Wraps a Sheets service so every .execute() becomes a span"""
+    return _TracedResource(service, '')
+
+# --- SQLite instrumentation ---
+
+class TracedConnection(sqlite3.Connection):
+    def execute(self, sql, *args):
+        with span('sqlite.query'):
+            return super().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        with span('sqlite.query'):
+            return super().executemany(sql, *args)
+
+    def commit(self):
+        with span('sqlite.commit'):
+            return super().commit()
+
+# --- Exposition ---
+
+def render_prometheus():
+    lines = []
+    for hist in ALL_HISTOGRAMS:
+        lines.extend(hist.render())
+    return '\n'.join(lines) + '\n'
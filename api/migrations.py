@@ -0,0 +1,61 @@
+from schema import CUSTOMER_HEADERS, INVENTORY_HEADERS, ORDER_HEADERS, LINE_HEADERS, ADJUSTMENT_HEADERS, PAYMENT_HEADERS
+
+# Schema version of each sync tab, stored with the tab (spreadsheet developer
+# metadata under SCHEMA_VERSION_KEY on Sheets, a table on SQLite), so a sync
+# checks one number per tab instead of reading and comparing header rows.
+# A tab behind the current version is migrated once, by the first sync that
+# sees it: the registered steps after its version rewrite it in order and the
+# new version is stamped last. Tabs a sync creates start at the current one.
+#
+# Adding a column means registering the tab's next version, e.g.
+#
+#     register('Customers', 2, by_name(CUSTOMER_HEADERS))
+#
+# after adding it to the headers in schema.py.
+
+SCHEMA_VERSION_KEY = 'partflow.schemaVersion'
+TAB_HEADERS = {'Customers': CUSTOMER_HEADERS, 'Inventory': INVENTORY_HEADERS, 'Orders': ORDER_HEADERS, 'OrderLines': LINE_HEADERS,
+               'StockAdjustments': ADJUSTMENT_HEADERS, 'Payments': PAYMENT_HEADERS}
+
+_steps = {tab: {} for tab in TAB_HEADERS}
+
+def register(tab, version, step):
+    """step(rows) -> rows: the tab's contents (header row included) at `version`"""
+    _steps[tab][version] = step
+
+def current_version(tab):
+    return max(_steps[tab], default=0)
+
+def _name(header):
+    return str(header).strip().lower()
+
+def by_name(headers):
+    """A step that lays a tab out as `headers`, moving each column by its header
+    name. Columns new to the tab start empty; ones no longer listed are dropped."""
+    def step(rows):
+        if not rows or not rows[0]: return [list(headers)]
+        old = {}
+        for i, h in enumerate(rows[0]):
+            if str(h).strip(): old.setdefault(_name(h), i)
+        source = [old.get(_name(h)) for h in headers]
+        if all(i is None for i in source):
+            # Not a header row we know: keep the columns where they are
+            source = list(range(len(headers)))
+        dropped = sorted(set(old) - {_name(h) for h in headers})
+        if dropped: print(f"Schema migration drops columns {dropped}")
+        return [list(headers)] + [[row[i] if i is not None and i < len(row) else '' for i in source] for row in rows[1:]]
+    return step
+
+def migrate_rows(tab, version, rows):
+    """(rows brought from `version` to the current one, current version)"""
+    for v in sorted(v for v in _steps[tab] if v > version):
+        rows = _steps[tab][v](rows)
+    return rows, current_version(tab)
+
+def stale_tabs(versions, tabs):
+    return [t for t in tabs if versions.get(t, 0) < current_version(t)]
+
+# v1: the first versioned layout. Tabs written before versioning (v0) may
+# predate a column (e.g. Credit Period); their columns are matched by name.
+for _tab, _headers in TAB_HEADERS.items():
+    register(_tab, 1, by_name(_headers))
@@ -0,0 +1,110 @@
+import datetime
+
+from database import Counters
+from schema import CUSTOMER_HEADERS, INVENTORY_HEADERS, ORDER_HEADERS
+
+# Field-level patches: a /sync body's `patches` change a few cells of rows
+# the sheet already has, e.g.
+#
+#   {"entity": "order", "id": "o-1", "fields": {"delivery_status": "delivered"},
+#    "base_updated_at": "2026-10-19T08:00:00.000Z"}
+#
+# rather than pushing the whole row. base_updated_at is the Last Updated
+# cell the device's copy was made from: a patch only applies while the row
+# still has it (optimistic concurrency), and moves it on to the patch's
+# updated_at (fields.updated_at, else the time it was received). A patch
+# whose row moved on, or is gone, comes back as a conflict for the device
+# to rebase; one whose row already has its updated_at was written before
+# and is left as it is. Per tab a sync reads just the target rows (through
+# the row index, one batchGet on Sheets) and writes just the patched cells
+# in one batchUpdate. There is no lock between the two: a write landing in
+# between wins over the patch, as with whole-row pushes.
+#
+# Cells owned by the server (stock, customer balances) cannot be patched.
+
+# Patchable fields of each entity: {field: column index in its tab}
+PATCH_TARGETS = {
+    'order': ('Orders', ORDER_HEADERS, {'paid_amount': 10, 'balance_due': 11, 'payment_status': 12, 'delivery_status': 13, 'order_status': 15}),
+    'customer': ('Customers', CUSTOMER_HEADERS, {'shop_name': 1, 'address': 2, 'phone': 3, 'city_ref': 4, 'discount_rate': 5,
+                                                 'secondary_discount_rate': 6, 'credit_period': 8, 'status': 9}),
+    'item': ('Inventory', INVENTORY_HEADERS, {'item_display_name': 1, 'item_name': 2, 'item_number': 3, 'vehicle_model': 4, 'source_brand': 5,
+                                              'category': 6, 'unit_value': 7, 'low_stock_threshold': 9, 'is_out_of_stock': 10, 'status': 11}),
+}
+TAB_WIDTHS = {tab: len(headers) for tab, headers, _ in PATCH_TARGETS.values()}
+
+_counts = Counters("applied", "stale", "missing")
+
+def _now_iso():
+    """As the app's toISOString()"""
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+def patch_record(p):
+    """A /sync patch, checked and resolved to cells: {entity, tab, id, cells, base_updated_at, updated_at}"""
+    if not isinstance(p, dict): raise TypeError(f"expected an object, got {type(p).__name__}")
+    target = PATCH_TARGETS.get(p['entity'])
+    if target is None: raise TypeError(f"unknown entity {p['entity']!r} (one of {', '.join(PATCH_TARGETS)})")
+    tab, _, columns = target
+    fields = p['fields']
+    if not isinstance(fields, dict): raise TypeError("fields must be an object")
+    cells = []
+    for name, value in fields.items():
+        if name == 'updated_at': continue
+        if name not in columns: raise TypeError(f"{p['entity']} field {name!r} cannot be patched")
+        if isinstance(value, (dict, list)): raise TypeError(f"{name} must be a single value")
+        cells.append([columns[name], value])
+    if not cells: raise TypeError("no fields to patch")
+    base = p['base_updated_at']
+    return {"entity": p['entity'], "tab": tab, "id": str(p['id']), "cells": cells,
+            "base_updated_at": '' if base is None else str(base), "updated_at": str(fields.get('updated_at') or _now_iso())}
+
+def by_tab(patches):
+    """{tab: [patches]}, each in the order sent"""
+    groups = {}
+    for p in patches: groups.setdefault(p['tab'], []).append(p)
+    return groups
+
+def _conflict(p, reason, updated_at):
+    return {"entity": p['entity'], "id": p['id'], "reason": reason, "updated_at": updated_at}
+
+def resolve(patches, current, width):
+    """Checks a tab's patches, in order, against the rows they target.
+    current: {id: (row number, row)} of the rows found.
+    Returns (cells to write [(row number, column index, value)], {id: patched row}, conflicts)."""
+    writes, patched, conflicts = {}, {}, []
+    last = width - 1
+    for p in patches:
+        found = current.get(p['id'])
+        if found is None:
+            conflicts.append(_conflict(p, 'missing', None))
+            continue
+        n, row = found
+        row = patched.get(p['id']) or list(row) + [''] * (width - len(row))
+        if str(row[last]) == p['updated_at']:
+            # Written already (a resent or replayed patch)
+            patched[p['id']] = row
+            continue
+        if str(row[last]) != p['base_updated_at']:
+            conflicts.append(_conflict(p, 'stale', str(row[last])))
+            continue
+        for col, value in p['cells'] + [[last, p['updated_at']]]:
+            row[col] = writes[(n, col)] = value
+        patched[p['id']] = row
+    return [(n, col, value) for (n, col), value in writes.items()], patched, conflicts
+
+def tally(patched_rows, conflicts):
+    _counts.add("applied", sum(len(rows) for rows in patched_rows.values()))
+    for c in conflicts: _counts.add(c['reason'])
+
+def overlay_patches(values, patches):
+    """Tab values (header first) with the patches that would apply laid over them"""
+    values = dict(values)
+    for tab, group in by_tab(patches).items():
+        rows = list(values.get(tab) or [])
+        current = {str(row[0]): (i, row) for i, row in enumerate(rows) if i > 0 and row}
+        _, patched, _ = resolve(group, current, TAB_WIDTHS[tab])
+        for key, row in patched.items(): rows[current[key][0]] = row
+        values[tab] = rows
+    return values
+
+def patch_stats():
+    return _counts.snapshot()
@@ -0,0 +1,141 @@
+import os
+import json
+import gzip
+import time
+import uuid
+import marshal
+import pstats
+import random
+import cProfile
+import datetime
+import tempfile
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+# On-demand profiling of /sync.
+# A request runs under cProfile when it asks for it (X-Partflow-Profile: 1 or
+# "profile": true) or is picked by PARTFLOW_PROFILE_SAMPLE_RATE. Each streamed
+# pull section (decode + encode) also gets a tracemalloc snapshot. Each run is stored as
+# gzip artifacts plus a small JSON summary that /debug/profiles lists.
+# When a request is not profiled, nothing here runs beyond one flag check.
+
+PROFILE_DIR = os.environ.get('PARTFLOW_PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'partflow-profiles')
+MAX_PROFILES = int(os.environ.get('PARTFLOW_PROFILE_KEEP', '50'))
+TOP_ALLOCATIONS = 15
+TOP_FUNCTIONS = 25
+
+def sample_rate():
+    try: return max(0.0, min(1.0, float(os.environ.get('PARTFLOW_PROFILE_SAMPLE_RATE', '0'))))
+    except ValueError: return 0.0
+
+def should_profile(requested):
+    if requested: return True
+    rate = sample_rate()
+    return rate > 0 and random.random() < rate
+
+class SyncProfile:
+    def __init__(self, spreadsheet_id, reason):
+        self.id = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S') + '-' + uuid.uuid4().hex[:8]
+        self.spreadsheet_id = spreadsheet_id
+        self.reason = reason
+        self.profiler = cProfile.Profile()
+        self.phases = {}
+        self._snapshots = {}
+        self._started = None
+
+    def start(self):
+        self._started = time.perf_counter()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        return time.perf_counter() - self._started
+
+    @contextmanager
+    def allocations(self, phase):
+        """tracemalloc around one phase; keeps the snapshot at the end of it"""
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing: tracemalloc.start()
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            if not was_tracing: tracemalloc.stop()
+            top = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics('lineno')[:TOP_ALLOCATIONS]
+            self.phases[phase] = {
+                "peak_kb": round((peak - before) / 1024, 1),
+                "retained_kb": round((current - before) / 1024, 1),
+                "top": [{"where": f"{s.traceback[0].filename}:{s.traceback[0].lineno}", "kb": round(s.size / 1024, 1), "count": s.count} for s in top]
+            }
+            self._snapshots[phase] = snapshot
+
+    def save(self, duration, status):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stats = pstats.Stats(self.profiler)
+        with gzip.open(os.path.join(PROFILE_DIR, f"{self.id}.prof.gz"), 'wb') as f:
+            f.write(_marshal_stats(stats))
+        for phase, snapshot in self._snapshots.items():
+            raw = os.path.join(PROFILE_DIR, f"{self.id}.{phase}.tracemalloc")
+            snapshot.dump(raw)
+            with open(raw, 'rb') as src, gzip.open(raw + '.gz', 'wb') as dst:
+                dst.write(src.read())
+            os.remove(raw)
+
+        meta = {
+            "id": self.id, "spreadsheet_id": self.spreadsheet_id, "reason": self.reason, "status": status,
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "duration_ms": round(duration * 1000, 2),
+            "top_functions": _top_functions(stats),
+            "allocations": self.phases,
+            "artifacts": [f"{self.id}.prof.gz"] + [f"{self.id}.{p}.tracemalloc.gz" for p in self._snapshots]
+        }
+        with open(os.path.join(PROFILE_DIR, f"{self.id}.json"), 'w') as f:
+            json.dump(meta, f)
+        _prune()
+        return meta
+
+def _marshal_stats(stats):
+    # Same bytes pstats.Stats.dump_stats() writes, loadable with pstats/snakeviz
+    return marshal.dumps(stats.stats)
+
+def _top_functions(stats):
+    rows = sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)[:TOP_FUNCTIONS]
+    return [{"function": f"{fn[0]}:{fn[1]}({fn[2]})", "calls": v[1], "tottime_ms": round(v[2] * 1000, 2), "cumtime_ms": round(v[3] * 1000, 2)}
+            for fn, v in rows]
+
+def _prune():
+    metas = sorted(f for f in os.listdir(PROFILE_DIR) if f.endswith('.json'))
+    for stale in metas[:-MAX_PROFILES] if MAX_PROFILES > 0 else []:
+        profile_id = stale[:-5]
+        for name in os.listdir(PROFILE_DIR):
+            if name.startswith(profile_id + '.'):
+                os.remove(os.path.join(PROFILE_DIR, name))
+
+def allocation_phase(profile, phase):
+    return profile.allocations(phase) if profile is not None else nullcontext()
+
+def list_profiles():
+    if not os.path.isdir(PROFILE_DIR): return []
+    out = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if not name.endswith('.json'): continue
+        with open(os.path.join(PROFILE_DIR, name)) as f:
+            meta = json.load(f)
+        out.append({k: meta[k] for k in ('id', 'spreadsheet_id', 'reason', 'status', 'created_at', 'duration_ms', 'artifacts')})
+    return out
+
+def load_profile(profile_id):
+    path = os.path.join(PROFILE_DIR, f"{os.path.basename(profile_id)}.json")
+    if not os.path.exists(path): return None
+    with open(path) as f:
+        return json.load(f)
+
+def artifact_path(name):
+    """Absolute path of an artifact, or None if it does not exist"""
+    name = os.path.basename(name)
+    if not name.endswith('.gz'): return None
+    path = os.path.join(PROFILE_DIR, name)
+    return path if os.path.exists(path) else None
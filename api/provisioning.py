@@ -0,0 +1,133 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash
+
+from database import get_db_connection, Counters, in_chunks
+
+# Bulk user provisioning (/users/bulk): onboarding a distributor's reps in
+# one request. Hashing is what costs (werkzeug's password hashes are slow
+# on purpose), so the passwords are hashed in a process pool of
+# PARTFLOW_HASH_PROCESSES workers (default: one per CPU), started with
+# 'spawn' so no server thread state is forked, and kept for later batches.
+# Hosts that cannot start processes (some serverless runtimes), or
+# PARTFLOW_HASH_PROCESSES=0, hash in-process instead.
+#
+# Usernames already taken are found before hashing, so they cost nothing,
+# then every new user is inserted with one executemany in a single write
+# transaction, which checks the names again against a /register that landed
+# in between. Each user gets its own result: created, exists (registered
+# already or earlier in the batch) or invalid; one bad entry does not stop
+# the others.
+#
+# /users/bulk itself is admin-only: the API key is handed to every rep at
+# login, so the request also carries an admin's username and password
+# (index.run_bulk_users). Accounts made here get the same password hash as
+# /register, so hashing sets the pace: about 0.12 s per password per CPU
+# (werkzeug's scrypt), i.e. roughly a minute for 500 users on one core and
+# a few seconds only with many cores. The hash is not weakened to go faster.
+
+HASH_PROCESSES = int(os.environ.get('PARTFLOW_HASH_PROCESSES', str(os.cpu_count() or 1)))
+MAX_BULK_USERS = int(os.environ.get('PARTFLOW_MAX_BULK_USERS', '1000'))
+ROLES = ('rep', 'admin')
+
+_pool = None
+_pool_failed = False
+_pool_lock = threading.Lock()
+
+_counts = Counters("batches", "created", "exists", "invalid", "in_process_hashes")
+
+def _hash_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(HASH_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def hash_passwords(passwords):
+    """Password hashes, in order"""
+    global _pool, _pool_failed
+    if len(passwords) > 1 and HASH_PROCESSES > 0 and not _pool_failed:
+        try:
+            chunk = max(1, len(passwords) // (HASH_PROCESSES * 4))
+            return list(_hash_pool().map(generate_password_hash, passwords, chunksize=chunk))
+        except BrokenProcessPool:
+            # A worker died: the next batch starts a new pool
+            with _pool_lock: _pool = None
+            raise
+        except (OSError, NotImplementedError) as e:
+            print(f"Password hashing pool unavailable ({e}); hashing in-process")
+            _pool_failed = True
+    _counts.add("in_process_hashes", len(passwords))
+    return [generate_password_hash(p) for p in passwords]
+
+def _user_fields(entry):
+    """(username, password, full_name, role), or None and what is wrong"""
+    if not isinstance(entry, dict): return None, "expected an object"
+    username, password = entry.get('username'), entry.get('password')
+    full_name, role = entry.get('full_name'), entry.get('role') or 'rep'
+    if not isinstance(username, str) or not username.strip(): return None, "Username required"
+    if not isinstance(password, str) or not password: return None, "Password required"
+    if full_name is not None and not isinstance(full_name, str): return None, "full_name must be a string"
+    if role not in ROLES: return None, f"role must be one of {', '.join(ROLES)}"
+    return (username, password, full_name, role), None
+
+def _taken(conn, usernames):
+    taken = set()
+    for chunk, placeholders in in_chunks(usernames):
+        taken.update(r[0] for r in conn.execute(f"SELECT username FROM users WHERE username IN ({placeholders})", chunk))
+    return taken
+
+def provision_users(entries):
+    """Creates the users in entries ({username, password, full_name?, role?});
+    one result per entry, in order: {username, status, id | message}"""
+    results, new, listed = [], {}, set()
+    for i, entry in enumerate(entries):
+        user, problem = _user_fields(entry)
+        username = entry.get('username') if isinstance(entry, dict) else None
+        if problem:
+            results.append({"username": username, "status": "invalid", "message": problem})
+        elif username in listed:
+            results.append({"username": username, "status": "exists", "message": "Listed earlier in this batch"})
+        else:
+            results.append({"username": username, "status": "created"})
+            new[i] = user
+            listed.add(username)
+
+    conn = get_db_connection()
+    try:
+        taken = _taken(conn, [u[0] for u in new.values()])
+    finally:
+        conn.close()
+    to_create = [(i, user) for i, user in new.items() if user[0] not in taken]
+    hashes = hash_passwords([user[1] for _, user in to_create])
+
+    ids = {}
+    if to_create:
+        conn = get_db_connection()
+        try:
+            # Write lock first: the second check and the insert see the same table
+            conn.execute('BEGIN IMMEDIATE')
+            taken |= _taken(conn, [user[0] for _, user in to_create])
+            rows = [(user[0], h, user[2], user[3]) for (_, user), h in zip(to_create, hashes) if user[0] not in taken]
+            conn.executemany('INSERT INTO users (username, password_hash, full_name, role) VALUES (?, ?, ?, ?)', rows)
+            names = [r[0] for r in rows]
+            for chunk, placeholders in in_chunks(names):
+                ids.update((r['username'], r['id']) for r in conn.execute(
+                    f"SELECT username, id FROM users WHERE username IN ({placeholders})", chunk))
+            conn.commit()
+        finally:
+            conn.close()
+
+    for i, user in new.items():
+        if user[0] in taken: results[i] = {"username": user[0], "status": "exists", "message": "Username already exists"}
+        else: results[i]["id"] = ids[user[0]]
+    _counts.add("batches")
+    for r in results: _counts.add(r["status"])
+    return results
+
+def provisioning_stats():
+    return {"hash_processes": HASH_PROCESSES if not _pool_failed else 0, **_counts.snapshot()}
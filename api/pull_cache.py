@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import threading
+import contextlib
+import collections
+
+# LRU cache of encoded /sync pull segments ("pulledItems":[...] and friends).
+# Keyed by spreadsheet, entity, wire format, the entity's generation and the
+# row counts of its tabs. Every write through this server to an entity's tabs
+# runs inside writing(), which moves the generation on before and after it;
+# a pull takes the generations before it reads the tabs, so a read that
+# overlapped a write is never cached as current. Edits made directly in the
+# sheet bump nothing: an entry keeps a digest of the values it was built from
+# and a hit re-checks it once PARTFLOW_PULL_CACHE_VERIFY_SECONDS (default 60,
+# 0 checks every hit) have passed since the last check, so the full-tab
+# digest runs once per entry per interval instead of on every sync. A hit
+# skips decoding and encoding the entity; the response is assembled from the
+# cached bytes. Bounded by
+# PARTFLOW_PULL_CACHE_MB (0 disables); PARTFLOW_PULL_CACHE_COMPRESS=1 stores
+# segments zlib-compressed to fit more spreadsheets in the same budget.
+#
+# Separately, the raw values of the last good pull of each spreadsheet are
+# kept (PARTFLOW_STALE_SNAPSHOTS most recent spreadsheets) so /sync can still
+# answer from them while the Sheets circuit breaker is open.
+
+MAX_CACHE_BYTES = int(float(os.environ.get('PARTFLOW_PULL_CACHE_MB', '64')) * 1024 * 1024)
+COMPRESS = os.environ.get('PARTFLOW_PULL_CACHE_COMPRESS', '0') == '1'
+MAX_SNAPSHOTS = int(os.environ.get('PARTFLOW_STALE_SNAPSHOTS', '8'))
+VERIFY_SECONDS = float(os.environ.get('PARTFLOW_PULL_CACHE_VERIFY_SECONDS', '60'))
+
+# Sheet tabs each pulled entity is decoded from
+ENTITY_TABS = {'inventory': ('Inventory',), 'customers': ('Customers',), 'orders': ('Orders', 'OrderLines')}
+
+def entities_of(tabs):
+    """The pulled entities decoded from any of the tabs"""
+    return [entity for entity, entity_tabs in ENTITY_TABS.items() if set(entity_tabs).intersection(tabs)]
+
+def content_digest(tab_values):
+    h = hashlib.blake2b(digest_size=16)
+    for rows in tab_values:
+        h.update(json.dumps(rows).encode('utf-8'))
+        h.update(b'\x00')
+    return h.hexdigest()
+
+class PullCache:
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, compress=COMPRESS, max_snapshots=MAX_SNAPSHOTS, verify_seconds=VERIFY_SECONDS):
+        self.max_bytes = max_bytes
+        self.verify_seconds = verify_seconds
+        # One segment may take at most a quarter of the budget
+        self.max_entry_bytes = max_bytes // 4
+        self.compress = compress
+        self._entries = collections.OrderedDict()
+        self._generations = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.max_snapshots = max_snapshots
+        self._snapshots = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.sheet_edits = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def generations(self, spreadsheet_id):
+        """{entity: generation}, taken before reading the tabs a pull is built from"""
+        with self._lock:
+            return {entity: self._generations.get((spreadsheet_id, entity), 0) for entity in ENTITY_TABS}
+
+    def key(self, spreadsheet_id, entity, wire_format, tab_values, generation=None):
+        """No pass over the cells: the generation (now, unless given) and the tabs' row counts"""
+        if generation is None:
+            with self._lock: generation = self._generations.get((spreadsheet_id, entity), 0)
+        return (spreadsheet_id, entity, wire_format, generation, tuple(len(rows) for rows in tab_values))
+
+    def get(self, key, tab_values):
+        """(segment bytes, extra) or None. tab_values: the values the key was
+        made from, digested when the entry is due for a check"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+        data, compressed, extra, digest, checked_at = entry
+        now = time.monotonic()
+        if now - checked_at >= self.verify_seconds:
+            edited = content_digest(tab_values) != digest
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    if edited: self._bytes -= len(self._entries.pop(key)[0])
+                    else: self._entries[key] = (data, compressed, extra, digest, now)
+                if edited:
+                    self.sheet_edits += 1
+                    self.misses += 1
+                    return None
+        with self._lock:
+            if key in self._entries: self._entries.move_to_end(key)
+            self.hits += 1
+        return (zlib.decompress(data) if compressed else data), extra
+
+    def put(self, key, segment, extra=None, tab_values=()):
+        """tab_values: the values the segment was encoded from"""
+        data = zlib.compress(segment, 1) if self.compress else segment
+        if len(data) > self.max_entry_bytes: return
+        digest = content_digest(tab_values)
+        with self._lock:
+            # A write may have moved the generation on since the tabs were read
+            if key[3] != self._generations.get((key[0], key[1]), 0): return
+            # Same entity and format with other content is superseded
+            for stale in [k for k in self._entries if k[:4] == key[:4]]:
+                self._bytes -= len(self._entries.pop(stale)[0])
+            self._entries[key] = (data, self.compress, extra, digest, time.monotonic())
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[0])
+
+    def invalidate(self, spreadsheet_id, entity):
+        """Drops the entity's segments and moves it to a new generation"""
+        with self._lock:
+            self._generations[(spreadsheet_id, entity)] = self._generations.get((spreadsheet_id, entity), 0) + 1
+            for key in [k for k in self._entries if k[0] == spreadsheet_id and k[1] == entity]:
+                self._bytes -= len(self._entries.pop(key)[0])
+
+    @contextlib.contextmanager
+    def writing(self, spreadsheet_id, *entities):
+        """Around every write through this server to the entities' tabs: the
+        generations move on before it and again once it is over"""
+        for entity in entities: self.invalidate(spreadsheet_id, entity)
+        try:
+            yield
+        finally:
+            for entity in entities: self.invalidate(spreadsheet_id, entity)
+
+    def remember(self, spreadsheet_id, values):
+        """Keeps a successful pull's raw tab values as the fallback for outages"""
+        if self.max_snapshots <= 0: return
+        with self._lock:
+            self._snapshots[spreadsheet_id] = (values, time.time())
+            self._snapshots.move_to_end(spreadsheet_id)
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+
+    def last_good(self, spreadsheet_id):
+        """(values, unix time pulled) of the last good pull, or None"""
+        with self._lock:
+            return self._snapshots.get(spreadsheet_id)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "sheet_edits": self.sheet_edits, "verify_seconds": self.verify_seconds,
+                    "compress": self.compress, "snapshots": len(self._snapshots)}
+
+pull_cache = PullCache()
@@ -0,0 +1,241 @@
+import hashlib
+import threading
+
+import numpy as np
+
+# Reorder suggestions from OrderLines history.
+# Line history is folded into an items x weeks demand matrix with NumPy, so
+# 500k lines cost a few array passes instead of a Python loop per line. The
+# matrix is kept per spreadsheet and only new (or changed) lines are folded
+# in on the next run; a read missing lines the matrix counted (deleted or
+# archived away) rebuilds it, so every process agrees on the same rows.
+# Results are cached on a digest of the rows, so edits in place miss too.
+# The current week is still filling up and is left out of the forecast.
+
+DEFAULT_ALPHA = 0.3
+DEFAULT_LEAD_TIME_DAYS = 7
+DEFAULT_COVER_DAYS = 28
+ROLLING_WEEKS = 4
+
+# Weeks are counted from a Monday so week buckets line up with calendar weeks
+WEEK_EPOCH = np.datetime64('1970-01-05', 'D')
+
+_state = {}
+_lock = threading.Lock()
+
+def _float_column(values):
+    try:
+        return np.array(values, dtype=float)
+    except ValueError:
+        out = np.zeros(len(values))
+        for i, v in enumerate(values):
+            try: out[i] = float(v)
+            except (TypeError, ValueError): pass
+        return out
+
+def _date_column(values):
+    try:
+        return np.array([str(v)[:10] for v in values], dtype='datetime64[D]')
+    except ValueError:
+        out = np.full(len(values), np.datetime64('NaT'), dtype='datetime64[D]')
+        for i, v in enumerate(values):
+            try: out[i] = np.datetime64(str(v)[:10], 'D')
+            except ValueError: pass
+        return out
+
+def rows_digest(rows):
+    """Content digest of a tab's rows, cells separated by unit and row separators"""
+    text = '\x1e'.join('\x1f'.join(map(str, r)) for r in rows)
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+def line_arrays(line_rows, order_rows):
+    """Column arrays (line_id, item_id, week, qty) for every dated line"""
+    lines = [r for r in line_rows[1:] if len(r) >= 5 and r[0]]
+    orders = [r for r in order_rows[1:] if len(r) >= 4 and r[0]]
+    if not lines or not orders:
+        empty = np.array([], dtype=str)
+        return empty, empty, np.array([], dtype=np.int64), np.array([], dtype=float)
+
+    line_ids = np.array([str(r[0]) for r in lines])
+    line_order_ids = np.array([str(r[1]) for r in lines])
+    item_ids = np.array([str(r[2]) for r in lines])
+    qty = _float_column([r[4] or 0 for r in lines])
+
+    # Join lines to their order date with a sorted lookup
+    order_ids = np.array([str(r[0]) for r in orders])
+    order_dates = _date_column([r[3] for r in orders])
+    sort_idx = np.argsort(order_ids)
+    order_ids, order_dates = order_ids[sort_idx], order_dates[sort_idx]
+    pos = np.clip(np.searchsorted(order_ids, line_order_ids), 0, len(order_ids) - 1)
+    matched = order_ids[pos] == line_order_ids
+    dates = np.where(matched, order_dates[pos], np.datetime64('NaT'))
+
+    keep = ~np.isnat(dates)
+    weeks = (dates[keep] - WEEK_EPOCH).astype(np.int64) // 7
+    return line_ids[keep], item_ids[keep], weeks, qty[keep]
+
+def _new_state():
+    return {
+        "item_index": {}, "week_origin": None,
+        "demand": np.zeros((0, 0)),
+        "line_ids": np.array([], dtype=str), "line_qty": np.array([], dtype=float),
+        "line_item": np.array([], dtype=np.int64), "line_week": np.array([], dtype=np.int64),
+        "fingerprint": None, "result": None
+    }
+
+def _grow(state, n_items, max_week, min_week):
+    demand = state['demand']
+    origin = state['week_origin']
+    if origin is None:
+        origin = min_week
+    shift = max(0, origin - min_week)
+    n_weeks = max(demand.shape[1] + shift, max_week - min(origin, min_week) + 1)
+    if shift or n_items > demand.shape[0] or n_weeks > demand.shape[1]:
+        grown = np.zeros((max(n_items, demand.shape[0]), n_weeks))
+        grown[:demand.shape[0], shift:shift + demand.shape[1]] = demand
+        state['demand'] = grown
+        state['line_week'] = state['line_week'] + shift
+    state['week_origin'] = min(origin, min_week)
+
+def _positions(tracked, line_ids):
+    """(index into the sorted tracked ids, found) for each line id"""
+    if len(tracked) == 0:
+        return np.zeros(len(line_ids), dtype=np.int64), np.zeros(len(line_ids), dtype=bool)
+    pos = np.clip(np.searchsorted(tracked, line_ids), 0, len(tracked) - 1)
+    return pos, tracked[pos] == line_ids
+
+def lines_removed(state, line_ids):
+    """True when a full read lacks lines the state has counted"""
+    pos, found = _positions(state['line_ids'], line_ids)
+    return np.unique(pos[found]).size < len(state['line_ids'])
+
+def fold_lines(state, line_ids, item_ids, weeks, qty):
+    """Adds new lines (and corrections to known lines) into the demand matrix"""
+    if len(line_ids) == 0:
+        return 0
+
+    # Collapse duplicate line ids within the read, last one wins (matches upsert)
+    _, last = np.unique(line_ids[::-1], return_index=True)
+    last = len(line_ids) - 1 - last
+    line_ids, item_ids, weeks, qty = line_ids[last], item_ids[last], weeks[last], qty[last]
+
+    index = state['item_index']
+    uniq_items, inverse = np.unique(item_ids, return_inverse=True)
+    for item_id in uniq_items:
+        if item_id not in index: index[item_id] = len(index)
+    item_rows = np.array([index[i] for i in uniq_items], dtype=np.int64)[inverse]
+
+    _grow(state, len(index), int(weeks.max()), int(weeks.min()))
+    col = weeks - state['week_origin']
+
+    pos, seen = _positions(state['line_ids'], line_ids)
+    changed = np.zeros(len(line_ids), dtype=bool)
+    removals = None
+    if seen.any():
+        pos = pos[seen]
+        prev_item, prev_col, prev_qty = state['line_item'][pos], state['line_week'][pos], state['line_qty'][pos]
+        diff = (prev_qty != qty[seen]) | (prev_item != item_rows[seen]) | (prev_col != col[seen])
+        changed[np.flatnonzero(seen)[diff]] = True
+        if diff.any():
+            # Take back what was counted for edited lines before adding the new values
+            removals = (prev_item[diff], prev_col[diff], prev_qty[diff])
+            state['line_qty'][pos[diff]] = qty[seen][diff]
+            state['line_item'][pos[diff]] = item_rows[seen][diff]
+            state['line_week'][pos[diff]] = col[seen][diff]
+
+    fresh = ~seen
+    apply = fresh | changed
+    if not apply.any():
+        return 0
+
+    shape = state['demand'].shape
+    flat = item_rows[apply] * shape[1] + col[apply]
+    delta = np.bincount(flat, weights=qty[apply], minlength=state['demand'].size)
+    if removals is not None:
+        delta -= np.bincount(removals[0] * shape[1] + removals[1], weights=removals[2], minlength=state['demand'].size)
+    state['demand'] += delta.reshape(shape)
+
+    if fresh.any():
+        ids = np.concatenate([state['line_ids'], line_ids[fresh]])
+        order = np.argsort(ids, kind='stable')
+        state['line_ids'] = ids[order]
+        state['line_qty'] = np.concatenate([state['line_qty'], qty[fresh]])[order]
+        state['line_item'] = np.concatenate([state['line_item'], item_rows[fresh]])[order]
+        state['line_week'] = np.concatenate([state['line_week'], col[fresh]])[order]
+    return int(apply.sum())
+
+def smoothed_weekly_demand(demand, alpha):
+    """Exponential smoothing over each item's weekly series, as one matrix-vector product"""
+    n_weeks = demand.shape[1]
+    if n_weeks == 0:
+        return np.zeros(demand.shape[0])
+    powers = (1 - alpha) ** np.arange(n_weeks - 1, -1, -1)
+    weights = alpha * powers
+    # The first observation seeds the level, so it carries the remaining weight
+    weights[0] = powers[0]
+    return demand @ weights
+
+def suggest(state, items, current_week, alpha=DEFAULT_ALPHA, lead_time_days=DEFAULT_LEAD_TIME_DAYS, cover_days=DEFAULT_COVER_DAYS):
+    index = state['item_index']
+    demand = state['demand']
+    if state['week_origin'] is not None:
+        # Complete weeks only, padded with empty ones up to last week so quiet
+        # items decay toward zero
+        complete = max(0, current_week - state['week_origin'])
+        demand = demand[:, :complete]
+        missing = complete - demand.shape[1]
+        if missing > 0:
+            demand = np.hstack([demand, np.zeros((demand.shape[0], missing))])
+
+    active = [i for i in items if str(i.get('status') or 'active') == 'active']
+    if not active:
+        return []
+    rows = np.array([index.get(str(i['item_id']), -1) for i in active], dtype=np.int64)
+    stock = np.array([i.get('current_stock_qty') or 0 for i in active], dtype=float)
+    has_history = rows >= 0
+
+    weekly = np.zeros(len(active))
+    rolling = np.zeros(len(active))
+    if demand.size:
+        hist = demand[rows[has_history]]
+        weekly[has_history] = smoothed_weekly_demand(hist, alpha)
+        rolling[has_history] = hist[:, -ROLLING_WEEKS:].sum(axis=1)
+
+    daily = weekly / 7.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cover = np.where(daily > 0, np.maximum(stock, 0) / daily, np.inf)
+    target = daily * (lead_time_days + cover_days)
+    suggested = np.maximum(0, np.ceil(target - np.maximum(stock, 0))).astype(np.int64)
+
+    out = []
+    for k in np.lexsort((-suggested, cover)):
+        item = active[k]
+        out.append({
+            "item_id": str(item['item_id']), "item_display_name": item.get('item_display_name', ''),
+            "item_number": item.get('item_number', ''), "current_stock_qty": int(stock[k]),
+            "rolling_demand": round(float(rolling[k]), 2), "weekly_forecast": round(float(weekly[k]), 2),
+            "days_of_cover": None if np.isinf(cover[k]) else round(float(cover[k]), 1),
+            "suggested_order_qty": int(suggested[k])
+        })
+    return out
+
+def reorder_suggestions(spreadsheet_id, line_rows, order_rows, items, today=None, **params):
+    """Incrementally folds line history and returns (suggestions, stats). Results are cached per input."""
+    today = np.datetime64(today or 'today', 'D')
+    current_week = int((today - WEEK_EPOCH).astype(np.int64) // 7)
+    fingerprint = (rows_digest(line_rows), rows_digest(order_rows), current_week, tuple(sorted(params.items())),
+                   hash(tuple((str(i.get('item_id')), i.get('current_stock_qty'), i.get('status')) for i in items)))
+
+    with _lock:
+        state = _state.setdefault(spreadsheet_id, _new_state())
+        if state['fingerprint'] == fingerprint and state['result'] is not None:
+            return state['result'], {"cached": True, "lines_folded": 0, "lines_tracked": int(len(state['line_ids'])), "rebuilt": False}
+
+        line_ids, item_ids, weeks, qty = line_arrays(line_rows, order_rows)
+        rebuilt = lines_removed(state, line_ids)
+        if rebuilt: state = _state[spreadsheet_id] = _new_state()
+        folded = fold_lines(state, line_ids, item_ids, weeks, qty)
+        result = suggest(state, items, current_week, **params)
+        state['fingerprint'] = fingerprint
+        state['result'] = result
+        return result, {"cached": False, "lines_folded": folded, "lines_tracked": int(len(state['line_ids'])), "rebuilt": rebuilt}
@@ -0,0 +1,75 @@
+import json
+
+from database import get_db_connection
+
+# Durable queue of /sync pushes that could not reach Sheets (breaker open or
+# an outage mid-sync). Each entry holds one request's encoded customer,
+# item, stock adjustment and payment rows, its orders and its field patches.
+# Entries are replayed oldest first, before the next push to the same
+# spreadsheet once Sheets answers again; upserts are keyed by id, appends
+# skip ids already written and a patch already written is known by its
+# updated_at, so replaying an entry that partly went through is safe. An
+# entry the sheet keeps refusing (not an outage) is parked as 'failed' after
+# MAX_REPLAY_ATTEMPTS so it cannot block the ones behind it.
+
+MAX_REPLAY_ATTEMPTS = 5
+
+def enqueue_push(spreadsheet_id, mode, customers, items, orders, adjustments=(), payments=(), patches=(), error=None):
+    payload = json.dumps({"mode": mode, "customers": customers, "items": items, "orders": orders,
+                          "adjustments": list(adjustments), "payments": list(payments), "patches": list(patches)}, separators=(',', ':'))
+    conn = get_db_connection()
+    try:
+        cur = conn.execute('INSERT INTO sync_retry_queue (spreadsheet_id, payload, last_error) VALUES (?, ?, ?)',
+                           (spreadsheet_id, payload, error))
+        conn.commit()
+        return cur.lastrowid
+    finally:
+        conn.close()
+
+def pending_pushes(spreadsheet_id):
+    """[(entry id, payload)] oldest first"""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute("SELECT id, payload FROM sync_retry_queue WHERE spreadsheet_id = ? AND status = 'pending' ORDER BY id",
+                            (spreadsheet_id,)).fetchall()
+        return [(r['id'], json.loads(r['payload'])) for r in rows]
+    finally:
+        conn.close()
+
+def has_pending(spreadsheet_id):
+    conn = get_db_connection()
+    try:
+        return conn.execute("SELECT 1 FROM sync_retry_queue WHERE spreadsheet_id = ? AND status = 'pending' LIMIT 1",
+                            (spreadsheet_id,)).fetchone() is not None
+    finally:
+        conn.close()
+
+def complete_push(entry_id):
+    conn = get_db_connection()
+    try:
+        conn.execute('DELETE FROM sync_retry_queue WHERE id = ?', (entry_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+def record_attempt(entry_id, error, give_up=False):
+    """Counts a failed replay; give_up (or too many attempts) parks the entry as 'failed'"""
+    conn = get_db_connection()
+    try:
+        conn.execute('''UPDATE sync_retry_queue SET attempts = attempts + 1, last_error = ?,
+                        status = CASE WHEN ? OR attempts + 1 >= ? THEN 'failed' ELSE status END WHERE id = ?''',
+                     (str(error)[:500], bool(give_up), MAX_REPLAY_ATTEMPTS, entry_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def queue_stats():
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('SELECT status, COUNT(*) AS n, MIN(queued_at) AS oldest FROM sync_retry_queue GROUP BY status').fetchall()
+        by_status = {r['status']: r for r in rows}
+        pending = by_status.get('pending')
+        return {"pending": pending['n'] if pending else 0, "oldest_pending_at": pending['oldest'] if pending else None,
+                "failed": by_status['failed']['n'] if 'failed' in by_status else 0}
+    finally:
+        conn.close()
@@ -0,0 +1,201 @@
+import os
+import sys
+import random
+import threading
+import contextlib
+
+from database import get_db_connection, Counters, in_chunks
+
+# Persistent id -> row number index of each spreadsheet tab the Sheets
+# backend upserts into, so an upsert does not read the whole tab: known ids
+# are written in place and new ones below the last row, in one batchUpdate.
+# Every write through the backend keeps it current. Edits made in the sheet
+# itself (sorting, deleting or inserting rows) are caught before each indexed
+# upsert by one batchGet of the id cells of up to
+# PARTFLOW_ROW_INDEX_SPOT_CHECKS target rows, the last indexed row and the
+# row after it. Any mismatch drops the tab's index; the upsert then falls
+# back to reading the tab, which rebuilds it. The header row is left to the
+# schema migrations (migrations.py).
+#
+# New rows go below the indexed row count, so nothing else may add rows to
+# a tab between an upsert's plan and its commit: the backends hold the tab's
+# tab_lock across plan, check, write and commit (and around appends,
+# replaces, clears and deletes), which serialises the writes of one server
+# process to one tab. The locks are reentrant so a read-modify-write over
+# several calls (archive.py) can hold them throughout. Writers in other
+# processes are left to the spot checks.
+
+SPOT_CHECK_ROWS = int(os.environ.get('PARTFLOW_ROW_INDEX_SPOT_CHECKS', '20'))
+
+_counts = Counters("indexed_upserts", "full_reads", "drift")
+
+_tab_locks = {}
+_tab_locks_lock = threading.Lock()
+
+def tab_lock(spreadsheet_id, tab):
+    """The lock a write that adds, moves or removes rows of the tab holds"""
+    with _tab_locks_lock:
+        return _tab_locks.setdefault((spreadsheet_id, tab), threading.RLock())
+
+@contextlib.contextmanager
+def tab_locks(spreadsheet_id, tabs):
+    """Holds the tab_lock of each tab, taken in name order"""
+    with contextlib.ExitStack() as stack:
+        for tab in sorted(set(tabs)): stack.enter_context(tab_lock(spreadsheet_id, tab))
+        yield
+
+def entity_key(row):
+    return str(row[0]) if row else ''
+
+def rebuild(spreadsheet_id, tab, rows):
+    """Indexes a tab from its full contents (header row included), as last written or read"""
+    positions = {}
+    for n, row in enumerate(rows[1:], 2):
+        key = entity_key(row)
+        # The last duplicate wins, as in merge_sheet_rows
+        if key: positions[key] = n
+    conn = get_db_connection()
+    try:
+        conn.execute('DELETE FROM sheet_row_index WHERE spreadsheet_id = ? AND tab = ?', (spreadsheet_id, tab))
+        conn.executemany('INSERT INTO sheet_row_index (spreadsheet_id, tab, entity_id, row_num) VALUES (?, ?, ?, ?)',
+                         [(spreadsheet_id, tab, key, n) for key, n in positions.items()])
+        conn.execute('INSERT OR REPLACE INTO sheet_row_counts (spreadsheet_id, tab, row_count) VALUES (?, ?, ?)',
+                     (spreadsheet_id, tab, len(rows)))
+        conn.commit()
+    finally:
+        conn.close()
+
+def forget(spreadsheet_id, tab):
+    conn = get_db_connection()
+    try:
+        conn.execute('DELETE FROM sheet_row_index WHERE spreadsheet_id = ? AND tab = ?', (spreadsheet_id, tab))
+        conn.execute('DELETE FROM sheet_row_counts WHERE spreadsheet_id = ? AND tab = ?', (spreadsheet_id, tab))
+        conn.commit()
+    finally:
+        conn.close()
+
+def truncate(spreadsheet_id, tab, start_row):
+    """The tab was cleared from start_row down"""
+    conn = get_db_connection()
+    try:
+        conn.execute('DELETE FROM sheet_row_index WHERE spreadsheet_id = ? AND tab = ? AND row_num >= ?', (spreadsheet_id, tab, start_row))
+        conn.execute('UPDATE sheet_row_counts SET row_count = MIN(row_count, ?) WHERE spreadsheet_id = ? AND tab = ?',
+                     (start_row - 1, spreadsheet_id, tab))
+        conn.commit()
+    finally:
+        conn.close()
+
+def _load(spreadsheet_id, tab, keys):
+    """(row count, {id: row} for the given ids, id of the last row) or None when the tab is not indexed"""
+    conn = get_db_connection()
+    try:
+        count = conn.execute('SELECT row_count FROM sheet_row_counts WHERE spreadsheet_id = ? AND tab = ?',
+                             (spreadsheet_id, tab)).fetchone()
+        if count is None: return None
+        row_count = count['row_count']
+        known = {}
+        for chunk, placeholders in in_chunks(keys):
+            known.update((r['entity_id'], r['row_num']) for r in conn.execute(
+                f"SELECT entity_id, row_num FROM sheet_row_index WHERE spreadsheet_id = ? AND tab = ? AND entity_id IN ({placeholders})",
+                (spreadsheet_id, tab, *chunk)))
+        last = conn.execute('SELECT entity_id FROM sheet_row_index WHERE spreadsheet_id = ? AND tab = ? AND row_num = ?',
+                            (spreadsheet_id, tab, row_count)).fetchone()
+        return row_count, known, (last['entity_id'] if last else None)
+    finally:
+        conn.close()
+
+class UpsertPlan:
+    """Where each upserted row goes, and what to read first to trust that"""
+
+    def __init__(self, spreadsheet_id, tab, headers, rows, index):
+        self.spreadsheet_id, self.tab, self.headers = spreadsheet_id, tab, headers
+        row_count, known, last_id = index
+        width = len(headers)
+        targets, self.placed, next_row = {}, {}, row_count + 1
+        for row in rows:
+            key = entity_key(row)
+            n = known.get(key) or self.placed.get(key)
+            if n is None:
+                n = self.placed[key] = next_row
+                next_row += 1
+            # Padded so cells an older, wider row had are blanked
+            targets[n] = list(row) + [''] * (width - len(row))
+        self.row_count = next_row - 1
+
+        # The id cell each check expects ('' = empty row)
+        checks = [(n, key) for key, n in known.items()]
+        if len(checks) > SPOT_CHECK_ROWS: checks = random.sample(checks, SPOT_CHECK_ROWS)
+        if row_count > 1 and last_id is not None: checks.append((row_count, last_id))
+        checks.append((row_count + 1, ''))
+        self.checks = checks
+        self.ranges = [f"'{tab}'!A{n}" for n, _ in checks]
+
+        # One range per run of consecutive target rows
+        data, run = [], []
+        for n in sorted(targets):
+            if run and n != run[-1] + 1:
+                data.append({'range': f"'{tab}'!A{run[0]}", 'values': [targets[r] for r in run]})
+                run = []
+            run.append(n)
+        if run: data.append({'range': f"'{tab}'!A{run[0]}", 'values': [targets[r] for r in run]})
+        self.body = {'valueInputOption': 'USER_ENTERED', 'data': data}
+
+    def matches(self, batch_result):
+        """True when the batchGet of self.ranges agrees with the index"""
+        value_ranges = [vr.get('values', []) for vr in batch_result.get('valueRanges', [])]
+        if len(value_ranges) != len(self.ranges): return False
+        for (_, expected), values in zip(self.checks, value_ranges):
+            cell = str(values[0][0]) if values and values[0] else ''
+            if cell != expected: return False
+        return True
+
+    def commit(self):
+        """Records the new rows once the batchUpdate went through"""
+        conn = get_db_connection()
+        try:
+            conn.executemany('INSERT OR REPLACE INTO sheet_row_index (spreadsheet_id, tab, entity_id, row_num) VALUES (?, ?, ?, ?)',
+                             [(self.spreadsheet_id, self.tab, key, n) for key, n in self.placed.items()])
+            conn.execute('UPDATE sheet_row_counts SET row_count = ? WHERE spreadsheet_id = ? AND tab = ?',
+                         (self.row_count, self.spreadsheet_id, self.tab))
+            conn.commit()
+        finally:
+            conn.close()
+        _counts.add("indexed_upserts")
+
+    def drifted(self):
+        drifted(self.spreadsheet_id, self.tab)
+
+def drifted(spreadsheet_id, tab):
+    """The sheet no longer matches the index: drop it for a full read"""
+    # stderr: the benchmarks write their JSON reports to stdout
+    print(f"Row index drift in {spreadsheet_id} '{tab}', rebuilding", file=sys.stderr)
+    forget(spreadsheet_id, tab)
+    _counts.add("drift")
+    _counts.add("full_reads")
+
+def plan_upsert(spreadsheet_id, tab, headers, rows):
+    """An UpsertPlan, or None when the tab is not indexed yet (read it in full)"""
+    index = _load(spreadsheet_id, tab, {entity_key(r) for r in rows})
+    if index is None:
+        _counts.add("full_reads")
+        return None
+    return UpsertPlan(spreadsheet_id, tab, headers, rows, index)
+
+def locate(spreadsheet_id, tab, keys):
+    """{id: row} of existing rows, or None when the tab is not indexed or one
+    of the ids is not in it (read the tab in full). The caller checks the id
+    cells of the rows it reads."""
+    keys = set(keys)
+    index = _load(spreadsheet_id, tab, keys)
+    if index is None or len(index[1]) < len(keys):
+        _counts.add("full_reads")
+        return None
+    return index[1]
+
+def index_stats():
+    conn = get_db_connection()
+    try:
+        tabs = conn.execute('SELECT COUNT(*) FROM sheet_row_counts').fetchone()[0]
+    finally:
+        conn.close()
+    return {"tabs": tabs, **_counts.snapshot()}
@@ -0,0 +1,10 @@
+# Column layout of each tab in the spreadsheet (row 1 headers)
+
+CUSTOMER_HEADERS = ['ID', 'Shop Name', 'Address', 'Phone', 'City', 'Discount 1', 'Discount 2', 'Balance', 'Credit Period', 'Status', 'Last Updated']
+INVENTORY_HEADERS = ['ID', 'Display Name', 'Internal Name', 'SKU', 'Vehicle', 'Brand/Origin', 'Category', 'Unit Value', 'Stock Qty', 'Low Stock Threshold', 'Out of Stock', 'Status', 'Last Updated']
+ORDER_HEADERS = ['Order ID', 'Customer ID', 'Rep ID', 'Date', 'Gross Total', 'Disc 1 Rate', 'Disc 1 Value', 'Disc 2 Rate', 'Disc 2 Value', 'Net Total', 'Paid', 'Balance Due', 'Payment Status', 'Delivery Status', 'Credit Period', 'Status', 'Last Updated']
+LINE_HEADERS = ['Line ID', 'Order ID', 'Item ID', 'Item Name', 'Qty', 'Unit Price', 'Line Total']
+
+# Append-only logs (append_log.py): rows are written once and never rewritten
+ADJUSTMENT_HEADERS = ['Adjustment ID', 'Item ID', 'Type', 'Qty', 'Stock Change', 'Reason', 'Date']
+PAYMENT_HEADERS = ['Payment ID', 'Order ID', 'Customer ID', 'Date', 'Amount', 'Type', 'Reference', 'Notes']
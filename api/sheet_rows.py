@@ -0,0 +1,132 @@
+from patches import patch_record
+
+# Sheet rows of the sync tabs (column layouts in schema.py): the encoders
+# turn /sync body records into rows as the body is read, the decoders turn
+# pulled rows back into the records sent to the app.
+
+# --- Row Encoders ---
+# Used on the /sync body as it is read: customers and items go straight to
+# sheet rows, orders stay dicts (validation and lines need them)
+
+def customer_row(c):
+    return [c['customer_id'], c['shop_name'], c['address'], c['phone'], c['city_ref'], c['discount_rate'], c.get('secondary_discount_rate', 0), c.get('outstanding_balance', 0), c.get('credit_period', 90), c['status'], c['updated_at']]
+
+def item_row(i):
+    return [i['item_id'], i['item_display_name'], i['item_name'], i['item_number'], i['vehicle_model'], i['source_brand'], i.get('category', 'Uncategorized'), i['unit_value'], i['current_stock_qty'], i.get('low_stock_threshold', 10), i.get('is_out_of_stock', False), i['status'], i['updated_at']]
+
+def order_row(o):
+    return [o['order_id'], o['customer_id'], o.get('rep_id', ''), o['order_date'], o.get('gross_total', 0), o.get('discount_rate', 0), o.get('discount_value', 0), o.get('secondary_discount_rate', 0), o.get('secondary_discount_value', 0), o['net_total'], o.get('paid_amount', 0), o.get('balance_due', 0), o.get('payment_status', 'unpaid'), o.get('delivery_status', 'pending'), o.get('credit_period', 90), o['order_status'], o['updated_at']]
+
+# Stock Change of each adjustment type ('correction' carries its own sign)
+ADJUSTMENT_SIGNS = {'restock': 1, 'return': 1, 'damage': -1, 'correction': 1}
+
+def adjustment_row(a):
+    return [a['adjustment_id'], a['item_id'], a['adjustment_type'], a['quantity'], ADJUSTMENT_SIGNS.get(a['adjustment_type'], 0) * a['quantity'], a.get('reason', ''), a.get('created_at') or a.get('updated_at', '')]
+
+def payment_row(p):
+    return [p['payment_id'], p['order_id'], p.get('customer_id', ''), p.get('payment_date', ''), p['amount'], p.get('payment_type', ''), p.get('reference_number', ''), p.get('notes', '')]
+
+def item_row_fields(row):
+    """The item fields the low-stock index needs, back from an encoded row"""
+    return {"item_id": row[0], "item_display_name": row[1], "item_number": row[3], "current_stock_qty": row[8],
+            "low_stock_threshold": row[9], "is_out_of_stock": row[10], "status": row[11], "updated_at": row[12]}
+
+def order_line_rows(o):
+    return [[l['line_id'], o['order_id'], l['item_id'], l['item_name'], l['quantity'], l['unit_value'], l['line_total']] for l in o.get('lines', [])]
+
+def order_sheet_rows(orders):
+    """(order rows, line rows) for a list of orders"""
+    return [order_row(o) for o in orders], [l for o in orders for l in order_line_rows(o)]
+
+def order_record(o):
+    if not isinstance(o, dict): raise TypeError(f"expected an object, got {type(o).__name__}")
+    return o
+
+SYNC_BODY_ENCODERS = {'customers': customer_row, 'items': item_row, 'orders': order_record, 'adjustments': adjustment_row, 'payments': payment_row,
+                      'patches': patch_record}
+
+# --- Pull Decoders ---
+# Generators over raw sheet values, so a streamed pull never holds every
+# decoded row at once. The parse_* wrappers return lists for everything else.
+
+def iter_inventory_rows(rows):
+    for row in rows[1:]:
+        if not row or not row[0]: continue
+        while len(row) < 13: row.append('')
+        try: unit_val = float(row[7]) if row[7] else 0
+        except: unit_val = 0
+        yield {
+            "item_id": str(row[0]), "item_display_name": str(row[1]), "item_name": str(row[2] or row[1]),
+            "item_number": str(row[3]), "vehicle_model": str(row[4]), "source_brand": str(row[5] or 'Unknown'),
+            "category": str(row[6] or 'Uncategorized'), "unit_value": unit_val, "current_stock_qty": int(row[8]) if row[8] else 0,
+            "low_stock_threshold": int(row[9]) if row[9] else 10, "is_out_of_stock": str(row[10]).lower() == 'true',
+            "status": str(row[11] or 'active'), "updated_at": str(row[12] or ''), "sync_status": 'synced'
+        }
+
+def iter_customer_rows(rows):
+    for row in rows[1:]:
+        if not row or not row[0]: continue
+        while len(row) < 11: row.append('')
+        try: disc1 = float(row[5]) if row[5] else 0
+        except: disc1 = 0
+        try: disc2 = float(row[6]) if row[6] else 0
+        except: disc2 = 0
+        try: bal = float(row[7]) if row[7] else 0
+        except: bal = 0
+        try: cpd = int(row[8]) if row[8] else 90
+        except: cpd = 90
+        yield {
+            "customer_id": str(row[0]), "shop_name": str(row[1]), "address": str(row[2]),
+            "phone": str(row[3]), "city_ref": str(row[4]), 
+            "discount_rate": disc1, "secondary_discount_rate": disc2,
+            "outstanding_balance": bal, "credit_period": cpd, "status": str(row[9] or 'active'),
+            "updated_at": str(row[10] or ''), "sync_status": 'synced'
+        }
+
+LINE_FIELDS = ["line_id", "order_id", "item_id", "item_name", "quantity", "unit_value", "line_total"]
+
+def decode_line_row(row):
+    return {
+        "line_id": str(row[0]), "order_id": str(row[1]), "item_id": str(row[2]),
+        "item_name": str(row[3]), "quantity": int(row[4]) if row[4] else 0,
+        "unit_value": float(row[5]) if row[5] else 0, "line_total": float(row[6]) if row[6] else 0
+    }
+
+def iter_order_rows(order_rows, line_rows):
+    # Group the raw line rows by order; they are decoded with their order
+    lines_by_order = {}
+    for row in line_rows[1:]:
+        if len(row) < 7: continue
+        lines_by_order.setdefault(str(row[1]), []).append(row)
+
+    for row in order_rows[1:]:
+        if not row or not row[0]: continue
+        while len(row) < 17: row.append('')
+        oid = str(row[0])
+        yield {
+            "order_id": oid, "customer_id": str(row[1]), "rep_id": str(row[2]),
+            "order_date": str(row[3]), 
+            "gross_total": float(row[4]) if row[4] else 0,
+            "discount_rate": float(row[5]) if row[5] else 0,
+            "discount_value": float(row[6]) if row[6] else 0,
+            "secondary_discount_rate": float(row[7]) if row[7] else 0,
+            "secondary_discount_value": float(row[8]) if row[8] else 0,
+            "net_total": float(row[9]) if row[9] else 0,
+            "paid_amount": float(row[10]) if row[10] else 0, 
+            "balance_due": float(row[11]) if row[11] else 0,
+            "payment_status": str(row[12] or 'unpaid'), 
+            "delivery_status": str(row[13] or 'pending'),
+            "credit_period": int(row[14]) if row[14] else 90,
+            "order_status": str(row[15] or 'confirmed'), 
+            "updated_at": str(row[16] or ''),
+            "lines": [decode_line_row(l) for l in lines_by_order.get(oid, [])], "sync_status": 'synced'
+        }
+
+def parse_inventory_rows(rows):
+    return list(iter_inventory_rows(rows))
+
+def parse_customer_rows(rows):
+    return list(iter_customer_rows(rows))
+
+def parse_order_rows(order_rows, line_rows):
+    return list(iter_order_rows(order_rows, line_rows))
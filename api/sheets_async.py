@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import asyncio
+from urllib.parse import quote
+
+import anyio
+import httpx
+from google.auth.transport.requests import Request
+
+from metrics import record_sheets_call
+from breaker import sheets_breaker, SHEETS_TIMEOUT_SECONDS
+
+# Non-blocking client for the Sheets REST API (v4), used by the ASGI app
+# (asgi.py). It makes the same calls as the googleapiclient service in
+# index.py, but over one pooled httpx.AsyncClient per process, so a request
+# waiting on Sheets holds a socket rather than a thread. google-auth is
+# blocking: the service-account token is refreshed in a worker thread and
+# shared by every request until it expires. Large bodies are encoded and
+# decoded in worker threads too. Every call goes through the Sheets circuit
+# breaker (breaker.py), shared with the Flask app's service.
+
+SHEETS_API = 'https://sheets.googleapis.com/v4/spreadsheets'
+MAX_CONNECTIONS = int(os.environ.get('PARTFLOW_SHEETS_MAX_CONNECTIONS', '100'))
+
+class SheetsError(Exception):
+    """A non-2xx answer from the Sheets API; status is the HTTP status"""
+    def __init__(self, status, message):
+        super().__init__(f"Sheets API returned {status}: {message}")
+        self.status = status
+
+def _error_message(response):
+    try: return response.json()['error']['message']
+    except Exception: return response.text[:200] or response.reason_phrase
+
+def _range_path(range_name):
+    return quote(range_name, safe='')
+
+class AsyncSheets:
+    """credentials: google-auth credentials (None sends no Authorization header).
+    transport: an httpx transport, e.g. httpx.MockTransport in tests."""
+
+    def __init__(self, credentials=None, transport=None, base_url=SHEETS_API, breaker=None):
+        self._credentials = credentials
+        self._breaker = breaker or sheets_breaker
+        self._token_lock = asyncio.Lock()
+        limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+        self._client = httpx.AsyncClient(base_url=base_url, transport=transport, limits=limits, timeout=SHEETS_TIMEOUT_SECONDS)
+
+    async def authorize(self):
+        """Refreshes the token if it is missing or expired; one refresh at a time"""
+        creds = self._credentials
+        if creds is None or creds.valid: return
+        async with self._token_lock:
+            if not creds.valid:
+                await anyio.to_thread.run_sync(creds.refresh, Request())
+
+    async def _call(self, name, method, path, params=None, body=None):
+        await self.authorize()
+        headers = {'Authorization': f'Bearer {self._credentials.token}'} if self._credentials else {}
+        content = None
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+            content = await anyio.to_thread.run_sync(json.dumps, body)
+        self._breaker.before_call()
+        start = time.perf_counter()
+        try:
+            response = await self._client.request(method, path, params=params, content=content, headers=headers)
+            if response.status_code >= 400:
+                raise SheetsError(response.status_code, _error_message(response))
+        except BaseException as e:
+            seconds = time.perf_counter() - start
+            self._breaker.record(seconds, e)
+            record_sheets_call(name, seconds, None, body)
+            raise
+        seconds = time.perf_counter() - start
+        self._breaker.record(seconds)
+        result = await anyio.to_thread.run_sync(json.loads, response.content) if response.content else {}
+        record_sheets_call(name, seconds, result, body)
+        return result
+
+    # --- Same calls as service.spreadsheets() ---
+
+    async def get(self, spreadsheet_id, fields='sheets.properties'):
+        return await self._call('spreadsheets.get', 'GET', f'/{spreadsheet_id}', {'fields': fields})
+
+    async def batch_update(self, spreadsheet_id, body):
+        return await self._call('spreadsheets.batchUpdate', 'POST', f'/{spreadsheet_id}:batchUpdate', body=body)
+
+    async def values_get(self, spreadsheet_id, range_name):
+        return await self._call('values.get', 'GET', f'/{spreadsheet_id}/values/{_range_path(range_name)}')
+
+    async def values_batch_get(self, spreadsheet_id, ranges):
+        return await self._call('values.batchGet', 'GET', f'/{spreadsheet_id}/values:batchGet', [('ranges', r) for r in ranges])
+
+    async def values_batch_update(self, spreadsheet_id, body):
+        return await self._call('values.batchUpdate', 'POST', f'/{spreadsheet_id}/values:batchUpdate', body=body)
+
+    async def values_update(self, spreadsheet_id, range_name, values, value_input_option='USER_ENTERED'):
+        return await self._call('values.update', 'PUT', f'/{spreadsheet_id}/values/{_range_path(range_name)}',
+                                {'valueInputOption': value_input_option}, {'values': values})
+
+    async def values_append(self, spreadsheet_id, range_name, values, value_input_option='USER_ENTERED'):
+        return await self._call('values.append', 'POST', f'/{spreadsheet_id}/values/{_range_path(range_name)}:append',
+                                {'valueInputOption': value_input_option}, {'values': values})
+
+    async def values_clear(self, spreadsheet_id, range_name):
+        return await self._call('values.clear', 'POST', f'/{spreadsheet_id}/values/{_range_path(range_name)}:clear', body={})
+
+    async def aclose(self):
+        await self._client.aclose()
@@ -0,0 +1,148 @@
+import re
+
+from database import get_db_connection, Counters
+from pull_cache import content_digest
+
+# Server-side SKU allocation for spreadsheets with auto SKUs on (the /sync
+# body's autoSku). A new SKU is the acronym of the item's display name (first
+# letter of each word, A-Z0-9 only) and the next number after the highest
+# number any SKU already carries after that acronym, padded to two digits:
+# "Brake Pad Set" -> BPS01, BPS02, ... as the app's generateSKU has always
+# done, but against every SKU of the spreadsheet rather than one device's.
+#
+# Per spreadsheet, sku_counters keeps the highest number seen after every
+# prefix a SKU has (BPS12 counts for BPS, and for BPS1 as 2), and sku_used
+# the SKUs taken and the item holding each. Allocating is then a counter
+# read and a few keyed writes per item, however many SKUs there are, in one
+# write transaction so two syncs never hand out the same number. An item
+# that already holds a SKU gets it again, so a resent push is not renumbered.
+#
+# Both tables are merged from the pulled Inventory tab whenever its ids and
+# SKUs differ from the last merge (edits made in the sheet); counters only
+# go up, so the SKU of a deleted item is not handed out again.
+
+_SKU_CELL = 3
+_NAME_CELL = 1
+_DIGITS = re.compile(r'\d+')
+_NOT_BASE = re.compile(r'[^A-Z0-9]')
+
+_counts = Counters("allocated", "reused", "merges")
+
+def sku_base(name):
+    """The acronym a SKU for this display name starts with ('' for none)"""
+    return _NOT_BASE.sub('', ''.join(word[0] for word in str(name or '').split()).upper())
+
+def _numbered_prefixes(sku):
+    """[(prefix, number)]: the number each prefix of the SKU is followed by"""
+    return [(sku[:k], int(_DIGITS.match(sku, k).group())) for k in range(1, len(sku)) if sku[k].isdigit()]
+
+def _sku(row):
+    return str(row[_SKU_CELL]).strip() if len(row) > _SKU_CELL and row[_SKU_CELL] is not None else ''
+
+def _tab_digest(rows):
+    return content_digest([[[str(row[0]), _sku(row)] for row in rows[1:] if row]])
+
+def _record(conn, spreadsheet_id, taken):
+    """Marks [(sku, item_id)] as used and raises the counters of their prefixes"""
+    highest = {}
+    for sku, _ in taken:
+        for prefix, n in _numbered_prefixes(sku):
+            if n > highest.get(prefix, -1): highest[prefix] = n
+    conn.executemany('''INSERT INTO sku_used (spreadsheet_id, sku, item_id) VALUES (?, ?, ?)
+                        ON CONFLICT (spreadsheet_id, sku) DO UPDATE SET item_id = excluded.item_id''',
+                     [(spreadsheet_id, sku, item_id) for sku, item_id in taken])
+    conn.executemany('''INSERT INTO sku_counters (spreadsheet_id, prefix, last_number) VALUES (?, ?, ?)
+                        ON CONFLICT (spreadsheet_id, prefix) DO UPDATE SET last_number = MAX(last_number, excluded.last_number)''',
+                     [(spreadsheet_id, prefix, n) for prefix, n in highest.items()])
+
+def is_seeded(spreadsheet_id):
+    conn = get_db_connection()
+    try:
+        return conn.execute('SELECT 1 FROM sku_seeded WHERE spreadsheet_id = ?', (spreadsheet_id,)).fetchone() is not None
+    finally:
+        conn.close()
+
+def _seen_digest(conn, spreadsheet_id):
+    seen = conn.execute('SELECT digest FROM sku_seeded WHERE spreadsheet_id = ?', (spreadsheet_id,)).fetchone()
+    return seen['digest'] if seen is not None else None
+
+def _set_digest(conn, spreadsheet_id, digest):
+    conn.execute('''INSERT INTO sku_seeded (spreadsheet_id, digest) VALUES (?, ?)
+                    ON CONFLICT (spreadsheet_id) DO UPDATE SET digest = excluded.digest''', (spreadsheet_id, digest))
+
+def merge_tab(spreadsheet_id, rows):
+    """Takes the SKUs of the Inventory tab (header first) into the index,
+    unless its ids and SKUs are as they were at the last merge"""
+    digest = _tab_digest(rows)
+    conn = get_db_connection()
+    try:
+        if _seen_digest(conn, spreadsheet_id) == digest: return False
+        conn.execute('BEGIN IMMEDIATE')
+        _record(conn, spreadsheet_id, [(_sku(row), str(row[0])) for row in rows[1:] if row and row[0] not in (None, '') and _sku(row)])
+        _set_digest(conn, spreadsheet_id, digest)
+        conn.commit()
+    finally:
+        conn.close()
+    _counts.add("merges")
+    return True
+
+def assign_skus(spreadsheet_id, rows):
+    """Takes the SKUs of Inventory rows into the index and gives the rows with
+    a blank SKU cell one, in place. Returns the rows given a SKU."""
+    rows = [row for row in rows if row and row[0] not in (None, '')]
+    taken = [(_sku(row), str(row[0])) for row in rows if _sku(row)]
+    blank = [row for row in rows if not _sku(row)]
+    if not taken and not blank: return []
+    filled, reused = [], 0
+    conn = get_db_connection()
+    try:
+        # Write lock first: counters read here are not handed out by another sync
+        conn.execute('BEGIN IMMEDIATE')
+        if taken: _record(conn, spreadsheet_id, taken)
+        for row in blank:
+            item_id = str(row[0])
+            held = conn.execute('SELECT sku FROM sku_used WHERE spreadsheet_id = ? AND item_id = ? ORDER BY rowid DESC LIMIT 1',
+                                (spreadsheet_id, item_id)).fetchone()
+            if held is not None:
+                sku = held['sku']
+                reused += 1
+            else:
+                base = sku_base(row[_NAME_CELL] if len(row) > _NAME_CELL else '')
+                if not base: continue
+                last = conn.execute('SELECT last_number FROM sku_counters WHERE spreadsheet_id = ? AND prefix = ?',
+                                    (spreadsheet_id, base)).fetchone()
+                # Higher than any number after base, so no SKU has it yet
+                sku = f"{base}{(last['last_number'] if last is not None else 0) + 1:02d}"
+                _record(conn, spreadsheet_id, [(sku, item_id)])
+            row.extend([''] * (_SKU_CELL + 1 - len(row)))
+            row[_SKU_CELL] = sku
+            filled.append(row)
+        conn.commit()
+    finally:
+        conn.close()
+    _counts.add("allocated", len(filled) - reused)
+    _counts.add("reused", reused)
+    return filled
+
+def fill_tab(spreadsheet_id, rows):
+    """Merges the pulled Inventory tab (header first) and gives its rows with
+    a blank SKU cell one, in place. Returns those rows, to be written back."""
+    merge_tab(spreadsheet_id, rows)
+    filled = assign_skus(spreadsheet_id, [row for row in rows[1:] if row and not _sku(row)])
+    if filled:
+        # As the tab will be once they are written: the next pull has nothing new
+        conn = get_db_connection()
+        try:
+            _set_digest(conn, spreadsheet_id, _tab_digest(rows))
+            conn.commit()
+        finally:
+            conn.close()
+    return filled
+
+def sku_stats():
+    conn = get_db_connection()
+    try:
+        used = conn.execute('SELECT COUNT(*) FROM sku_used').fetchone()[0]
+    finally:
+        conn.close()
+    return {"used": used, **_counts.snapshot()}
@@ -0,0 +1,223 @@
+import io
+import os
+import csv
+import json
+import zlib
+import hashlib
+
+from database import get_db_connection, Counters, in_chunks
+from pull_cache import content_digest
+
+# Server-side snapshots of the pulled tabs, taken after each successful
+# /sync (replacing the CSV backup the app used to save on every sync).
+#
+# A tab is cut into chunks of rows and each chunk is stored once, zlib
+# compressed, under the digest of its rows (content addressed), so a
+# snapshot only adds the chunks that changed since earlier ones. Chunk
+# boundaries fall after rows whose id hashes to 0 mod SNAPSHOT_CHUNK_ROWS
+# (at most 4x that many rows per chunk), so they follow the rows: an edited,
+# added or removed row changes its own chunk and leaves the others alone.
+# A tab whose values are as in the last snapshot reuses its chunk list
+# without being cut again, and a sync that changed nothing takes no
+# snapshot at all.
+#
+# The last PARTFLOW_SNAPSHOT_KEEP snapshots of each spreadsheet are kept
+# (0 turns snapshots off); chunks no snapshot uses any more go with them.
+# A diff skips the chunks both snapshots share and compares the rest by id.
+
+SNAPSHOT_KEEP = int(os.environ.get('PARTFLOW_SNAPSHOT_KEEP', '100'))
+SNAPSHOT_CHUNK_ROWS = 256
+_MAX_CHUNK_ROWS = SNAPSHOT_CHUNK_ROWS * 4
+
+_counts = Counters("taken", "unchanged", "chunks_written", "chunks_reused", "bytes_written", "pruned")
+
+def _cut(rows):
+    """A tab's rows (no header) in chunks whose boundaries follow the row ids"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        key = str(row[0]) if row else ''
+        if zlib.crc32(key.encode('utf-8')) % SNAPSHOT_CHUNK_ROWS == 0 or len(chunk) >= _MAX_CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
+def _encode(chunk):
+    raw = json.dumps(chunk, separators=(',', ':')).encode('utf-8')
+    return hashlib.blake2b(raw, digest_size=16).hexdigest(), raw
+
+def _store_chunks(conn, rows):
+    """Writes the chunks of rows not stored yet; returns (digests in order, new chunks, new bytes)"""
+    digests, new, new_bytes = [], 0, 0
+    for chunk in _cut(rows):
+        digest, raw = _encode(chunk)
+        digests.append(digest)
+        if conn.execute('SELECT 1 FROM snapshot_chunks WHERE digest = ?', (digest,)).fetchone() is not None: continue
+        data = zlib.compress(raw)
+        conn.execute('INSERT INTO snapshot_chunks (digest, data, row_count) VALUES (?, ?, ?)', (digest, data, len(chunk)))
+        new += 1
+        new_bytes += len(data)
+    return digests, new, new_bytes
+
+def _latest(conn, spreadsheet_id):
+    latest = conn.execute('SELECT id FROM snapshots WHERE spreadsheet_id = ? ORDER BY id DESC LIMIT 1', (spreadsheet_id,)).fetchone()
+    if latest is None: return None, {}
+    tabs = conn.execute('SELECT tab, digest FROM snapshot_tabs WHERE snapshot_id = ?', (latest['id'],)).fetchall()
+    return latest['id'], {r['tab']: r['digest'] for r in tabs}
+
+def take_snapshot(spreadsheet_id, values):
+    """Snapshots the pulled tab values ({tab: rows, header first}) unless
+    they are all as in the last snapshot. Returns the new snapshot's id or None."""
+    if SNAPSHOT_KEEP <= 0: return None
+    digests = {tab: content_digest([rows]) for tab, rows in values.items()}
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        previous, previous_digests = _latest(conn, spreadsheet_id)
+        if previous_digests == digests:
+            conn.rollback()
+            _counts.add("unchanged")
+            return None
+        snapshot_id = conn.execute('INSERT INTO snapshots (spreadsheet_id) VALUES (?)', (spreadsheet_id,)).lastrowid
+        new, new_bytes, reused = 0, 0, 0
+        for tab, rows in values.items():
+            if previous_digests.get(tab) == digests[tab]:
+                conn.execute('''INSERT INTO snapshot_parts (snapshot_id, tab, seq, chunk)
+                                SELECT ?, tab, seq, chunk FROM snapshot_parts WHERE snapshot_id = ? AND tab = ?''',
+                             (snapshot_id, previous, tab))
+                conn.execute('''INSERT INTO snapshot_tabs (snapshot_id, tab, digest, header, row_count)
+                                SELECT ?, tab, digest, header, row_count FROM snapshot_tabs WHERE snapshot_id = ? AND tab = ?''',
+                             (snapshot_id, previous, tab))
+                reused += conn.execute('SELECT COUNT(*) FROM snapshot_parts WHERE snapshot_id = ? AND tab = ?', (snapshot_id, tab)).fetchone()[0]
+                continue
+            header, body = (rows[0] if rows else []), rows[1:]
+            chunks, tab_new, tab_bytes = _store_chunks(conn, body)
+            conn.executemany('INSERT INTO snapshot_parts (snapshot_id, tab, seq, chunk) VALUES (?, ?, ?, ?)',
+                             [(snapshot_id, tab, seq, digest) for seq, digest in enumerate(chunks)])
+            conn.execute('INSERT INTO snapshot_tabs (snapshot_id, tab, digest, header, row_count) VALUES (?, ?, ?, ?, ?)',
+                         (snapshot_id, tab, digests[tab], json.dumps(header), len(body)))
+            new, new_bytes, reused = new + tab_new, new_bytes + tab_bytes, reused + len(chunks) - tab_new
+        conn.execute('UPDATE snapshots SET new_chunks = ?, new_bytes = ? WHERE id = ?', (new, new_bytes, snapshot_id))
+        pruned = _prune(conn, spreadsheet_id)
+        conn.commit()
+    finally:
+        conn.close()
+    _counts.add("taken")
+    _counts.add("chunks_written", new)
+    _counts.add("chunks_reused", reused)
+    _counts.add("bytes_written", new_bytes)
+    _counts.add("pruned", pruned)
+    return snapshot_id
+
+def _prune(conn, spreadsheet_id):
+    """Drops all but the last SNAPSHOT_KEEP snapshots, and the chunks only they used"""
+    old = [r['id'] for r in conn.execute('SELECT id FROM snapshots WHERE spreadsheet_id = ? ORDER BY id DESC LIMIT -1 OFFSET ?',
+                                         (spreadsheet_id, SNAPSHOT_KEEP))]
+    if not old: return 0
+    for table, column in (('snapshot_parts', 'snapshot_id'), ('snapshot_tabs', 'snapshot_id'), ('snapshots', 'id')):
+        conn.executemany(f'DELETE FROM {table} WHERE {column} = ?', [(i,) for i in old])
+    conn.execute('DELETE FROM snapshot_chunks WHERE NOT EXISTS (SELECT 1 FROM snapshot_parts WHERE snapshot_parts.chunk = snapshot_chunks.digest)')
+    return len(old)
+
+def list_snapshots(spreadsheet_id, limit=50):
+    """Newest first: {id, created_at, tabs: {tab: rows}, new_chunks, new_bytes}"""
+    conn = get_db_connection()
+    try:
+        snaps = conn.execute('SELECT id, created_at, new_chunks, new_bytes FROM snapshots WHERE spreadsheet_id = ? ORDER BY id DESC LIMIT ?',
+                             (spreadsheet_id, limit)).fetchall()
+        tabs = {}
+        if snaps:
+            for chunk, placeholders in in_chunks([s['id'] for s in snaps]):
+                for r in conn.execute(f"SELECT snapshot_id, tab, row_count FROM snapshot_tabs WHERE snapshot_id IN ({placeholders})", chunk):
+                    tabs.setdefault(r['snapshot_id'], {})[r['tab']] = r['row_count']
+    finally:
+        conn.close()
+    return [{"id": s['id'], "created_at": s['created_at'], "tabs": tabs.get(s['id'], {}),
+             "new_chunks": s['new_chunks'], "new_bytes": s['new_bytes']} for s in snaps]
+
+def _tab(conn, spreadsheet_id, snapshot_id, tab):
+    """(header, [chunk digests]) of a snapshot's tab, or None"""
+    found = conn.execute('''SELECT t.header FROM snapshot_tabs t JOIN snapshots s ON s.id = t.snapshot_id
+                            WHERE s.spreadsheet_id = ? AND t.snapshot_id = ? AND t.tab = ?''', (spreadsheet_id, snapshot_id, tab)).fetchone()
+    if found is None: return None
+    chunks = [r['chunk'] for r in conn.execute('SELECT chunk FROM snapshot_parts WHERE snapshot_id = ? AND tab = ? ORDER BY seq', (snapshot_id, tab))]
+    return json.loads(found['header']), chunks
+
+def _load_chunk(digest):
+    # A connection per chunk: a streamed download may be read from more than one thread
+    conn = get_db_connection()
+    try:
+        data = conn.execute('SELECT data FROM snapshot_chunks WHERE digest = ?', (digest,)).fetchone()['data']
+    finally:
+        conn.close()
+    return json.loads(zlib.decompress(data))
+
+def snapshot_tabs(spreadsheet_id, snapshot_id):
+    """The tabs a snapshot has, or None if it is not one of the spreadsheet's"""
+    conn = get_db_connection()
+    try:
+        if conn.execute('SELECT 1 FROM snapshots WHERE spreadsheet_id = ? AND id = ?', (spreadsheet_id, snapshot_id)).fetchone() is None: return None
+        return [r['tab'] for r in conn.execute('SELECT tab FROM snapshot_tabs WHERE snapshot_id = ? ORDER BY tab', (snapshot_id,))]
+    finally:
+        conn.close()
+
+def _csv_text(rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue()
+
+def snapshot_csv(spreadsheet_id, snapshot_id, tab):
+    """A generator of the tab's CSV text (header first), a chunk at a time, or None"""
+    conn = get_db_connection()
+    try:
+        found = _tab(conn, spreadsheet_id, snapshot_id, tab)
+    finally:
+        conn.close()
+    if found is None: return None
+    header, chunks = found
+
+    def lines():
+        yield _csv_text([header])
+        for digest in chunks: yield _csv_text(_load_chunk(digest))
+    return lines()
+
+def _rows_by_id(chunks, skip):
+    rows = {}
+    for digest in chunks:
+        if digest in skip: continue
+        for row in _load_chunk(digest):
+            if row and row[0] not in (None, ''): rows[str(row[0])] = row
+    return rows
+
+def diff_snapshots(spreadsheet_id, from_id, to_id, tabs=None):
+    """Row-level changes from one snapshot to another, per tab (by id):
+    {tab: {header, added, removed, changed: [{id, before, after}]}}, or None
+    if either snapshot is not one of the spreadsheet's"""
+    old_tabs, new_tabs = snapshot_tabs(spreadsheet_id, from_id), snapshot_tabs(spreadsheet_id, to_id)
+    if old_tabs is None or new_tabs is None: return None
+    diff = {}
+    conn = get_db_connection()
+    try:
+        for tab in tabs or sorted(set(old_tabs) | set(new_tabs)):
+            old, new = _tab(conn, spreadsheet_id, from_id, tab) or ([], []), _tab(conn, spreadsheet_id, to_id, tab) or ([], [])
+            # Chunks in both hold the same rows on both sides
+            shared = set(old[1]) & set(new[1])
+            before, after = _rows_by_id(old[1], shared), _rows_by_id(new[1], shared)
+            diff[tab] = {
+                "header": new[0] or old[0],
+                "added": [row for key, row in after.items() if key not in before],
+                "removed": [row for key, row in before.items() if key not in after],
+                "changed": [{"id": key, "before": before[key], "after": row} for key, row in after.items() if key in before and before[key] != row],
+            }
+    finally:
+        conn.close()
+    return diff
+
+def snapshot_stats():
+    conn = get_db_connection()
+    try:
+        chunks = conn.execute('SELECT COUNT(*) AS n, COALESCE(SUM(LENGTH(data)), 0) AS bytes FROM snapshot_chunks').fetchone()
+        snaps = conn.execute('SELECT COUNT(*) FROM snapshots').fetchone()[0]
+    finally:
+        conn.close()
+    return {"keep": SNAPSHOT_KEEP, "snapshots": snaps, "chunks": chunks['n'], "stored_bytes": chunks['bytes'], **_counts.snapshot()}
@@ -0,0 +1,285 @@
+import os
+import time
+import contextlib
+
+from database import get_db_connection, Counters, in_chunks, to_int
+
+# Server-side stock of every item, so reps selling the same part at the same
+# time cannot oversell it and the last device to push does not set the stock.
+#
+# stock_levels holds each item's on-hand and reserved quantities; every change
+# to them is appended to stock_ledger (kind, on-hand delta, reserved delta) in
+# the same transaction, so the levels are the ledger summed. An item's level
+# starts at the Stock Qty the spreadsheet had when the ledger first saw it
+# (a 'baseline' entry); from then on the ledger, not pushed Inventory rows,
+# decides the stock (an overwrite push re-baselines).
+#
+# Reservations are per order (any reference the client picks) and per item,
+# and always name the quantities the order wants in total, so a retried or
+# replayed call changes nothing:
+#
+#   reserve  hold the quantities not yet committed, if available (all lines or none)
+#   commit   take the order's quantities out of stock and drop its holds; may
+#            go negative (the sale already happened, e.g. offline) and reports it
+#   release  give back everything the order held or took (cancelled or failed)
+#
+# Holds not committed within PARTFLOW_STOCK_HOLD_SECONDS lapse. Writes take
+# SQLite's write lock up front (BEGIN IMMEDIATE) and check availability in the
+# UPDATE itself, so concurrent reservations queue on the lock for the length
+# of a few indexed statements instead of racing.
+
+STOCK_CELL = 8  # 'Stock Qty' in INVENTORY_HEADERS
+DEFAULT_HOLD_SECONDS = float(os.environ.get('PARTFLOW_STOCK_HOLD_SECONDS', '900'))
+MAX_HOLD_SECONDS = 24 * 3600
+_counts = Counters("reserved", "refused", "committed", "released", "adjusted", "expired")
+
+def _connect():
+    conn = get_db_connection()
+    # Transactions are opened by hand (BEGIN IMMEDIATE)
+    conn.isolation_level = None
+    conn.execute('PRAGMA busy_timeout = 10000')
+    return conn
+
+@contextlib.contextmanager
+def _write():
+    """A transaction holding the write lock from its first statement; committed
+    on exit unless it was rolled back inside"""
+    conn = _connect()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        yield conn
+        if conn.in_transaction: conn.execute('COMMIT')
+    except BaseException:
+        if conn.in_transaction: conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+def quantities(lines):
+    """{item_id: total quantity} from [{item_id, quantity}]"""
+    if not isinstance(lines, list): raise ValueError("lines must be a list of {item_id, quantity}")
+    wanted = {}
+    for i, line in enumerate(lines):
+        if not isinstance(line, dict) or not line.get('item_id'): raise ValueError(f"lines[{i}]: item_id is required")
+        qty = line.get('quantity')
+        if isinstance(qty, bool) or not isinstance(qty, (int, float)) or qty != int(qty) or qty < 0:
+            raise ValueError(f"lines[{i}]: quantity must be a whole number, 0 or more")
+        item_id = str(line['item_id'])
+        wanted[item_id] = wanted.get(item_id, 0) + int(qty)
+    return wanted
+
+def _select_in(conn, sql, spreadsheet_id, keys, *params):
+    for chunk, placeholders in in_chunks(keys):
+        yield from conn.execute(sql.format(placeholders), (spreadsheet_id, *params, *chunk))
+
+def _levels(conn, spreadsheet_id, item_ids):
+    return {r['item_id']: r for r in _select_in(
+        conn, 'SELECT item_id, on_hand, reserved FROM stock_levels WHERE spreadsheet_id = ? AND item_id IN ({})', spreadsheet_id, item_ids)}
+
+def _holds(conn, spreadsheet_id, ref):
+    rows = conn.execute('SELECT item_id, held, committed FROM stock_holds WHERE spreadsheet_id = ? AND ref = ?', (spreadsheet_id, ref))
+    return {r['item_id']: (r['held'], r['committed']) for r in rows}
+
+def _journal(conn, spreadsheet_id, item_id, ref, kind, on_hand_delta=0, reserved_delta=0):
+    conn.execute('INSERT INTO stock_ledger (spreadsheet_id, item_id, ref, kind, on_hand_delta, reserved_delta) VALUES (?, ?, ?, ?, ?, ?)',
+                 (spreadsheet_id, item_id, ref, kind, on_hand_delta, reserved_delta))
+
+def _expire(conn, spreadsheet_id, item_ids, now):
+    """Lets lapsed holds on the given items go"""
+    lapsed = [r for r in _select_in(
+        conn, 'SELECT ref, item_id, held FROM stock_holds WHERE spreadsheet_id = ? AND held > 0 AND expires_at < ? AND item_id IN ({})',
+        spreadsheet_id, item_ids, now)]
+    for r in lapsed:
+        conn.execute('UPDATE stock_levels SET reserved = reserved - ? WHERE spreadsheet_id = ? AND item_id = ?', (r['held'], spreadsheet_id, r['item_id']))
+        conn.execute('UPDATE stock_holds SET held = 0, expires_at = NULL WHERE spreadsheet_id = ? AND ref = ? AND item_id = ?',
+                     (spreadsheet_id, r['ref'], r['item_id']))
+        _journal(conn, spreadsheet_id, r['item_id'], r['ref'], 'expire', reserved_delta=-r['held'])
+    if lapsed:
+        conn.execute('DELETE FROM stock_holds WHERE spreadsheet_id = ? AND held = 0 AND committed = 0', (spreadsheet_id,))
+        _counts.add("expired", len(lapsed))
+
+def _stock(levels):
+    return [{"item_id": item_id, "on_hand": r['on_hand'], "reserved": r['reserved'], "available": r['on_hand'] - r['reserved']}
+            for item_id, r in levels.items()]
+
+def reserve(spreadsheet_id, ref, lines, hold_seconds=None, now=None):
+    """Holds what `ref` wants of each item beyond what it already committed.
+    Nothing is held when any item is short (listed in "shortfalls")."""
+    wanted = quantities(lines)
+    hold_seconds = DEFAULT_HOLD_SECONDS if hold_seconds is None else float(hold_seconds)
+    if not 0 < hold_seconds <= MAX_HOLD_SECONDS: raise ValueError(f"holdSeconds must be between 0 and {MAX_HOLD_SECONDS}")
+    now = time.time() if now is None else now
+    with _write() as conn:
+        holds = _holds(conn, spreadsheet_id, ref)
+        items = set(wanted) | set(holds)
+        _expire(conn, spreadsheet_id, items, now)
+        holds = _holds(conn, spreadsheet_id, ref)
+        levels = _levels(conn, spreadsheet_id, items)
+        shortfalls = []
+        for item_id in sorted(items):
+            held, committed = holds.get(item_id, (0, 0))
+            hold = max(wanted.get(item_id, 0) - committed, 0)
+            if item_id not in levels:
+                if hold: shortfalls.append({"item_id": item_id, "requested": wanted[item_id], "available": None})
+                continue
+            if hold == held: continue
+            # The availability check is part of the write
+            cur = conn.execute('UPDATE stock_levels SET reserved = reserved + ? WHERE spreadsheet_id = ? AND item_id = ? AND on_hand - reserved >= ?',
+                               (hold - held, spreadsheet_id, item_id, hold - held))
+            if cur.rowcount == 0:
+                level = levels[item_id]
+                shortfalls.append({"item_id": item_id, "requested": wanted[item_id], "available": max(level['on_hand'] - level['reserved'] + held, 0)})
+                continue
+            _journal(conn, spreadsheet_id, item_id, ref, 'reserve', reserved_delta=hold - held)
+            conn.execute('''INSERT INTO stock_holds (spreadsheet_id, ref, item_id, held, committed, expires_at) VALUES (?, ?, ?, ?, 0, ?)
+                            ON CONFLICT (spreadsheet_id, ref, item_id) DO UPDATE SET held = excluded.held, expires_at = excluded.expires_at''',
+                         (spreadsheet_id, ref, item_id, hold, now + hold_seconds))
+        if shortfalls:
+            conn.execute('ROLLBACK')
+            _counts.add("refused")
+            return {"order_id": ref, "shortfalls": shortfalls}
+        conn.execute('UPDATE stock_holds SET expires_at = ? WHERE spreadsheet_id = ? AND ref = ? AND held > 0', (now + hold_seconds, spreadsheet_id, ref))
+        conn.execute('DELETE FROM stock_holds WHERE spreadsheet_id = ? AND ref = ? AND held = 0 AND committed = 0', (spreadsheet_id, ref))
+        levels = _levels(conn, spreadsheet_id, items)
+    _counts.add("reserved")
+    return {"order_id": ref, "expires_at": now + hold_seconds, "shortfalls": [], "stock": _stock(levels)}
+
+def _settle(spreadsheet_id, ref, wanted, kind):
+    """Makes `ref` have taken exactly `wanted` ({item_id: qty}, None = what it holds) and hold nothing"""
+    with _write() as conn:
+        holds = _holds(conn, spreadsheet_id, ref)
+        if wanted is None: wanted = {item_id: held + committed for item_id, (held, committed) in holds.items()}
+        items = set(wanted) | set(holds)
+        levels = _levels(conn, spreadsheet_id, items)
+        untracked = sorted(item_id for item_id in items if item_id not in levels)
+        for item_id in items:
+            if item_id not in levels: continue
+            held, committed = holds.get(item_id, (0, 0))
+            take = wanted.get(item_id, 0) - committed
+            if not take and not held: continue
+            conn.execute('UPDATE stock_levels SET on_hand = on_hand - ?, reserved = reserved - ? WHERE spreadsheet_id = ? AND item_id = ?',
+                         (take, held, spreadsheet_id, item_id))
+            _journal(conn, spreadsheet_id, item_id, ref, kind, on_hand_delta=-take, reserved_delta=-held)
+        conn.execute('DELETE FROM stock_holds WHERE spreadsheet_id = ? AND ref = ?', (spreadsheet_id, ref))
+        conn.executemany('INSERT INTO stock_holds (spreadsheet_id, ref, item_id, held, committed) VALUES (?, ?, ?, 0, ?)',
+                         [(spreadsheet_id, ref, item_id, qty) for item_id, qty in wanted.items() if qty and item_id in levels])
+        levels = _levels(conn, spreadsheet_id, items)
+    return {"order_id": ref, "stock": _stock(levels), "untracked": untracked,
+            "oversold": sorted(item_id for item_id, r in levels.items() if r['on_hand'] < 0)}
+
+def commit(spreadsheet_id, ref, lines=None):
+    """Takes the order's quantities (lines, else what it holds) out of stock"""
+    result = _settle(spreadsheet_id, ref, None if lines is None else quantities(lines), 'commit')
+    _counts.add("committed")
+    return result
+
+def release(spreadsheet_id, ref):
+    """Returns everything the order held or took"""
+    result = _settle(spreadsheet_id, ref, {}, 'release')
+    _counts.add("released")
+    return result
+
+def adjust(spreadsheet_id, adjustment_id, item_id, delta, kind='adjust'):
+    """Adds delta to an item's stock once per adjustment_id (restock, damage, correction).
+    None when the item has no stock level yet."""
+    if isinstance(delta, bool) or not isinstance(delta, (int, float)) or delta != int(delta):
+        raise ValueError("delta must be a whole number")
+    with _write() as conn:
+        level = _levels(conn, spreadsheet_id, [str(item_id)]).get(str(item_id))
+        if level is None: return None
+        applied = _apply_adjustment(conn, spreadsheet_id, adjustment_id, str(item_id), int(delta))
+        levels = _levels(conn, spreadsheet_id, [str(item_id)])
+    if applied: _counts.add("adjusted")
+    return {"applied": applied, "stock": _stock(levels)}
+
+def _apply_adjustment(conn, spreadsheet_id, adjustment_id, item_id, delta):
+    applied = conn.execute('''INSERT OR IGNORE INTO stock_ledger (spreadsheet_id, item_id, ref, kind, on_hand_delta, reserved_delta)
+                              VALUES (?, ?, ?, 'adjust', ?, 0)''', (spreadsheet_id, item_id, adjustment_id, delta)).rowcount
+    if applied:
+        conn.execute('UPDATE stock_levels SET on_hand = on_hand + ? WHERE spreadsheet_id = ? AND item_id = ?', (delta, spreadsheet_id, item_id))
+    return bool(applied)
+
+def stock_levels(spreadsheet_id, item_ids, now=None):
+    """Current levels of the given items (lapsed holds let go first)"""
+    now = time.time() if now is None else now
+    item_ids = [str(i) for i in item_ids]
+    with _write() as conn:
+        _expire(conn, spreadsheet_id, item_ids, now)
+        levels = _levels(conn, spreadsheet_id, item_ids)
+    return _stock(levels)
+
+# --- /sync ---
+
+def take_adjustments(spreadsheet_id, rows):
+    """Applies StockAdjustments log rows (id, item, type, qty, stock change, ...)
+    in one transaction, each once. An item the ledger has not seen yet starts
+    from its pushed row, which already has the change: the adjustment is
+    recorded as applied with none. Returns how many changed stock."""
+    entries = [(str(r[0]), str(r[1]), to_int(r[4])) for r in rows if r and len(r) > 4 and r[0] not in (None, '') and r[1] not in (None, '')]
+    if not entries: return 0
+    with _write() as conn:
+        levels = _levels(conn, spreadsheet_id, {item_id for _, item_id, _ in entries})
+        applied = 0
+        for adjustment_id, item_id, delta in entries:
+            tracked = item_id in levels
+            if _apply_adjustment(conn, spreadsheet_id, adjustment_id, item_id, delta if tracked else 0) and tracked: applied += 1
+    _counts.add("adjusted", applied)
+    return applied
+
+def take_pushed_stock(spreadsheet_id, rows, rebaseline=False):
+    """Pushed Inventory rows get the ledger's stock (in place). Items the ledger
+    has not seen start from their pushed stock; rebaseline (overwrite pushes)
+    sets every pushed item's stock from its row instead."""
+    by_id = {str(r[0]): r for r in rows if r and r[0] not in (None, '')}
+    if not by_id: return
+    with _write() as conn:
+        levels = _levels(conn, spreadsheet_id, by_id)
+        for item_id, row in by_id.items():
+            pushed = to_int(row[STOCK_CELL])
+            level = levels.get(item_id)
+            if level is None or (rebaseline and level['on_hand'] != pushed):
+                _baseline(conn, spreadsheet_id, item_id, pushed, level)
+            else:
+                row[STOCK_CELL] = level['on_hand']
+
+def _baseline(conn, spreadsheet_id, item_id, on_hand, level):
+    conn.execute('''INSERT INTO stock_levels (spreadsheet_id, item_id, on_hand, reserved) VALUES (?, ?, ?, 0)
+                    ON CONFLICT (spreadsheet_id, item_id) DO UPDATE SET on_hand = excluded.on_hand''', (spreadsheet_id, item_id, on_hand))
+    _journal(conn, spreadsheet_id, item_id, None, 'baseline', on_hand_delta=on_hand - (level['on_hand'] if level else 0))
+
+def overlay_stock(spreadsheet_id, rows):
+    """Sets the Stock Qty of pulled Inventory rows (header first) to the ledger's,
+    in place, and starts the ledger for items it has not seen. Returns the rows
+    whose stock the sheet has wrong, to be written back."""
+    stale, unseen = [], []
+    conn = get_db_connection()
+    try:
+        on_hand = dict(conn.execute('SELECT item_id, on_hand FROM stock_levels WHERE spreadsheet_id = ?', (spreadsheet_id,)).fetchall())
+    finally:
+        conn.close()
+    for row in rows[1:]:
+        if not row or row[0] in (None, ''): continue
+        item_id = str(row[0])
+        if item_id not in on_hand:
+            unseen.append(item_id)
+            on_hand[item_id] = to_int(row[STOCK_CELL] if len(row) > STOCK_CELL else '')
+        elif len(row) <= STOCK_CELL or to_int(row[STOCK_CELL]) != on_hand[item_id]:
+            row.extend([''] * (STOCK_CELL + 1 - len(row)))
+            row[STOCK_CELL] = on_hand[item_id]
+            stale.append(row)
+    if unseen:
+        with _write() as conn:
+            for item_id in unseen:
+                cur = conn.execute('INSERT OR IGNORE INTO stock_levels (spreadsheet_id, item_id, on_hand, reserved) VALUES (?, ?, ?, 0)',
+                                   (spreadsheet_id, item_id, on_hand[item_id]))
+                if cur.rowcount: _journal(conn, spreadsheet_id, item_id, None, 'baseline', on_hand_delta=on_hand[item_id])
+    return stale
+
+def stock_stats():
+    conn = get_db_connection()
+    try:
+        items = conn.execute('SELECT COUNT(*) FROM stock_levels').fetchone()[0]
+        holds = conn.execute('SELECT COUNT(*) FROM stock_holds WHERE held > 0').fetchone()[0]
+    finally:
+        conn.close()
+    return {"items": items, "active_holds": holds, **_counts.snapshot()}
@@ -0,0 +1,603 @@
+import os
+import json
+import sqlite3
+import threading
+
+import row_index
+from database import DB_PATH, in_chunks
+from migrations import SCHEMA_VERSION_KEY
+
+# Where the sync engine keeps its tabs. A backend stores named tabs of rows
+# (lists of cell values, row 1 the header) per spreadsheet id and offers the
+# few operations /sync and the other routes need: batched reads, reads and
+# cell writes by id, upsert by id, replace, append and clear, plus each tab's
+# schema version (migrations.py).
+# Two are built in:
+#
+#   sheets  the spreadsheet itself (Google Sheets API); the default
+#   sqlite  a local SQLite file, no Google dependency
+#
+# The backend for a spreadsheet id is, in order: the one named by an
+# "<backend>:" prefix of the id (e.g. "sqlite:colombo-branch"), the one
+# PARTFLOW_STORAGE_ROUTES maps it to ("id1=sqlite,id2=sheets"), else the
+# deployment's PARTFLOW_STORAGE_BACKEND. More can be added with
+# register_backend(name, factory).
+
+DEFAULT_BACKEND = os.environ.get('PARTFLOW_STORAGE_BACKEND', 'sheets')
+STORAGE_ROUTES = dict(pair.split('=', 1) for pair in os.environ.get('PARTFLOW_STORAGE_ROUTES', '').split(',') if '=' in pair)
+SQLITE_STORE_PATH = os.environ.get('PARTFLOW_SQLITE_STORE_PATH') or DB_PATH
+APPEND_CHUNK_ROWS = 5000
+
+def column_letter(n):
+    """1 -> A, 26 -> Z, 27 -> AA"""
+    letters = ''
+    while n > 0:
+        n, rem = divmod(n - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+def merge_sheet_rows(sheet_name, rows, headers, data, id_column_index=0):
+    """New contents of a tab: the rows read from it with `data` upserted by id
+    and row 1 set to `headers`. The layout itself is the schema migrations' job."""
+    existing_width = max((len(r) for r in rows), default=0)
+    rows = list(rows) if rows else [headers]
+
+    # Map Data
+    if data:
+        id_map = {str(row[id_column_index]): i for i, row in enumerate(rows) if i > 0 and len(row) > id_column_index}
+        for new_row in data:
+            nid = str(new_row[id_column_index])
+            if nid in id_map: rows[id_map[nid]] = new_row
+            else: rows.append(new_row)
+
+    rows[0] = headers
+    # Overwrite in place, blanking cells the old rows had beyond the new ones.
+    # Clearing the tab first left it empty whenever the following write failed.
+    return [list(r) + [''] * (existing_width - len(r)) if len(r) < existing_width else r for r in rows]
+
+def rows_by_id(rows, ids):
+    """{id: (row number, row)} of a tab's rows (header first) whose id is in ids; the last duplicate wins"""
+    return {str(row[0]): (n, row) for n, row in enumerate(rows[1:], 2) if row and str(row[0]) in ids}
+
+def row_ranges(tab, rows, width):
+    """A1 ranges of whole rows, by row number"""
+    return [f"'{tab}'!A{n}:{column_letter(width)}{n}" for n in rows]
+
+def rows_at(located, batch_result):
+    """{id: (row number, row)} from a batchGet of row_ranges(tab, located.values(), ...),
+    or None when a row no longer starts with the id the index has for it"""
+    value_ranges = [vr.get('values', []) for vr in batch_result.get('valueRanges', [])]
+    if len(value_ranges) != len(located): return None
+    found = {}
+    for (key, n), values in zip(located.items(), value_ranges):
+        row = values[0] if values else []
+        if not row or str(row[0]) != key: return None
+        found[key] = (n, row)
+    return found
+
+def cell_ranges(tab, cells):
+    """batchUpdate data for [(row number, column index, value)]: one range per run of adjacent cells in a row"""
+    data, last = [], None
+    for n, col, value in sorted(cells, key=lambda c: (c[0], c[1])):
+        if last == (n, col - 1): data[-1]['values'][0].append(value)
+        else: data.append({'range': f"'{tab}'!{column_letter(col + 1)}{n}", 'values': [[value]]})
+        last = (n, col)
+    return data
+
+def row_runs(numbers):
+    """[(first, last)] of each run of consecutive row numbers, ascending"""
+    runs = []
+    for n in sorted(numbers):
+        if runs and n == runs[-1][1] + 1: runs[-1][1] = n
+        else: runs.append([n, n])
+    return [tuple(r) for r in runs]
+
+def rewritten_rows(headers, rows, current):
+    """headers + rows, each padded to the widest current row so writing them
+    over the tab in place leaves no old cells behind"""
+    width = max([len(headers)] + [len(r) for r in current])
+    return [list(r) + [''] * (width - len(r)) for r in [headers] + list(rows)]
+
+class StorageBackend:
+    """A range is a tab name, or (tab name, number of columns) to read only
+    the leading columns. Rows come back the way Sheets returns them: strings,
+    trailing empty cells dropped."""
+
+    name = None
+
+    def ensure_tabs(self, spreadsheet_id, tabs, headers=None):
+        """Creates the missing tabs; headers ({tab: row}) is written to the new ones"""
+        raise NotImplementedError
+
+    def read_ranges(self, spreadsheet_id, ranges):
+        """[rows] per range, in one round trip where the backend allows"""
+        raise NotImplementedError
+
+    def replace_rows(self, spreadsheet_id, tab, headers, rows):
+        """The tab becomes headers + rows"""
+        raise NotImplementedError
+
+    def rewrite_rows(self, spreadsheet_id, tab, headers, rows, current):
+        """The tab becomes headers + rows without being emptied first, so a
+        write that fails halfway leaves rows behind. current: the tab's rows
+        (header included) as just read."""
+        self.replace_rows(spreadsheet_id, tab, headers, rows)
+
+    def append_rows(self, spreadsheet_id, tab, rows):
+        raise NotImplementedError
+
+    def delete_rows(self, spreadsheet_id, tab, ids, id_column_index=0):
+        """Removes the rows whose id_column_index cell is in ids, leaving the others as they are"""
+        ids = {str(i) for i in ids}
+        if not ids: return
+        current = self.read_ranges(spreadsheet_id, [tab])[0]
+        kept = [r for r in current[1:] if not (len(r) > id_column_index and str(r[id_column_index]) in ids)]
+        if len(kept) < len(current) - 1: self.replace_rows(spreadsheet_id, tab, current[0], kept)
+
+    def clear_rows(self, spreadsheet_id, tab, start_row=2):
+        """Empties the tab from start_row (1-based) down"""
+        raise NotImplementedError
+
+    def schema_versions(self, spreadsheet_id):
+        """{tab: schema version}; tabs never stamped are left out"""
+        raise NotImplementedError
+
+    def set_schema_versions(self, spreadsheet_id, versions):
+        raise NotImplementedError
+
+    def read_tabs(self, spreadsheet_id, tabs):
+        return dict(zip(tabs, self.read_ranges(spreadsheet_id, tabs)))
+
+    def read_rows_by_id(self, spreadsheet_id, tab, ids, width=None):
+        """{id: (row number, row)} of the rows with those ids (first cell), up to width columns"""
+        return rows_by_id(self.read_ranges(spreadsheet_id, [(tab, width) if width else tab])[0], ids)
+
+    def write_cells(self, spreadsheet_id, tab, cells):
+        """Sets single cells of existing rows: [(row number, column index, value)]"""
+        rows = [list(r) for r in self.read_ranges(spreadsheet_id, [tab])[0]]
+        for n, col, value in cells:
+            row = rows[n - 1]
+            row.extend([''] * (col + 1 - len(row)))
+            row[col] = value
+        self.replace_rows(spreadsheet_id, tab, rows[0], rows[1:])
+
+    def upsert_rows(self, spreadsheet_id, tab, headers, rows, id_column_index=0):
+        """Replaces the rows whose id is in `rows` and appends the others"""
+        if not rows: return
+        current = self.read_ranges(spreadsheet_id, [tab])[0]
+        self.replace_rows(spreadsheet_id, tab, headers, merge_sheet_rows(tab, current, headers, rows, id_column_index)[1:])
+
+class SheetsBackend(StorageBackend):
+    """service: a googleapiclient Sheets service (guarded and traced by the caller).
+    Upserts go through the row index (row_index.py) once a tab is indexed."""
+
+    name = 'sheets'
+
+    def __init__(self, service):
+        self.service = service
+        self._catalogs = {}
+
+    def _values(self):
+        return self.service.spreadsheets().values()
+
+    def _catalog(self, spreadsheet_id, refresh=False):
+        if refresh or spreadsheet_id not in self._catalogs:
+            spreadsheet = self.service.spreadsheets().get(spreadsheetId=spreadsheet_id, fields=SHEET_FIELDS).execute()
+            self._catalogs[spreadsheet_id] = sheet_catalog(spreadsheet)
+        return self._catalogs[spreadsheet_id]
+
+    def ensure_tabs(self, spreadsheet_id, tabs, headers=None):
+        catalog = self._catalog(spreadsheet_id, refresh=True)
+        missing = [tab for tab in tabs if tab not in catalog]
+        if not missing: return []
+        body = {'requests': [{'addSheet': {'properties': {'title': tab}}} for tab in missing]}
+        add_to_catalog(catalog, self.service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute())
+        for tab in missing: row_index.forget(spreadsheet_id, tab)
+        data = [{'range': f"'{tab}'!A1", 'values': [headers[tab]]} for tab in missing if headers and tab in headers]
+        if data:
+            self._values().batchUpdate(spreadsheetId=spreadsheet_id, body={'valueInputOption': 'RAW', 'data': data}).execute()
+        return missing
+
+    def read_ranges(self, spreadsheet_id, ranges):
+        a1 = [f"'{r[0]}'!A:{column_letter(r[1])}" if isinstance(r, tuple) else f"'{r}'!A:Z" for r in ranges]
+        result = self._values().batchGet(spreadsheetId=spreadsheet_id, ranges=a1).execute()
+        value_ranges = [vr.get('values', []) for vr in result.get('valueRanges', [])]
+        return value_ranges + [[]] * (len(ranges) - len(value_ranges))
+
+    def upsert_rows(self, spreadsheet_id, tab, headers, rows, id_column_index=0):
+        if not rows: return
+        with row_index.tab_lock(spreadsheet_id, tab):
+            self._upsert(spreadsheet_id, tab, headers, rows, id_column_index)
+
+    def _upsert(self, spreadsheet_id, tab, headers, rows, id_column_index):
+        plan = row_index.plan_upsert(spreadsheet_id, tab, headers, rows) if id_column_index == 0 else None
+        if plan is not None:
+            checked = self._values().batchGet(spreadsheetId=spreadsheet_id, ranges=plan.ranges).execute()
+            if plan.matches(checked):
+                self._values().batchUpdate(spreadsheetId=spreadsheet_id, body=plan.body).execute()
+                plan.commit()
+                return
+            plan.drifted()
+        try:
+            current = self._values().get(spreadsheetId=spreadsheet_id, range=f"'{tab}'!A1:Z").execute().get('values', [])
+        except Exception as e:
+            # Only a missing/unreadable tab (HttpError 400) starts empty; anything
+            # else (429, 5xx) must not fall through to the rewrite below
+            if getattr(getattr(e, 'resp', None), 'status', None) != 400: raise
+            current = []
+        existing_rows = len(current)
+        merged = merge_sheet_rows(tab, current, headers, rows, id_column_index)
+        self._values().update(spreadsheetId=spreadsheet_id, range=f"'{tab}'!A1",
+                              valueInputOption='USER_ENTERED', body={'values': merged}).execute()
+        if existing_rows > len(merged):
+            self._values().clear(spreadsheetId=spreadsheet_id, range=f"'{tab}'!A{len(merged) + 1}:Z").execute()
+        if id_column_index == 0: row_index.rebuild(spreadsheet_id, tab, merged)
+
+    def read_rows_by_id(self, spreadsheet_id, tab, ids, width=None):
+        """The indexed rows in one batchGet; a tab not indexed, an id not in
+        it or a row that moved falls back to reading the tab (and reindexing)"""
+        if not ids: return {}
+        located = row_index.locate(spreadsheet_id, tab, ids)
+        if located is not None:
+            found = rows_at(located, self._values().batchGet(spreadsheetId=spreadsheet_id,
+                                                             ranges=row_ranges(tab, located.values(), width or 26)).execute())
+            if found is not None: return found
+            row_index.drifted(spreadsheet_id, tab)
+        with row_index.tab_lock(spreadsheet_id, tab):
+            current = self._values().get(spreadsheetId=spreadsheet_id, range=f"'{tab}'!A1:Z").execute().get('values', [])
+            row_index.rebuild(spreadsheet_id, tab, current)
+        return rows_by_id(current, ids)
+
+    def write_cells(self, spreadsheet_id, tab, cells):
+        # Rows stay where they are: the index holds
+        body = {'valueInputOption': 'USER_ENTERED', 'data': cell_ranges(tab, cells)}
+        self._values().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
+
+    def replace_rows(self, spreadsheet_id, tab, headers, rows):
+        with row_index.tab_lock(spreadsheet_id, tab):
+            row_index.forget(spreadsheet_id, tab)
+            self._values().update(spreadsheetId=spreadsheet_id, range=f"'{tab}'!A1", valueInputOption="RAW", body={"values": [headers]}).execute()
+            self._values().clear(spreadsheetId=spreadsheet_id, range=f"'{tab}'!A2:Z").execute()
+            self._append(spreadsheet_id, tab, rows)
+            row_index.rebuild(spreadsheet_id, tab, [headers] + list(rows))
+
+    def rewrite_rows(self, spreadsheet_id, tab, headers, rows, current):
+        # One batchUpdate over the rows in place, padded to blank wider old
+        # cells, then the rows left below are cleared
+        values = rewritten_rows(headers, rows, current)
+        with row_index.tab_lock(spreadsheet_id, tab):
+            row_index.forget(spreadsheet_id, tab)
+            self._values().batchUpdate(spreadsheetId=spreadsheet_id, body={'valueInputOption': 'USER_ENTERED',
+                                                                         'data': [{'range': f"'{tab}'!A1", 'values': values}]}).execute()
+            if len(current) > len(values):
+                self._values().clear(spreadsheetId=spreadsheet_id, range=f"'{tab}'!A{len(values) + 1}:Z").execute()
+            row_index.rebuild(spreadsheet_id, tab, [headers] + list(rows))
+
+    def append_rows(self, spreadsheet_id, tab, rows):
+        # Sheets picks the rows; the next upsert reads the tab again
+        with row_index.tab_lock(spreadsheet_id, tab):
+            row_index.forget(spreadsheet_id, tab)
+            self._append(spreadsheet_id, tab, rows)
+
+    def delete_rows(self, spreadsheet_id, tab, ids, id_column_index=0):
+        # One batchUpdate of deleteDimension requests, bottom run first so the
+        # row numbers read still hold; Sheets applies all of them or none
+        ids = {str(i) for i in ids}
+        if not ids: return
+        with row_index.tab_lock(spreadsheet_id, tab):
+            current = self._values().get(spreadsheetId=spreadsheet_id,
+                                         range=f"'{tab}'!A1:{column_letter(id_column_index + 1)}").execute().get('values', [])
+            doomed = [n for n, row in enumerate(current[1:], 2) if len(row) > id_column_index and str(row[id_column_index]) in ids]
+            if not doomed: return
+            catalog = self._catalog(spreadsheet_id)
+            if tab not in catalog: catalog = self._catalog(spreadsheet_id, refresh=True)
+            requests = [{'deleteDimension': {'range': {'sheetId': catalog[tab]['sheetId'], 'dimension': 'ROWS',
+                                                       'startIndex': first - 1, 'endIndex': last}}}
+                        for first, last in reversed(row_runs(doomed))]
+            row_index.forget(spreadsheet_id, tab)
+            self.service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body={'requests': requests}).execute()
+
+    def _append(self, spreadsheet_id, tab, rows):
+        """Appends below the header in APPEND_CHUNK_ROWS pieces, keeping each request body bounded"""
+        for start in range(0, len(rows), APPEND_CHUNK_ROWS):
+            self._values().append(
+                spreadsheetId=spreadsheet_id, range=f"'{tab}'!A2",
+                valueInputOption="USER_ENTERED", body={"values": rows[start:start + APPEND_CHUNK_ROWS]}).execute()
+
+    def clear_rows(self, spreadsheet_id, tab, start_row=2):
+        with row_index.tab_lock(spreadsheet_id, tab):
+            self._values().clear(spreadsheetId=spreadsheet_id, range=f"'{tab}'!A{start_row}:Z").execute()
+            row_index.truncate(spreadsheet_id, tab, start_row)
+
+    def schema_versions(self, spreadsheet_id):
+        return {tab: info['version'] for tab, info in self._catalog(spreadsheet_id).items() if info['version'] is not None}
+
+    def set_schema_versions(self, spreadsheet_id, versions):
+        catalog = self._catalog(spreadsheet_id)
+        body = {'requests': schema_version_requests(catalog, versions)}
+        self.service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
+        for tab, version in versions.items(): catalog[tab]['version'] = version
+
+# Tab titles, ids and developer metadata (the schema version) in one get
+SHEET_FIELDS = 'sheets(properties(sheetId,title),developerMetadata)'
+
+def sheet_catalog(spreadsheet):
+    """{title: {'sheetId', 'version'}} from a spreadsheets.get response"""
+    catalog = {}
+    for sheet in spreadsheet.get('sheets', []):
+        version = None
+        for meta in sheet.get('developerMetadata', []):
+            if meta.get('metadataKey') == SCHEMA_VERSION_KEY:
+                try: version = int(meta.get('metadataValue'))
+                except (TypeError, ValueError): pass
+        props = sheet['properties']
+        catalog[props['title']] = {'sheetId': props.get('sheetId'), 'version': version}
+    return catalog
+
+def add_to_catalog(catalog, reply):
+    """Records the tabs an addSheet batchUpdate created"""
+    for r in reply.get('replies', []):
+        props = r.get('addSheet', {}).get('properties')
+        if props: catalog[props['title']] = {'sheetId': props.get('sheetId'), 'version': None}
+
+def schema_version_requests(catalog, versions):
+    """batchUpdate requests stamping {tab: version} as developer metadata on each tab"""
+    requests = []
+    for tab, version in versions.items():
+        info = catalog[tab]
+        if info['version'] is None:
+            requests.append({'createDeveloperMetadata': {'developerMetadata': {
+                'metadataKey': SCHEMA_VERSION_KEY, 'metadataValue': str(version),
+                'location': {'sheetId': info['sheetId']}, 'visibility': 'DOCUMENT'}}})
+        else:
+            requests.append({'updateDeveloperMetadata': {
+                'dataFilters': [{'developerMetadataLookup': {'metadataKey': SCHEMA_VERSION_KEY,
+                                                             'metadataLocation': {'sheetId': info['sheetId']}}}],
+                'developerMetadata': {'metadataValue': str(version)}, 'fields': 'metadataValue'}})
+    return requests
+
+# --- SQLite ---
+
+def sheet_cell(value):
+    """A cell as Sheets would read it back after a USER_ENTERED write"""
+    if value is None: return ''
+    if isinstance(value, bool): return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer(): return str(int(value))
+    return value if isinstance(value, str) else str(value)
+
+def _sheet_row(row):
+    cells = [sheet_cell(v) for v in row]
+    while cells and cells[-1] == '': cells.pop()
+    return cells
+
+class SqliteBackend(StorageBackend):
+    """Tabs as rows of one table, keyed by (spreadsheet, tab, row number), with
+    the first cell indexed so an upsert touches only the rows it changes.
+    Writes that add or remove rows hold the tab's tab_lock, as the Sheets
+    backend does, so archive.py can keep them out while it moves rows."""
+
+    name = 'sqlite'
+
+    def __init__(self, path=SQLITE_STORE_PATH):
+        self.path = path
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._ready:
+            with self._lock:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS tab_rows (
+                        spreadsheet_id TEXT NOT NULL,
+                        tab TEXT NOT NULL,
+                        row_num INTEGER NOT NULL,
+                        row_key TEXT,
+                        cells TEXT NOT NULL,
+                        PRIMARY KEY (spreadsheet_id, tab, row_num)
+                    ) WITHOUT ROWID
+                ''')
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_tab_rows_key ON tab_rows (spreadsheet_id, tab, row_key)')
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS tab_versions (
+                        spreadsheet_id TEXT NOT NULL,
+                        tab TEXT NOT NULL,
+                        version INTEGER NOT NULL,
+                        PRIMARY KEY (spreadsheet_id, tab)
+                    )
+                ''')
+                conn.commit()
+                self._ready = True
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    @staticmethod
+    def _record(spreadsheet_id, tab, row_num, row):
+        cells = _sheet_row(row)
+        # The header row has no id
+        key = cells[0] if row_num > 1 and cells else None
+        return (spreadsheet_id, tab, row_num, key, json.dumps(cells, separators=(',', ':')))
+
+    def _last_row(self, conn, spreadsheet_id, tab):
+        return conn.execute('SELECT MAX(row_num) FROM tab_rows WHERE spreadsheet_id = ? AND tab = ?',
+                            (spreadsheet_id, tab)).fetchone()[0] or 0
+
+    def _insert(self, conn, records):
+        conn.executemany('INSERT OR REPLACE INTO tab_rows (spreadsheet_id, tab, row_num, row_key, cells) VALUES (?, ?, ?, ?, ?)', records)
+
+    def ensure_tabs(self, spreadsheet_id, tabs, headers=None):
+        conn = self._connect()
+        try:
+            # A tab exists once it has a row
+            present = {r[0] for r in conn.execute('SELECT DISTINCT tab FROM tab_rows WHERE spreadsheet_id = ?', (spreadsheet_id,))}
+            missing = [tab for tab in tabs if tab not in present]
+            self._insert(conn, [self._record(spreadsheet_id, tab, 1, headers[tab]) for tab in missing if headers and tab in headers])
+            conn.commit()
+            return missing
+        finally:
+            conn.close()
+
+    def read_ranges(self, spreadsheet_id, ranges):
+        conn = self._connect()
+        try:
+            out = []
+            for r in ranges:
+                tab, width = r if isinstance(r, tuple) else (r, None)
+                rows = [json.loads(c) for (c,) in conn.execute(
+                    'SELECT cells FROM tab_rows WHERE spreadsheet_id = ? AND tab = ? ORDER BY row_num', (spreadsheet_id, tab))]
+                out.append([row[:width] for row in rows] if width else rows)
+            return out
+        finally:
+            conn.close()
+
+    def upsert_rows(self, spreadsheet_id, tab, headers, rows, id_column_index=0):
+        if not rows: return
+        with row_index.tab_lock(spreadsheet_id, tab):
+            if id_column_index != 0: super().upsert_rows(spreadsheet_id, tab, headers, rows, id_column_index)
+            else: self._upsert(spreadsheet_id, tab, headers, rows)
+
+    def _upsert(self, spreadsheet_id, tab, headers, rows):
+        conn = self._connect()
+        try:
+            # Write lock first: new ids get row numbers no other write is handing out
+            conn.execute('BEGIN IMMEDIATE')
+            records = [self._record(spreadsheet_id, tab, 1, headers)]
+            row_nums = dict(conn.execute('SELECT row_key, row_num FROM tab_rows WHERE spreadsheet_id = ? AND tab = ? AND row_num > 1',
+                                         (spreadsheet_id, tab)).fetchall())
+            next_row = max(self._last_row(conn, spreadsheet_id, tab), 1) + 1
+            for row in rows:
+                key = sheet_cell(row[0]) if row else ''
+                if key not in row_nums:
+                    row_nums[key] = next_row
+                    next_row += 1
+                records.append(self._record(spreadsheet_id, tab, row_nums[key], row))
+            self._insert(conn, records)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def read_rows_by_id(self, spreadsheet_id, tab, ids, width=None):
+        keys, found = list(ids), {}
+        conn = self._connect()
+        try:
+            for chunk, placeholders in in_chunks(keys):
+                for n, cells in conn.execute(f"SELECT row_num, cells FROM tab_rows WHERE spreadsheet_id = ? AND tab = ? AND row_num > 1 "
+                                             f"AND row_key IN ({placeholders}) ORDER BY row_num", [spreadsheet_id, tab] + chunk):
+                    row = json.loads(cells)
+                    found[row[0]] = (n, row[:width] if width else row)
+            return found
+        finally:
+            conn.close()
+
+    def write_cells(self, spreadsheet_id, tab, cells):
+        by_row = {}
+        for n, col, value in cells: by_row.setdefault(n, []).append((col, value))
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            records = []
+            for n, changes in by_row.items():
+                current = conn.execute('SELECT cells FROM tab_rows WHERE spreadsheet_id = ? AND tab = ? AND row_num = ?',
+                                       (spreadsheet_id, tab, n)).fetchone()
+                row = json.loads(current[0]) if current else []
+                for col, value in changes:
+                    row.extend([''] * (col + 1 - len(row)))
+                    row[col] = value
+                records.append(self._record(spreadsheet_id, tab, n, row))
+            self._insert(conn, records)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def replace_rows(self, spreadsheet_id, tab, headers, rows):
+        conn = self._connect()
+        try:
+            with row_index.tab_lock(spreadsheet_id, tab):
+                conn.execute('DELETE FROM tab_rows WHERE spreadsheet_id = ? AND tab = ?', (spreadsheet_id, tab))
+                self._insert(conn, [self._record(spreadsheet_id, tab, n, row) for n, row in enumerate([headers] + list(rows), 1)])
+                conn.commit()
+        finally:
+            conn.close()
+
+    def append_rows(self, spreadsheet_id, tab, rows):
+        conn = self._connect()
+        try:
+            with row_index.tab_lock(spreadsheet_id, tab):
+                conn.execute('BEGIN IMMEDIATE')
+                # Below the header even when the tab is empty, as the Sheets append at A2 does
+                start = max(self._last_row(conn, spreadsheet_id, tab), 1) + 1
+                self._insert(conn, [self._record(spreadsheet_id, tab, start + i, row) for i, row in enumerate(rows)])
+                conn.commit()
+        finally:
+            conn.close()
+
+    def delete_rows(self, spreadsheet_id, tab, ids, id_column_index=0):
+        # In one transaction; the rows below keep their numbers
+        ids = {str(i) for i in ids}
+        if not ids: return
+        conn = self._connect()
+        try:
+            with row_index.tab_lock(spreadsheet_id, tab):
+                conn.execute('BEGIN IMMEDIATE')
+                if id_column_index == 0:
+                    for chunk, placeholders in in_chunks(ids):
+                        conn.execute(f"DELETE FROM tab_rows WHERE spreadsheet_id = ? AND tab = ? AND row_num > 1 "
+                                     f"AND row_key IN ({placeholders})", [spreadsheet_id, tab] + chunk)
+                else:
+                    doomed = []
+                    for n, cells in conn.execute('SELECT row_num, cells FROM tab_rows WHERE spreadsheet_id = ? AND tab = ? AND row_num > 1',
+                                                 (spreadsheet_id, tab)).fetchall():
+                        row = json.loads(cells)
+                        if len(row) > id_column_index and str(row[id_column_index]) in ids: doomed.append((spreadsheet_id, tab, n))
+                    conn.executemany('DELETE FROM tab_rows WHERE spreadsheet_id = ? AND tab = ? AND row_num = ?', doomed)
+                conn.commit()
+        finally:
+            conn.close()
+
+    def clear_rows(self, spreadsheet_id, tab, start_row=2):
+        conn = self._connect()
+        try:
+            with row_index.tab_lock(spreadsheet_id, tab):
+                conn.execute('DELETE FROM tab_rows WHERE spreadsheet_id = ? AND tab = ? AND row_num >= ?', (spreadsheet_id, tab, start_row))
+                conn.commit()
+        finally:
+            conn.close()
+
+    def schema_versions(self, spreadsheet_id):
+        conn = self._connect()
+        try:
+            return dict(conn.execute('SELECT tab, version FROM tab_versions WHERE spreadsheet_id = ?', (spreadsheet_id,)).fetchall())
+        finally:
+            conn.close()
+
+    def set_schema_versions(self, spreadsheet_id, versions):
+        conn = self._connect()
+        try:
+            conn.executemany('INSERT OR REPLACE INTO tab_versions (spreadsheet_id, tab, version) VALUES (?, ?, ?)',
+                             [(spreadsheet_id, tab, version) for tab, version in versions.items()])
+            conn.commit()
+        finally:
+            conn.close()
+
+# --- Registry ---
+
+_factories = {}
+
+def register_backend(name, factory):
+    """factory() returns the StorageBackend to use for one request"""
+    _factories[name] = factory
+
+def backend_name(spreadsheet_id):
+    prefix = spreadsheet_id.split(':', 1)[0] if ':' in spreadsheet_id else None
+    if prefix in _factories: return prefix
+    return STORAGE_ROUTES.get(spreadsheet_id, DEFAULT_BACKEND)
+
+def open_backend(spreadsheet_id):
+    name = backend_name(spreadsheet_id)
+    if name not in _factories:
+        raise ValueError(f"Unknown storage backend '{name}' (known: {', '.join(sorted(_factories))})")
+    return _factories[name]()
+
+_sqlite = SqliteBackend()
+register_backend('sqlite', lambda: _sqlite)
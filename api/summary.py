@@ -0,0 +1,110 @@
+import json
+import hashlib
+import datetime
+import threading
+
+# Precomputed dashboard numbers for the Android home-screen widget.
+# Refreshed from the pulled data at the end of every /sync, so order and
+# inventory upserts are reflected without the widget doing a full sync.
+
+# Orders in these delivery states no longer count as "pending"
+CLOSED_DELIVERY_STATUSES = ('delivered', 'cancelled', 'failed')
+
+_cache = {}
+_lock = threading.Lock()
+
+def is_low_stock(item):
+    if item.get('status', 'active') != 'active':
+        return False
+    return bool(item.get('is_out_of_stock')) or item.get('current_stock_qty', 0) <= item.get('low_stock_threshold', 10)
+
+class SummaryBuilder:
+    """Accumulates the summary one pulled item/order at a time, so a streamed
+    pull can feed it without keeping the rows"""
+
+    def __init__(self):
+        self.sales = {}
+        self.pending = {}
+        self.outstanding = {}
+        self.low_stock_count = 0
+
+    def add_item(self, item):
+        if is_low_stock(item): self.low_stock_count += 1
+
+    def add_order(self, o):
+        if o.get('order_status') == 'draft': return
+        rep = str(o.get('rep_id') or '')
+        day = str(o.get('order_date') or '')[:10]
+        days = self.sales.setdefault(rep, {})
+        days[day] = days.get(day, 0) + (o.get('net_total') or 0)
+        if o.get('delivery_status', 'pending') not in CLOSED_DELIVERY_STATUSES:
+            self.pending[rep] = self.pending.get(rep, 0) + 1
+        self.outstanding[rep] = self.outstanding.get(rep, 0) + (o.get('balance_due') or 0)
+
+    def merge(self, other):
+        """Adds another builder's totals (e.g. a cached per-entity partial) without changing it"""
+        self.low_stock_count += other.low_stock_count
+        for rep, days in other.sales.items():
+            mine = self.sales.setdefault(rep, {})
+            for day, total in days.items(): mine[day] = mine.get(day, 0) + total
+        for rep, n in other.pending.items(): self.pending[rep] = self.pending.get(rep, 0) + n
+        for rep, total in other.outstanding.items(): self.outstanding[rep] = self.outstanding.get(rep, 0) + total
+
+    def result(self):
+        return {
+            "low_stock_count": self.low_stock_count,
+            "sales": self.sales,
+            "pending": self.pending,
+            "outstanding": self.outstanding,
+            "updated_at": datetime.datetime.now(datetime.timezone.utc).isoformat()
+        }
+
+def build_summary(items, orders):
+    """Reduces pulled items/orders to small per-rep aggregates"""
+    builder = SummaryBuilder()
+    for i in items: builder.add_item(i)
+    for o in orders: builder.add_order(o)
+    return builder.result()
+
+def store_summary(spreadsheet_id, summary):
+    with _lock:
+        _cache[spreadsheet_id] = summary
+    return summary
+
+def refresh_summary(spreadsheet_id, items, orders):
+    return store_summary(spreadsheet_id, build_summary(items, orders))
+
+def get_cached_summary(spreadsheet_id):
+    with _lock:
+        return _cache.get(spreadsheet_id)
+
+def invalidate_summary(spreadsheet_id):
+    with _lock:
+        _cache.pop(spreadsheet_id, None)
+
+def summary_for_rep(summary, rep_id, day):
+    """Returns the widget payload and its ETag for one rep and day"""
+    rep = str(rep_id or '')
+    if rep:
+        sales = summary['sales'].get(rep, {}).get(day, 0)
+        pending = summary['pending'].get(rep, 0)
+        outstanding = summary['outstanding'].get(rep, 0)
+    else:
+        # No rep given: totals across every rep on the spreadsheet
+        sales = sum(days.get(day, 0) for days in summary['sales'].values())
+        pending = sum(summary['pending'].values())
+        outstanding = sum(summary['outstanding'].values())
+
+    payload = {
+        "date": day,
+        "rep_id": rep,
+        "today_sales": round(sales, 2),
+        "pending_deliveries": pending,
+        "low_stock_count": summary['low_stock_count'],
+        "outstanding_balance": round(outstanding, 2)
+    }
+    # Hashed without updated_at, which every sync moves: unchanged numbers keep their ETag (304)
+    body = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    etag = hashlib.sha1(body.encode('utf-8')).hexdigest()
+    payload["updated_at"] = summary['updated_at']
+    return payload, etag
@@ -0,0 +1,165 @@
+import os
+import re
+import json
+import codecs
+import hashlib
+
+from wire import columnar_record
+
+# Incremental reader for /sync request bodies.
+# The top-level object is walked key by key and arrays are read one element
+# at a time from the request stream. Entity lists (plain or columnar, see
+# wire.py) go through their encoder as each element completes: customers and
+# items become sheet rows, so neither the raw body nor their dicts are held
+# in full. Bodies over MAX_SYNC_BODY_BYTES are refused while reading. The
+# raw bytes are hashed as they arrive, for Idempotency-Key reuse checks
+# (idempotency.py).
+
+MAX_SYNC_BODY_BYTES = int(float(os.environ.get('PARTFLOW_MAX_SYNC_BODY_MB', '50')) * 1024 * 1024)
+READ_CHUNK_BYTES = 64 * 1024
+
+class SyncBodyError(ValueError):
+    status = 400
+
+class SyncBodyTooLarge(SyncBodyError):
+    status = 413
+
+_WS = re.compile(r'[ \t\n\r]*')
+_decoder = json.JSONDecoder()
+
+class _Reader:
+    def __init__(self, stream, max_bytes):
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.read_bytes = 0
+        self.digest = hashlib.blake2b(digest_size=16)
+        self.eof = False
+
+    def _fill(self):
+        """Appends the next chunk to the buffer (dropping what was consumed); False at end of body"""
+        if self.eof: return False
+        chunk = self.stream.read(READ_CHUNK_BYTES)
+        try:
+            if not chunk:
+                self.eof = True
+                self.buf = self.buf[self.pos:] + self.utf8.decode(b'', final=True)
+                self.pos = 0
+                return False
+            self.read_bytes += len(chunk)
+            if self.read_bytes > self.max_bytes:
+                raise SyncBodyTooLarge(f"Request body exceeds {self.max_bytes / (1024 * 1024):.1f} MB")
+            self.digest.update(chunk)
+            self.buf = self.buf[self.pos:] + self.utf8.decode(chunk)
+        except UnicodeDecodeError:
+            raise SyncBodyError("Request body is not valid UTF-8")
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non-whitespace character, '' at end of body"""
+        while True:
+            self.pos = _WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf): return self.buf[self.pos]
+            if not self._fill(): return ''
+
+    def take(self, allowed):
+        ch = self.peek()
+        if ch == '' or ch not in allowed:
+            raise SyncBodyError(f"Malformed JSON body: expected one of {allowed!r}, got {ch!r}")
+        self.pos += 1
+        return ch
+
+    def value(self):
+        """One complete JSON value, reading more of the body until it parses"""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                # A number at the very end of the buffer may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof: raise SyncBodyError(f"Malformed JSON body: {e.msg}")
+            self._fill()
+
+def _encode_element(encode, key, index, element):
+    try: return encode(element)
+    except KeyError as e:
+        raise SyncBodyError(f"{key}[{index}]: missing field {e}")
+    except (TypeError, AttributeError) as e:
+        raise SyncBodyError(f"{key}[{index}]: invalid element ({e})")
+
+def _read_array(reader, key, encode, to_record=None):
+    reader.take('[')
+    out = []
+    if reader.peek() == ']':
+        reader.pos += 1
+        return out
+    while True:
+        element = reader.value()
+        if to_record:
+            try: element = to_record(element)
+            except TypeError as e: raise SyncBodyError(f"{key}[{len(out)}]: {e}")
+        if encode: element = _encode_element(encode, key, len(out), element)
+        out.append(element)
+        if reader.take(',]') == ']': return out
+
+def _read_columnar(reader, key, encode):
+    """An entity list in the columnar shape (see wire.py); columns must come before rows"""
+    reader.take('{')
+    columns, nested, out = None, None, []
+    if reader.peek() == '}':
+        reader.pos += 1
+        return out
+    while True:
+        member = reader.value()
+        reader.take(':')
+        if member == 'rows':
+            if columns is None: raise SyncBodyError(f"{key}: \"columns\" must come before \"rows\"")
+            out = _read_array(reader, key, encode, lambda row: columnar_record(columns, row, nested))
+        elif member == 'columns':
+            columns = reader.value()
+            if not isinstance(columns, list): raise SyncBodyError(f"{key}: \"columns\" must be an array")
+        elif member == 'nested':
+            nested = reader.value()
+            if not isinstance(nested, dict): raise SyncBodyError(f"{key}: \"nested\" must be an object")
+        else:
+            reader.value()
+        if reader.take(',}') == '}': return out
+
+def read_sync_body(stream, encoders, max_bytes=MAX_SYNC_BODY_BYTES):
+    """Parses a /sync body from a file-like stream.
+
+    Returns (fields, rows, body_hash): entity lists whose key is in
+    `encoders` come back in rows with every element passed through its
+    encoder, whether sent as an array of objects or in the columnar shape;
+    everything else is in fields as plain JSON values. body_hash is the hex
+    digest of the raw body.
+    """
+    reader = _Reader(stream, max_bytes)
+    fields, rows = {}, {}
+    if reader.peek() != '{':
+        raise SyncBodyError("Request body must be a JSON object")
+    reader.pos += 1
+    if reader.peek() == '}':
+        reader.pos += 1
+    else:
+        while True:
+            key = reader.value()
+            if not isinstance(key, str): raise SyncBodyError("Malformed JSON body: object keys must be strings")
+            reader.take(':')
+            encode = encoders.get(key)
+            if reader.peek() == '[':
+                (rows if encode else fields)[key] = _read_array(reader, key, encode)
+            elif encode and reader.peek() == '{':
+                rows[key] = _read_columnar(reader, key, encode)
+            else:
+                fields[key] = reader.value()
+            if reader.take(',}') == '}': break
+    if reader.peek() != '':
+        raise SyncBodyError("Malformed JSON body: trailing data after the object")
+    return fields, rows, reader.digest.hexdigest()
@@ -0,0 +1,557 @@
+import json
+import time
+import functools
+import traceback
+
+from schema import CUSTOMER_HEADERS, INVENTORY_HEADERS, ORDER_HEADERS, LINE_HEADERS
+from sheet_rows import LINE_FIELDS, item_row_fields, order_sheet_rows, iter_inventory_rows, iter_customer_rows, iter_order_rows
+from summary import SummaryBuilder, store_summary
+from low_stock import apply_inventory_upserts, reconcile_low_stock, is_seeded
+from validation import malformed_order, validate_order_totals, apply_expected_totals, VALIDATION_MODES
+from metrics import span, current_trace, breakdown
+from profiling import allocation_phase
+from wire import columnar_pieces
+from pull_cache import pull_cache, entities_of, ENTITY_TABS
+from storage import merge_sheet_rows, open_backend
+from migrations import TAB_HEADERS, current_version, migrate_rows, stale_tabs
+from breaker import sheets_breaker, is_outage
+from retry_queue import enqueue_push, pending_pushes, has_pending, complete_push, record_attempt
+from idempotency import claim, complete, release, valid_key, MAX_KEY_LENGTH, IN_PROGRESS, DONE, MISMATCH
+from snapshots import take_snapshot
+from archive import archived_ids, unarchive_ids, partitions_of, split_archived_rows, archive_tab_names
+import stock_ledger
+import balances
+import append_log
+import patches
+import skus
+
+# The /sync pipeline, shared by the Flask app (index.py) and the ASGI app
+# (asgi.py): from the decoded body to the streamed response, with the
+# pushes, the pull and its write-backs, idempotency and outages in between.
+#
+# The two apps differ only in how they do I/O, so the pipeline does none:
+# each step is a generator that yields what it needs done and is sent back
+# the result (or has the error thrown in where it yielded):
+#
+#   open_store(spreadsheet_id)   opens the spreadsheet's StorageBackend
+#   store(method, *args)         a call on that backend
+#   work(fn, *args)              blocking work: SQLite, encoding
+#
+# Steps call each other with `yield from`. run_steps does every op inline
+# (Flask); asgi.run_steps awaits the async backend and runs `work` in the
+# worker pool.
+
+PULL_TABS = ('Inventory', 'Customers', 'Orders', 'OrderLines')
+SYNC_TABS = ('Customers', 'Inventory', 'Orders', 'OrderLines', 'StockAdjustments', 'Payments')
+# Written with appends only, never read back by a sync (append_log.py)
+APPEND_TABS = ('StockAdjustments', 'Payments')
+
+# --- Steps ---
+
+def open_store(spreadsheet_id):
+    return ('open', spreadsheet_id)
+
+def store(method, *args):
+    return ('store', method, args)
+
+def work(fn, *args, **kwargs):
+    return ('work', functools.partial(fn, *args, **kwargs))
+
+def run_steps(steps):
+    """Runs a step generator to its return value, each op inline"""
+    backend, send = None, functools.partial(steps.send, None)
+    while True:
+        try:
+            op = send()
+        except StopIteration as done:
+            return done.value
+        try:
+            if op[0] == 'open': result = backend = open_backend(op[1])
+            elif op[0] == 'store': result = getattr(backend, op[1])(*op[2])
+            else: result = op[1]()
+        except Exception as e:
+            send = functools.partial(steps.throw, e)
+        else:
+            send = functools.partial(steps.send, result)
+
+# --- Streamed Pull Response ---
+# The /sync body is written as it is decoded: each row is encoded on its own
+# and flushed in ~64 KB chunks, so memory stays flat as the sheets grow.
+
+STREAM_CHUNK_BYTES = 64 * 1024
+
+def _encode_json(value):
+    return json.dumps(value, separators=(',', ':'))
+
+def _entity_pieces(key, rows, columnar, nested=None):
+    return columnar_pieces(key, rows, nested) if columnar else _json_array(key, rows)
+
+def _json_array(key, rows):
+    yield _encode_json(key) + ':['
+    sep = ''
+    for row in rows:
+        yield sep + _encode_json(row)
+        sep = ','
+    yield ']'
+
+def _tap(rows, fn):
+    for row in rows:
+        fn(row)
+        yield row
+
+def chunked(pieces, size=STREAM_CHUNK_BYTES):
+    """Text pieces to ~size byte chunks; bytes pieces (cached segments) pass through"""
+    buf, n = [], 0
+    for piece in pieces:
+        if isinstance(piece, bytes):
+            if buf: yield ''.join(buf).encode('utf-8')
+            buf, n = [], 0
+            for start in range(0, len(piece), size):
+                yield piece[start:start + size]
+            continue
+        buf.append(piece)
+        n += len(piece)
+        if n >= size:
+            yield ''.join(buf).encode('utf-8')
+            buf, n = [], 0
+    if buf: yield ''.join(buf).encode('utf-8')
+
+# (entity, response key, nested columns) in response order
+PULL_SEGMENTS = (('inventory', 'pulledItems', None), ('customers', 'pulledCustomers', None),
+                 ('orders', 'pulledOrders', {"lines": LINE_FIELDS}))
+
+def _decode_entity(entity, values, partial):
+    if entity == 'inventory': return _tap(iter_inventory_rows(values['Inventory']), partial.add_item)
+    if entity == 'customers': return iter_customer_rows(values['Customers'])
+    return _tap(iter_order_rows(values['Orders'], values['OrderLines']), partial.add_order)
+
+def _segment_pieces(spreadsheet_id, entity, key, nested, values, columnar, builder, live=True, generation=None):
+    """One pulled list, from the pull cache when the sheet content is unchanged"""
+    cache_key = None
+    if live and pull_cache.enabled:
+        tab_values = [values[t] for t in ENTITY_TABS[entity]]
+        cache_key = pull_cache.key(spreadsheet_id, entity, 'columnar' if columnar else 'json', tab_values, generation)
+        hit = pull_cache.get(cache_key, tab_values)
+        if hit is not None:
+            segment, partial = hit
+            builder.merge(partial)
+            yield segment
+            return
+
+    # Miss: stream it, keeping a copy for the cache unless it outgrows an entry
+    partial = SummaryBuilder()
+    parts, size = ([], 0) if cache_key else (None, 0)
+    for piece in _entity_pieces(key, _decode_entity(entity, values, partial), columnar, nested):
+        if parts is not None:
+            parts.append(piece)
+            size += len(piece)
+            if size > pull_cache.max_entry_bytes: parts = None
+        yield piece
+    builder.merge(partial)
+    if parts is not None:
+        pull_cache.put(cache_key, ''.join(parts).encode('utf-8'), partial, tab_values)
+
+def pull_response_pieces(spreadsheet_id, values, tail, trace=None, profile=None, columnar=False, live=True, generations=None):
+    """Pieces of the /sync response: pulledItems, pulledCustomers and
+    pulledOrders (cached bytes, or decoded lazily from `values` as object
+    arrays or columnar), then the small `tail` fields. The widget summary is
+    accumulated on the way and stored at the end. A stale pull (live=False)
+    bypasses the pull cache and leaves the stored summary alone.
+    generations: pull_cache.generations() from before `values` was read"""
+    builder = SummaryBuilder()
+    yield '{"success":true'
+    for entity, key, nested in PULL_SEGMENTS:
+        yield ','
+        with span(f'sync.stream.{entity}'), allocation_phase(profile, f'stream.{entity}'):
+            yield from _segment_pieces(spreadsheet_id, entity, key, nested, values, columnar, builder, live,
+                                       (generations or {}).get(entity))
+    if live:
+        with span('sync.summary'):
+            store_summary(spreadsheet_id, builder.result())
+    for key, value in tail.items():
+        yield ',' + _encode_json(key) + ':' + _encode_json(value)
+    if trace is not None:
+        yield ',"timings":' + _encode_json(breakdown(trace))
+    yield '}'
+
+def sync_tail(mode, validation_mode, mismatches, patches=None):
+    """The small fields sent after the pulled lists; patches: what push_entities made of the sync's patches"""
+    tail = {
+        "debug": {
+            "customer_header_len": len(CUSTOMER_HEADERS),
+            "order_header_len": len(ORDER_HEADERS)
+        },
+        "validation": {"mode": validation_mode, "mismatches": mismatches},
+        "message": f"Sync completed successfully ({mode} mode)"
+    }
+    if patches is not None: tail["patches"] = patches
+    return tail
+
+def push_outcome(mode, validation_mode, mismatches, queued=None, patches=None):
+    """What a retry with the same Idempotency-Key is answered with"""
+    return {"mode": mode, "validation": {"mode": validation_mode, "mismatches": mismatches}, "queued": queued, "patches": patches}
+
+IDEMPOTENCY_KEY_ERROR = f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} printable characters"
+IN_PROGRESS_MESSAGE = "A sync with this Idempotency-Key is still running"
+MISMATCH_MESSAGE = "This Idempotency-Key was already used with a different request body"
+
+
+# --- Sheets Outages ---
+# While the breaker is open (or a sync hits an outage) pushes go to the retry
+# queue and the pull is answered from the last good one, with the queued
+# pushes laid over it so reps still see their own changes.
+
+def overlay_pushes(values, pushes):
+    """Tab values as they will be once `pushes` (queued payloads, oldest first) are written"""
+    values = dict(values)
+    for push in pushes:
+        order_values, line_values = order_sheet_rows(push.get('orders') or [])
+        for tab, headers, rows in (('Customers', CUSTOMER_HEADERS, push.get('customers')), ('Inventory', INVENTORY_HEADERS, push.get('items')),
+                                   ('Orders', ORDER_HEADERS, order_values), ('OrderLines', LINE_HEADERS, line_values)):
+            if not rows: continue
+            if push.get('mode') == 'overwrite' and tab != 'OrderLines': values[tab] = [headers] + rows
+            else: values[tab] = merge_sheet_rows(tab, list(values.get(tab) or []), headers, rows)
+        if push.get('patches'): values = patches.overlay_patches(values, push['patches'])
+    return values
+
+def stale_pull(spreadsheet_id):
+    """(values, age in seconds) of the last good pull plus queued pushes, or None"""
+    snapshot = pull_cache.last_good(spreadsheet_id)
+    if snapshot is None: return None
+    values, pulled_at = snapshot
+    return overlay_pushes(values, [push for _, push in pending_pushes(spreadsheet_id)]), int(time.time() - pulled_at)
+
+def outage_fields(age, queued, retry_after):
+    """Tail fields of a stale /sync answer"""
+    return {
+        "stale": {"ageSeconds": age, "retryAfterSeconds": retry_after},
+        "queued": queued,
+        "message": f"Google Sheets is unavailable: showing data from {age}s ago" + ("; your changes are queued" if queued else "")
+    }
+
+def outage_sync(spreadsheet_id, mode, validation_mode, mismatches, pushes, error, columnar=False, timings=False, key=None, replayed=None):
+    """/sync while Sheets is down: queue the pushes not yet written, answer from the last good pull.
+    key: the request's claimed Idempotency-Key, recorded as done once its push is queued;
+    replayed: the recorded outcome when the push already went through"""
+    queued = replayed['queued'] if replayed else None
+    if pushes and any(pushes):
+        yield work(order_sheet_rows, pushes[2])  # a malformed order fails here, not on replay
+        with span('sync.queue'):
+            queued = yield work(enqueue_push, spreadsheet_id, mode, *pushes, error=str(error))
+    if key:
+        if queued: yield work(complete, spreadsheet_id, key, push_outcome(mode, validation_mode, mismatches, queued))
+        else: yield work(release, spreadsheet_id, key)
+    retry_after = max(1, round(sheets_breaker.retry_after()))
+    stale = yield work(stale_pull, spreadsheet_id)
+    if stale is None:
+        message = f"{error}. No earlier copy of this spreadsheet to serve" + ("; your changes are queued" if queued else "")
+        return {"success": False, "message": message, "queued": queued}, 503, {'Retry-After': str(retry_after)}
+
+    values, age = stale
+    tail = sync_tail(mode, validation_mode, mismatches)
+    tail.update(outage_fields(age, queued, retry_after))
+    pieces = pull_response_pieces(spreadsheet_id, values, tail, current_trace() if timings else None, None, columnar, live=False)
+    return pieces, 200, {'Age': str(age), 'Warning': '110 - "Response is Stale"'}
+
+
+# --- Tabs ---
+
+def migrate_tabs(spreadsheet_id, tabs, created=()):
+    """Brings tabs to their current schema version (migrations.py);
+    `created` were just made with current headers and are only stamped"""
+    versions = yield store('schema_versions', spreadsheet_id)
+    stamp = {t: current_version(t) for t in created}
+    stale = stale_tabs(versions, [t for t in tabs if t not in stamp])
+    current = (yield store('read_tabs', spreadsheet_id, stale)) if stale else {}
+    for tab in stale:
+        migrated, stamp[tab] = yield work(migrate_rows, tab, versions.get(tab, 0), current[tab])
+        # In place, never cleared first: a failed write leaves the tab's rows, and the next sync retries
+        with pull_cache.writing(spreadsheet_id, *entities_of([tab])):
+            yield store('rewrite_rows', spreadsheet_id, tab, migrated[0], migrated[1:], current[tab])
+        print(f"Migrated '{tab}' in {spreadsheet_id} from schema v{versions.get(tab, 0)} to v{stamp[tab]}")
+    if stamp: yield store('set_schema_versions', spreadsheet_id, stamp)
+    return stale
+
+def ensure_sync_tabs(spreadsheet_id):
+    """Adds whichever of the sync tabs are missing and brings the others
+    to their current schema version (one metadata read when they are current)"""
+    created = []
+    try:
+        created = yield store('ensure_tabs', spreadsheet_id, SYNC_TABS, TAB_HEADERS)
+    except Exception as err:
+        if is_outage(err): raise
+        print(f"Error creating sheets in {spreadsheet_id}: {err}")
+    for tab in APPEND_TABS:
+        if tab in created: yield work(append_log.forget_tab, spreadsheet_id, tab)
+    yield from migrate_tabs(spreadsheet_id, SYNC_TABS, created)
+
+
+# --- Pushes ---
+
+def push_rows(spreadsheet_id, tab, headers, rows, mode):
+    if mode == 'overwrite': yield store('replace_rows', spreadsheet_id, tab, headers, rows)
+    else: yield store('upsert_rows', spreadsheet_id, tab, headers, rows, 0)
+
+def append_new(spreadsheet_id, tab, rows):
+    """Appends the rows the tab does not have yet (append_log.py); returns them"""
+    new = yield work(append_log.claim_new, spreadsheet_id, tab, rows)
+    if not new: return new
+    try:
+        yield store('append_rows', spreadsheet_id, tab, new)
+    except Exception:
+        yield work(append_log.release, spreadsheet_id, tab, new)
+        raise
+    return new
+
+def apply_patches(spreadsheet_id, patch_values):
+    """Writes the patches that still apply (patches.py): per tab one read of
+    the target rows and one write of the cells. Returns ({tab: [patched rows]}, conflicts)."""
+    patched_rows, conflicts = {}, []
+    for tab, group in patches.by_tab(patch_values).items():
+        width = patches.TAB_WIDTHS[tab]
+        current = yield store('read_rows_by_id', spreadsheet_id, tab, {p['id'] for p in group}, width)
+        cells, patched, lost = patches.resolve(group, current, width)
+        if cells: yield store('write_cells', spreadsheet_id, tab, cells)
+        patched_rows[tab] = list(patched.values())
+        conflicts += lost
+    patches.tally(patched_rows, conflicts)
+    return patched_rows, conflicts
+
+def push_patches(spreadsheet_id, patch_values):
+    """Writes the patches that still apply; {applied, conflicts}. Patched rows
+    go through the same rollups and caches as pushed ones."""
+    with pull_cache.writing(spreadsheet_id, *entities_of({p['tab'] for p in patch_values})):
+        patched_rows, conflicts = yield from apply_patches(spreadsheet_id, patch_values)
+    if patched_rows.get('Orders'): yield work(balances.record_orders, spreadsheet_id, patched_rows['Orders'])
+    if patched_rows.get('Inventory'): yield work(apply_inventory_upserts, spreadsheet_id, [item_row_fields(r) for r in patched_rows['Inventory']])
+    return {"applied": sum(len(rows) for rows in patched_rows.values()), "conflicts": conflicts}
+
+def unarchive_orders(spreadsheet_id, order_ids, pushed_lines=()):
+    """Takes orders a client pushed again out of their archive tabs and the
+    index (archive.py): the live copy wins. Archived lines of theirs the push
+    did not carry go back to OrderLines first. Run once the live rows are
+    written; until the index entries go, a failed run is picked up by the next push."""
+    pushed = {str(r[0]) for r in pushed_lines if r}
+    tabs, restore = {}, []
+    for partition, ids in sorted((yield work(partitions_of, spreadsheet_id, order_ids)).items()):
+        orders_tab, lines_tab = archive_tab_names(partition)
+        current = yield store('read_tabs', spreadsheet_id, [orders_tab, lines_tab])
+        kept_orders, kept_lines, taken_lines = split_archived_rows(current[orders_tab], current[lines_tab], ids)
+        tabs[orders_tab] = (ORDER_HEADERS, kept_orders, current[orders_tab])
+        tabs[lines_tab] = (LINE_HEADERS, kept_lines, current[lines_tab])
+        restore += [r for r in taken_lines if str(r[0]) not in pushed]
+    if restore: yield store('upsert_rows', spreadsheet_id, 'OrderLines', LINE_HEADERS, restore, 0)
+    for tab, (headers, kept, current) in tabs.items():
+        # In place, not cleared first: a failed write never empties the month
+        if len(kept) < len(current) - 1: yield store('rewrite_rows', spreadsheet_id, tab, headers, kept, current)
+    yield work(unarchive_ids, spreadsheet_id, order_ids)
+
+def push_entities(spreadsheet_id, mode, customer_values, item_values, orders, adjustment_values=(), payment_values=(), patch_values=()):
+    """Writes one sync's customer and item rows and orders (upsert or overwrite),
+    its field patches and its stock adjustment and payment rows (appended, each
+    id once). Returns {applied, conflicts} of the patches, None without any."""
+    order_values, line_values = (yield work(order_sheet_rows, orders)) if orders else ([], [])
+    # Rolled up first: the Customers and Inventory rows below carry the results
+    with span('sync.rollups'):
+        if adjustment_values: yield work(stock_ledger.take_adjustments, spreadsheet_id, adjustment_values)
+        if order_values: yield work(balances.record_orders, spreadsheet_id, order_values)
+        if payment_values: yield work(balances.record_payments, spreadsheet_id, payment_values)
+
+    with span('sync.push.customers'):
+        if customer_values:
+            yield work(balances.take_pushed_balances, spreadsheet_id, customer_values)
+            with pull_cache.writing(spreadsheet_id, 'customers'):
+                yield from push_rows(spreadsheet_id, 'Customers', CUSTOMER_HEADERS, customer_values, mode)
+
+    with span('sync.push.inventory'):
+        if item_values:
+            yield work(stock_ledger.take_pushed_stock, spreadsheet_id, item_values, rebaseline=mode == 'overwrite')
+            with pull_cache.writing(spreadsheet_id, 'inventory'):
+                yield from push_rows(spreadsheet_id, 'Inventory', INVENTORY_HEADERS, item_values, mode)
+            if mode != 'overwrite': yield work(apply_inventory_upserts, spreadsheet_id, [item_row_fields(r) for r in item_values])
+
+    with span('sync.push.orders'):
+        if orders:
+            # A re-pushed archived order is live again
+            revived = yield work(archived_ids, spreadsheet_id, [str(o['order_id']) for o in orders])
+            with pull_cache.writing(spreadsheet_id, 'orders'):
+                yield from push_rows(spreadsheet_id, 'Orders', ORDER_HEADERS, order_values, mode)
+                if line_values: yield store('upsert_rows', spreadsheet_id, 'OrderLines', LINE_HEADERS, line_values, 0)
+                if revived: yield from unarchive_orders(spreadsheet_id, revived, line_values)
+
+    patched = None
+    if patch_values:
+        with span('sync.push.patches'):
+            patched = yield from push_patches(spreadsheet_id, patch_values)
+
+    with span('sync.push.logs'):
+        if adjustment_values: yield from append_new(spreadsheet_id, 'StockAdjustments', adjustment_values)
+        if payment_values: yield from append_new(spreadsheet_id, 'Payments', payment_values)
+    return patched
+
+def replay_queued_pushes(spreadsheet_id):
+    """Writes queued pushes oldest first; stops (and re-raises) at the first failure"""
+    for entry_id, push in (yield work(pending_pushes, spreadsheet_id)):
+        try:
+            patched = yield from push_entities(spreadsheet_id, push['mode'], push['customers'], push['items'], push['orders'],
+                                               push.get('adjustments', []), push.get('payments', []), push.get('patches', []))
+        except Exception as e:
+            yield work(record_attempt, entry_id, e, give_up=not is_outage(e))
+            if is_outage(e): raise
+            traceback.print_exc()
+            continue
+        # Nobody is waiting on a queued push's answer
+        if patched and patched['conflicts']: print(f"Queued push {entry_id} to {spreadsheet_id}: {len(patched['conflicts'])} patch conflict(s) dropped")
+        yield work(complete_push, entry_id)
+
+
+# --- Write-backs ---
+# The pull carries the server's rollups and the sheet gets the cells that lag
+# behind: the stock ledger's stock (stock_ledger.py), auto SKUs (skus.py) and
+# customer balances (balances.py).
+
+def assign_pushed_skus(spreadsheet_id, item_values):
+    """Gives the pushed item rows with a blank SKU one, in place"""
+    if not (yield work(skus.is_seeded, spreadsheet_id)):
+        current = yield store('read_tabs', spreadsheet_id, ['Inventory'])
+        yield work(skus.merge_tab, spreadsheet_id, current['Inventory'])
+    yield work(skus.assign_skus, spreadsheet_id, item_values)
+
+def write_back_stock(spreadsheet_id, inventory_rows, auto_sku=False):
+    """Puts the ledger's stock into the pulled rows and, with auto_sku, a SKU
+    into the rows without one; the rows that changed go back in one write"""
+    stale = yield work(stock_ledger.overlay_stock, spreadsheet_id, inventory_rows)
+    if auto_sku:
+        listed = {id(row) for row in stale}
+        stale += [row for row in (yield work(skus.fill_tab, spreadsheet_id, inventory_rows)) if id(row) not in listed]
+    if not stale: return
+    for row in stale: row.extend([''] * (len(INVENTORY_HEADERS) - len(row)))
+    with pull_cache.writing(spreadsheet_id, 'inventory'):
+        yield store('upsert_rows', spreadsheet_id, 'Inventory', INVENTORY_HEADERS, stale, 0)
+    yield work(apply_inventory_upserts, spreadsheet_id, [item_row_fields(r) for r in stale])
+
+def write_back_balances(spreadsheet_id, values, mode):
+    """Seeds the rollup from the pulled Orders tab when needed, then puts its
+    balances into the pulled Customers rows and the sheet cells that differ"""
+    if mode == 'overwrite' or not (yield work(balances.is_seeded, spreadsheet_id)):
+        yield work(balances.reconcile_balances, spreadsheet_id, values['Orders'], replace_paid=mode == 'overwrite')
+    stale = yield work(balances.overlay_balances, spreadsheet_id, values['Customers'])
+    if not stale: return
+    with pull_cache.writing(spreadsheet_id, 'customers'):
+        # Only the Balance cells: the rest of a pulled row may be older than the sheet by now
+        found = yield store('read_rows_by_id', spreadsheet_id, 'Customers', {str(row[0]) for row in stale}, len(CUSTOMER_HEADERS))
+        cells = [(found[str(row[0])][0], balances.BALANCE_CELL, row[balances.BALANCE_CELL]) for row in stale if str(row[0]) in found]
+        if cells: yield store('write_cells', spreadsheet_id, 'Customers', cells)
+
+def snapshot_pull(spreadsheet_id, values):
+    """Snapshots the pull (snapshots.py); a failure here does not fail the sync"""
+    try:
+        take_snapshot(spreadsheet_id, values)
+    except Exception:
+        traceback.print_exc()
+
+
+# --- /sync ---
+
+def _failure(message, status, headers=None, **extra):
+    return {"success": False, "message": message, **extra}, status, headers or {}
+
+def sync_steps(data, rows, key=None, body_hash=None, columnar=False, profile=None):
+    """A /sync request from its decoded body (sync_body.py) on: returns
+    (response pieces, 200, headers), the pull to stream through chunked(),
+    or (error body, status, headers). key: the Idempotency-Key header;
+    body_hash: read_sync_body's hash of the raw body, which the key is tied to;
+    columnar: the client accepts the columnar pull (wire.py)"""
+    spreadsheet_id = data.get('spreadsheetId')
+    orders = rows.get('orders', [])
+    customer_values, item_values = rows.get('customers', []), rows.get('items', [])
+    adjustment_values, payment_values = rows.get('adjustments', []), rows.get('payments', [])
+    patch_values = rows.get('patches', [])
+    mode = data.get('mode', 'upsert')
+    validation_mode = data.get('validation', 'report')
+    auto_sku = data.get('autoSku') is True
+    if not spreadsheet_id: return _failure("Spreadsheet ID is required", 400)
+    if validation_mode not in VALIDATION_MODES:
+        return _failure(f"validation must be one of {', '.join(VALIDATION_MODES)}", 400)
+
+    malformed = malformed_order(orders)
+    if malformed: return _failure(malformed, 400)
+
+    # Check client totals against their lines before anything is written
+    with span('sync.validate'):
+        mismatches, expected_totals = (yield work(validate_order_totals, orders)) if orders else ([], {})
+    if mismatches and validation_mode == 'reject':
+        return _failure(f"{len(mismatches)} order(s) have totals that do not match their lines", 422, mismatches=mismatches)
+    if mismatches and validation_mode == 'correct':
+        apply_expected_totals(orders, expected_totals)
+
+    # A resent push (same Idempotency-Key) is not written again: its recorded
+    # outcome goes out with a fresh pull
+    replayed, patched = None, None
+    if key is not None:
+        if not valid_key(key): return _failure(IDEMPOTENCY_KEY_ERROR, 400)
+        with span('sync.idempotency'):
+            state, replayed = yield work(claim, spreadsheet_id, key, body_hash)
+        if state == MISMATCH:
+            return _failure(MISMATCH_MESSAGE, 422)
+        if state == IN_PROGRESS:
+            return _failure(IN_PROGRESS_MESSAGE, 409, {'Retry-After': '2'})
+        if state == DONE:
+            key, customer_values, item_values, orders, adjustment_values, payment_values, patch_values = None, [], [], [], [], [], []
+            mode, validation_mode, mismatches = replayed['mode'], replayed['validation']['mode'], replayed['validation']['mismatches']
+            patched = replayed.get('patches')
+    pushes = (customer_values, item_values, orders, adjustment_values, payment_values, patch_values)
+    try:
+        with span('sync.auth'):
+            yield open_store(spreadsheet_id)
+
+        with span('sync.ensure_headers'):
+            yield from ensure_sync_tabs(spreadsheet_id)
+
+        # Pushes queued during an outage are written first, in order
+        if (yield work(has_pending, spreadsheet_id)):
+            with span('sync.replay'):
+                yield from replay_queued_pushes(spreadsheet_id)
+
+        if auto_sku and item_values:
+            with span('sync.skus'):
+                yield from assign_pushed_skus(spreadsheet_id, item_values)
+        patched = (yield from push_entities(spreadsheet_id, mode, customer_values, item_values, orders, adjustment_values, payment_values,
+                                            patch_values)) or patched
+        pushes = None
+        if key: yield work(complete, spreadsheet_id, key, push_outcome(mode, validation_mode, mismatches, patches=patched))
+        # --- PULL ALL DATA ---
+        # One batched read; rows are decoded while the response streams
+        with span('sync.pull'):
+            generations = pull_cache.generations(spreadsheet_id)
+            values = yield store('read_tabs', spreadsheet_id, PULL_TABS)
+        with span('sync.stock'):
+            yield from write_back_stock(spreadsheet_id, values['Inventory'], auto_sku)
+        with span('sync.balances'):
+            yield from write_back_balances(spreadsheet_id, values, mode)
+        pull_cache.remember(spreadsheet_id, values)
+        with span('sync.snapshot'):
+            yield work(snapshot_pull, spreadsheet_id, values)
+
+        if mode == 'overwrite' or not (yield work(is_seeded, spreadsheet_id)):
+            with span('sync.low_stock'):
+                yield work(reconcile_low_stock, spreadsheet_id, iter_inventory_rows(values['Inventory']))
+
+        tail, headers = sync_tail(mode, validation_mode, mismatches, patched), {}
+        if replayed:
+            tail["replayed"] = True
+            headers['Idempotent-Replayed'] = 'true'
+        pieces = pull_response_pieces(spreadsheet_id, values, tail, current_trace() if data.get('timings') else None, profile, columnar,
+                                      generations=generations)
+        return pieces, 200, headers
+    except Exception as e:
+        if is_outage(e):
+            try:
+                return (yield from outage_sync(spreadsheet_id, mode, validation_mode, mismatches, pushes, e, columnar, data.get('timings'),
+                                               key, replayed))
+            except Exception:
+                traceback.print_exc()
+        # Not written (or written and recorded, which release leaves alone)
+        if key: yield work(release, spreadsheet_id, key)
+        traceback.print_exc()
+        return _failure(str(e), 500)
@@ -0,0 +1,109 @@
+import math
+
+import numpy as np
+
+# Push-time check of client-computed order totals against their lines.
+# Mirrors OrderBuilder: gross = sum(line_total), disc1 = gross * rate1,
+# disc2 = (gross - disc1) * rate2, net = gross - disc1 - disc2.
+# The whole batch is checked with array ops, one pass over the lines.
+
+# Currency tolerance (half a cent plus float noise)
+TOLERANCE = 0.006
+
+VALIDATION_MODES = ('report', 'reject', 'correct')
+
+TOTAL_FIELDS = ('gross_total', 'discount_value', 'secondary_discount_value', 'net_total')
+AMOUNT_FIELDS = TOTAL_FIELDS + ('discount_rate', 'secondary_discount_rate')
+LINE_FIELDS = ('line_id', 'item_id', 'item_name', 'quantity', 'unit_value', 'line_total')
+LINE_AMOUNT_FIELDS = ('quantity', 'unit_value', 'line_total')
+
+def _num(value):
+    try: return float(value) if value not in (None, '') else 0.0
+    except (TypeError, ValueError): return float('nan')
+
+def _column(values):
+    try:
+        return np.array(values, dtype=float)
+    except (TypeError, ValueError):
+        return np.array([_num(v) for v in values], dtype=float)
+
+def _bad_amount(o, fields):
+    """The first field holding something other than a number (blank counts as 0)"""
+    return next((f for f in fields if not math.isfinite(_num(o.get(f)))), None)
+
+def malformed_order(orders):
+    """Names the first order whose lines or amounts can be neither checked nor
+    written: lines that are not a list of objects with every LINE_FIELDS field,
+    or an amount that is not a number. None when all are well formed."""
+    for i, o in enumerate(orders):
+        bad = _bad_amount(o, AMOUNT_FIELDS)
+        if bad: return f"orders[{i}]: {bad} is not a number"
+        lines = o.get('lines', [])
+        if not isinstance(lines, list): return f"orders[{i}]: lines must be an array"
+        for j, line in enumerate(lines):
+            if not isinstance(line, dict): return f"orders[{i}].lines[{j}]: expected an object, got {type(line).__name__}"
+            missing = next((f for f in LINE_FIELDS if f not in line), None)
+            if missing: return f"orders[{i}].lines[{j}]: missing field '{missing}'"
+            bad = _bad_amount(line, LINE_AMOUNT_FIELDS)
+            if bad: return f"orders[{i}].lines[{j}]: {bad} is not a number"
+    return None
+
+def validate_order_totals(orders):
+    """Recomputes totals for every order that carries lines (checked with
+    malformed_order first). An order sent with no lines ('lines': []) says
+    nothing about its totals and is left alone, as one without the key is.
+
+    Returns (mismatches, expected) where mismatches is a list of
+    {order_id, fields: {name: {sent, expected}}, lines: [...]} and expected
+    maps each mismatched order_id to its recomputed totals.
+    """
+    checked = [o for o in orders if isinstance(o.get('lines'), list) and o['lines']]
+    if not checked:
+        return [], {}
+
+    counts = np.array([len(o['lines']) for o in checked], dtype=np.int64)
+    order_idx = np.repeat(np.arange(len(checked)), counts)
+    all_lines = [l for o in checked for l in o['lines']]
+    qty = _column([l.get('quantity', 0) for l in all_lines])
+    unit = _column([l.get('unit_value', 0) for l in all_lines])
+    line_total = _column([l.get('line_total', 0) for l in all_lines])
+
+    sent = np.column_stack([_column([o.get(f, 0) for o in checked]) for f in TOTAL_FIELDS])
+    rate1 = _column([o.get('discount_rate', 0) for o in checked])
+    rate2 = _column([o.get('secondary_discount_rate', 0) for o in checked])
+
+    gross = np.bincount(order_idx, weights=line_total, minlength=len(checked))
+    disc1 = gross * rate1
+    disc2 = (gross - disc1) * rate2
+    net = gross - disc1 - disc2
+    expected = np.column_stack([gross, disc1, disc2, net])
+
+    field_bad = ~np.isclose(sent, expected, rtol=0, atol=TOLERANCE)
+    line_bad = ~np.isclose(line_total, qty * unit, rtol=0, atol=TOLERANCE)
+    orders_with_bad_lines = np.bincount(order_idx[line_bad], minlength=len(checked)) > 0 if len(all_lines) else np.zeros(len(checked), dtype=bool)
+    bad_orders = np.flatnonzero(field_bad.any(axis=1) | orders_with_bad_lines)
+
+    expected_by_id = {}
+    mismatches = []
+    starts = np.concatenate([[0], np.cumsum(counts)])
+    for k in bad_orders:
+        o = checked[k]
+        fields = {TOTAL_FIELDS[f]: {"sent": o.get(TOTAL_FIELDS[f]), "expected": round(float(expected[k, f]), 2)}
+                  for f in np.flatnonzero(field_bad[k])}
+        bad_lines = [{"line_id": all_lines[j].get('line_id'), "sent": all_lines[j].get('line_total'),
+                      "expected": round(float(qty[j] * unit[j]), 2)}
+                     for j in range(starts[k], starts[k + 1]) if line_bad[j]]
+        expected_by_id[str(o.get('order_id'))] = dict(zip(TOTAL_FIELDS, (round(float(v), 2) for v in expected[k])))
+        entry = {"order_id": o.get('order_id'), "fields": fields}
+        if bad_lines: entry["lines"] = bad_lines
+        mismatches.append(entry)
+    return mismatches, expected_by_id
+
+def apply_expected_totals(orders, expected_by_id):
+    """Overwrites client totals with the recomputed ones (validation mode 'correct')"""
+    for o in orders:
+        totals = expected_by_id.get(str(o.get('order_id')))
+        if not totals: continue
+        o.update(totals)
+        # Keep the balance consistent with the corrected net
+        o['balance_due'] = round(totals['net_total'] - _num(o.get('paid_amount')), 2)
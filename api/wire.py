@@ -0,0 +1,65 @@
+import json
+
+# Columnar /sync encoding (opt-in).
+# Each entity list is sent once as column names plus rows of values instead
+# of an array of objects that repeats every key:
+#
+#   {"columns": ["item_id", "item_name", ...], "rows": [["item-1", "Brake Pad", ...], ...]}
+#
+# Orders carry their lines the same way: "nested": {"lines": [line columns]}
+# and the lines cell of each order row is a list of line rows. It is plain
+# JSON, so the app still decodes it with JSON.parse, just with far fewer bytes.
+# A null cell means the field is absent.
+# Pull responses use it when the request sends `Accept: COLUMNAR_MIME`; pushes
+# may send any entity list in this shape (Content-Type: COLUMNAR_MIME).
+
+COLUMNAR_MIME = 'application/vnd.partflow.columnar+json'
+JSON_MIME = 'application/json'
+
+def wants_columnar(accept_mimetypes):
+    """True when the Accept header prefers the columnar encoding over JSON"""
+    return accept_mimetypes.best_match([JSON_MIME, COLUMNAR_MIME]) == COLUMNAR_MIME
+
+def _encode(value):
+    return json.dumps(value, separators=(',', ':'))
+
+def columnar_pieces(key, records, nested=None):
+    """JSON text pieces for `"key":{columns, nested, rows}` from an iterable of dicts.
+    Columns are taken from the first record; `nested` maps a list-valued field
+    to the columns of its elements."""
+    yield _encode(key) + ':{'
+    records = iter(records)
+    first = next(records, None)
+    columns = list(first) if first is not None else []
+    yield '"columns":' + _encode(columns)
+    if nested:
+        yield ',"nested":' + _encode(nested)
+    yield ',"rows":['
+    if first is not None:
+        yield _encode(_row(first, columns, nested))
+        for record in records:
+            yield ',' + _encode(_row(record, columns, nested))
+    yield ']}'
+
+def _row(record, columns, nested):
+    if not nested:
+        return [record.get(c) for c in columns]
+    row = []
+    for c in columns:
+        value = record.get(c)
+        if c in nested and isinstance(value, list):
+            value = [[v.get(n) for n in nested[c]] for v in value]
+        row.append(value)
+    return row
+
+def columnar_record(columns, row, nested=None):
+    """One row back to a dict (nested lists included). Null cells are left out,
+    the same as a key missing from an object, so encoder defaults still apply."""
+    if not isinstance(row, list):
+        raise TypeError(f"expected a row array, got {type(row).__name__}")
+    record = {c: v for c, v in zip(columns, row) if v is not None}
+    for field, sub_columns in (nested or {}).items():
+        value = record.get(field)
+        if isinstance(value, list):
+            record[field] = [{c: x for c, x in zip(sub_columns, v) if x is not None} if isinstance(v, list) else v for v in value]
+    return record
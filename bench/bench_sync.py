@@ -0,0 +1,240 @@
+"""Offline benchmark for /sync, upsert_rows and the pull decoders.
+
+Runs the Flask app in-process against bench/fake_sheets.py, so no spreadsheet
+or credentials are needed. Results are printed (or written) as JSON so two
+runs can be diffed:
+
+    python bench/bench_sync.py --sizes 500,2000,10000 --runs 3 --out bench_output.json
+
+--backend sqlite runs the same scenarios on the SQLite storage backend.
+"""
+import os
+import sys
+import json
+import time
+import copy
+import argparse
+import platform
+import datetime
+import tempfile
+import statistics
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'api')
+for path in (API_DIR, BENCH_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+# Keep the benchmark's SQLite state out of the repo
+os.environ.setdefault('PARTFLOW_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='partflow-bench-'), 'partflow.db'))
+
+from fake_sheets import FakeSheetsService
+
+SPREADSHEET_ID = 'bench-spreadsheet'
+SQLITE_ID = f'sqlite:{SPREADSHEET_ID}'
+NOW = '2026-02-04T10:00:00.000Z'
+
+# --- Synthetic data ---
+
+def make_item(i):
+    return {
+        "item_id": f"item-{i}", "item_display_name": f"Brake Pad {i} (Toyota Corolla)", "item_name": f"Brake Pad {i}",
+        "item_number": f"BP-{i:06d}", "vehicle_model": "Corolla", "source_brand": "Denso", "category": "Brakes",
+        "unit_value": 1250.0 + i % 100, "current_stock_qty": i % 40, "low_stock_threshold": 10,
+        "is_out_of_stock": False, "status": "active", "updated_at": NOW
+    }
+
+def make_customer(i):
+    return {
+        "customer_id": f"cust-{i}", "shop_name": f"Auto Parts {i}", "address": f"{i} Main Street", "phone": "0771234567",
+        "city_ref": "Colombo", "discount_rate": 0.05, "secondary_discount_rate": 0.02, "outstanding_balance": 0,
+        "credit_period": 90, "status": "active", "updated_at": NOW
+    }
+
+def make_order(i, n_items, n_customers, lines_per_order=3):
+    lines = []
+    for j in range(lines_per_order):
+        qty = 1 + (i + j) % 5
+        lines.append({"line_id": f"line-{i}-{j}", "order_id": f"order-{i}", "item_id": f"item-{(i * 7 + j) % n_items}",
+                      "item_name": f"Brake Pad {(i * 7 + j) % n_items}", "quantity": qty, "unit_value": 1000.0, "line_total": qty * 1000.0})
+    gross = sum(l['line_total'] for l in lines)
+    disc1 = gross * 0.05
+    disc2 = (gross - disc1) * 0.02
+    net = gross - disc1 - disc2
+    return {
+        "order_id": f"order-{i}", "customer_id": f"cust-{i % max(n_customers, 1)}", "rep_id": str(1 + i % 5),
+        "order_date": f"2026-01-{1 + i % 28:02d}", "gross_total": gross, "discount_rate": 0.05, "discount_value": disc1,
+        "secondary_discount_rate": 0.02, "secondary_discount_value": disc2, "net_total": net, "paid_amount": 0,
+        "balance_due": net, "payment_status": "unpaid", "delivery_status": "pending", "credit_period": 90,
+        "order_status": "confirmed", "updated_at": NOW, "lines": lines
+    }
+
+def dataset(n_items):
+    n_customers = max(1, n_items // 5)
+    n_orders = max(1, n_items // 2)
+    orders = [make_order(i, n_items, n_customers) for i in range(n_orders)]
+    customers = [make_customer(i) for i in range(n_customers)]
+    # Balances that agree with the orders, as the server rolls them up (balances.py)
+    for o in orders:
+        customers[int(o['customer_id'].split('-')[1])]['outstanding_balance'] += o['balance_due']
+    for c in customers: c['outstanding_balance'] = round(c['outstanding_balance'], 2)
+    return [make_item(i) for i in range(n_items)], customers, orders
+
+def seed_sheets(fake, items, customers, orders):
+    from schema import CUSTOMER_HEADERS, INVENTORY_HEADERS, ORDER_HEADERS, LINE_HEADERS
+    from migrations import TAB_HEADERS
+    from sync_pipeline import APPEND_TABS
+    import sheet_rows
+    fake.seed(SPREADSHEET_ID, 'Inventory', [INVENTORY_HEADERS] + [sheet_rows.item_row(i) for i in items])
+    fake.seed(SPREADSHEET_ID, 'Customers', [CUSTOMER_HEADERS] + [sheet_rows.customer_row(c) for c in customers])
+    fake.seed(SPREADSHEET_ID, 'Orders', [ORDER_HEADERS] + [sheet_rows.order_row(o) for o in orders])
+    fake.seed(SPREADSHEET_ID, 'OrderLines', [LINE_HEADERS] + [r for o in orders for r in sheet_rows.order_line_rows(o)])
+    for tab in APPEND_TABS: fake.seed(SPREADSHEET_ID, tab, [TAB_HEADERS[tab]])
+    # Seeded at the current layout: stamp it so no run pays the one-time migration
+    from storage import SheetsBackend
+    stamp_schema_versions(SheetsBackend(fake), SPREADSHEET_ID)
+
+def stamp_schema_versions(backend, spreadsheet_id):
+    from migrations import TAB_HEADERS, current_version
+    backend.set_schema_versions(spreadsheet_id, {tab: current_version(tab) for tab in TAB_HEADERS})
+
+# --- Measurement ---
+
+def measure(fn, runs, setup=None):
+    """Times `runs` plain calls, then one more under tracemalloc for peak memory.
+    setup (untimed) runs before every call."""
+    timings, result = [], None
+    for _ in range(runs):
+        if setup: setup()
+        start = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    if setup: setup()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "latency_ms": {"median": round(statistics.median(timings), 2), "min": round(min(timings), 2), "max": round(max(timings), 2)},
+        "peak_mem_kb": round(peak / 1024, 1)
+    }, result
+
+def restore(fake, seeded, store=None):
+    """Puts the seeded tabs back, in the SQLite store too when benchmarking it"""
+    fake._books[SPREADSHEET_ID] = copy.deepcopy(seeded)
+    fake.reset_counters()
+    if store is not None:
+        for tab, rows in seeded.items():
+            store.replace_rows(SQLITE_ID, tab, rows[0], rows[1:])
+        stamp_schema_versions(store, SQLITE_ID)
+
+def bench_sync(index, fake, client, seeded, payload, runs, store=None):
+    def reset():
+        restore(fake, seeded, store)
+    def run():
+        # Drain the (possibly streamed) body like a client would, without keeping it
+        start = time.perf_counter()
+        resp = client.post('/sync', json=payload, headers={'X-API-KEY': index.API_KEY})
+        ttfb, size = None, 0
+        for chunk in resp.iter_encoded():
+            if ttfb is None: ttfb = (time.perf_counter() - start) * 1000
+            size += len(chunk)
+        resp.close()
+        return resp.status_code, ttfb, size
+    stats, (status, ttfb, size) = measure(run, runs, reset)
+    stats.update({
+        "status": status,
+        "ttfb_ms": round(ttfb or 0, 2),
+        "api_calls": dict(sorted(fake.calls.items())),
+        "api_calls_total": fake.total_calls,
+        "rows_read": fake.rows_read,
+        "rows_written": fake.rows_written,
+        "response_bytes": size
+    })
+    return stats
+
+def run_benchmarks(sizes, runs, latency, backend='sheets'):
+    import index
+    import sheet_rows
+    from storage import SheetsBackend, open_backend
+    store = open_backend(SQLITE_ID) if backend == 'sqlite' else None
+    spreadsheet_id = SQLITE_ID if store is not None else SPREADSHEET_ID
+    fake = FakeSheetsService(latency=latency)
+    index.get_sheets_service = lambda: index.traced_service(fake)
+    client = index.app.test_client()
+    results = []
+
+    for n in sizes:
+        items, customers, orders = dataset(n)
+        fake._books.pop(SPREADSHEET_ID, None)
+        seed_sheets(fake, items, customers, orders)
+        seeded = copy.deepcopy(fake._books[SPREADSHEET_ID])
+        sizes_meta = {"inventory": len(items), "customers": len(customers), "orders": len(orders),
+                      "order_lines": sum(len(o['lines']) for o in orders)}
+
+        scenarios = {
+            "pull_only": {"spreadsheetId": spreadsheet_id, "mode": "upsert"},
+            "upsert_small": {"spreadsheetId": spreadsheet_id, "mode": "upsert", "items": items[:10],
+                             "customers": customers[:10], "orders": orders[:10]},
+            "overwrite_full": {"spreadsheetId": spreadsheet_id, "mode": "overwrite", "items": items,
+                               "customers": customers, "orders": orders},
+        }
+        for name, payload in scenarios.items():
+            stats = bench_sync(index, fake, client, seeded, payload, runs, store)
+            results.append({"benchmark": f"sync.{name}", "sizes": sizes_meta, **stats})
+
+        # upsert_rows on its own, 10 changed rows into the full inventory sheet
+        from schema import INVENTORY_HEADERS
+        changed = [sheet_rows.item_row(i) for i in items[:10]]
+        target = store or SheetsBackend(fake)
+        def reset():
+            restore(fake, seeded, store)
+        def run_upsert():
+            return target.upsert_rows(spreadsheet_id, 'Inventory', INVENTORY_HEADERS, changed, 0)
+        stats, _ = measure(run_upsert, runs, reset)
+        stats.update({"api_calls_total": fake.total_calls, "rows_read": fake.rows_read, "rows_written": fake.rows_written})
+        results.append({"benchmark": "upsert_rows.inventory", "sizes": sizes_meta, **stats})
+
+        # Pull decoders on raw sheet values
+        raw = {tab: seeded[tab] for tab in ('Inventory', 'Customers', 'Orders', 'OrderLines')}
+        decoders = {
+            "parse_inventory_rows": lambda: sheet_rows.parse_inventory_rows([list(r) for r in raw['Inventory']]),
+            "parse_customer_rows": lambda: sheet_rows.parse_customer_rows([list(r) for r in raw['Customers']]),
+            "parse_order_rows": lambda: sheet_rows.parse_order_rows([list(r) for r in raw['Orders']], [list(r) for r in raw['OrderLines']]),
+        }
+        for name, fn in decoders.items():
+            stats, decoded = measure(fn, runs)
+            results.append({"benchmark": f"decode.{name}", "sizes": sizes_meta, "rows": len(decoded), **stats})
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='500,2000,10000', help='comma separated inventory sizes (customers = n/5, orders = n/2)')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated per-call Sheets latency')
+    parser.add_argument('--backend', choices=('sheets', 'sqlite'), default='sheets', help='storage backend /sync runs on')
+    parser.add_argument('--out', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    report = {
+        "meta": {
+            "generated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "runs": args.runs,
+            "latency_ms": args.latency_ms,
+            "backend": args.backend
+        },
+        "results": run_benchmarks(sizes, args.runs, args.latency_ms / 1000.0, args.backend)
+    }
+    out = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Payload size and encode/decode time of the /sync wire formats.
+
+Compares the default JSON object arrays with the columnar encoding
+(api/wire.py), raw and gzipped, on a synthetic pull of each size. MessagePack
+is included when the msgpack package is installed. parse_ms is the parse
+alone (JSON.parse in the app); records_ms adds turning columnar rows back
+into objects, as utils/columnar.ts does.
+
+    python bench/bench_wire.py --sizes 2000,10000 --runs 5 --out wire_report.json
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+import platform
+import datetime
+import statistics
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+if BENCH_DIR not in sys.path:
+    sys.path.insert(0, BENCH_DIR)
+
+# bench_sync points PARTFLOW_DB_PATH at a temp dir before the app is imported
+from bench_sync import dataset
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def pulled_payload(n):
+    """The pull part of a /sync response, as the server decodes it from the sheets"""
+    from schema import CUSTOMER_HEADERS, INVENTORY_HEADERS, ORDER_HEADERS, LINE_HEADERS
+    import sheet_rows
+    items, customers, orders = dataset(n)
+    return {
+        "pulledItems": sheet_rows.parse_inventory_rows([INVENTORY_HEADERS] + [sheet_rows.item_row(i) for i in items]),
+        "pulledCustomers": sheet_rows.parse_customer_rows([CUSTOMER_HEADERS] + [sheet_rows.customer_row(c) for c in customers]),
+        "pulledOrders": sheet_rows.parse_order_rows([ORDER_HEADERS] + [sheet_rows.order_row(o) for o in orders],
+                                               [LINE_HEADERS] + [r for o in orders for r in sheet_rows.order_line_rows(o)])
+    }
+
+def formats():
+    from wire import columnar_pieces, columnar_record
+    from sheet_rows import LINE_FIELDS
+    nested = {"pulledOrders": {"lines": LINE_FIELDS}}
+
+    def columnar_encode(payload):
+        pieces = []
+        for key, records in payload.items():
+            pieces.append(''.join(columnar_pieces(key, records, nested.get(key))))
+        return ('{' + ','.join(pieces) + '}').encode('utf-8')
+
+    def columnar_records(data):
+        return {k: [columnar_record(v['columns'], r, v.get('nested')) for r in v['rows']] for k, v in data.items()}
+
+    def columnar_lists(payload):
+        return {k: {"columns": list(v[0]) if v else [], "rows": [list(r.values()) for r in v]} for k, v in payload.items()}
+
+    out = {
+        "json": (lambda p: json.dumps(p, separators=(',', ':')).encode('utf-8'), json.loads, None),
+        "columnar_json": (columnar_encode, json.loads, columnar_records),
+    }
+    if msgpack is not None:
+        out["msgpack"] = (msgpack.packb, msgpack.unpackb, None)
+        out["msgpack_columnar"] = (lambda p: msgpack.packb(columnar_lists(p)), msgpack.unpackb, columnar_records)
+    return out
+
+def timed(fn, arg, runs):
+    timings, result = [], None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn(arg)
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(timings), 2), result
+
+def run(sizes, runs):
+    results = []
+    for n in sizes:
+        payload = pulled_payload(n)
+        counts = {k: len(v) for k, v in payload.items()}
+        baseline = None
+        for name, (encode, parse, to_records) in formats().items():
+            encode_ms, body = timed(encode, payload, runs)
+            parse_ms, parsed = timed(parse, body, runs)
+            records_ms = parse_ms + (timed(to_records, parsed, runs)[0] if to_records else 0)
+            gz = len(gzip.compress(body, 6))
+            entry = {"format": name, "sizes": counts, "bytes": len(body), "gzip_bytes": gz,
+                     "encode_ms": encode_ms, "parse_ms": parse_ms, "records_ms": round(records_ms, 2)}
+            if baseline is None:
+                baseline = entry
+            else:
+                entry["vs_json"] = {"bytes": round(len(body) / baseline["bytes"], 3), "gzip_bytes": round(gz / baseline["gzip_bytes"], 3),
+                                    "parse": round(parse_ms / baseline["parse_ms"], 3) if baseline["parse_ms"] else None}
+            results.append(entry)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='2000,10000', help='comma separated inventory sizes (customers = n/5, orders = n/2)')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--out', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = {
+        "meta": {
+            "generated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "runs": args.runs,
+            "msgpack": getattr(msgpack, 'version', None) and '.'.join(map(str, msgpack.version))
+        },
+        "results": run([int(s) for s in args.sizes.split(',') if s.strip()], args.runs)
+    }
+    out = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+if __name__ == '__main__':
+    main()
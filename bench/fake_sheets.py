@@ -0,0 +1,336 @@
+import re
+import json
+import time
+import random
+import asyncio
+import threading
+import collections
+from urllib.parse import unquote
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+# In-process stand-in for the googleapiclient Sheets service used by api/index.py.
+# Covers spreadsheets().get/batchUpdate (addSheet, create/updateDeveloperMetadata
+# on a tab, deleteDimension of rows) and values().get, batchGet,
+# update, batchUpdate, append, clear and batchClear. Tabs live in memory as
+# lists of rows. Every call is counted and can be slowed down or made to fail
+# with a quota error, so sync behaviour can be measured without a live sheet.
+# rest_handler serves the same tabs over the REST paths the async client
+# (api/sheets_async.py) calls, as an httpx.MockTransport handler.
+
+_A1 = re.compile(r"^([A-Z]*)(\d*)$")
+
+def _col_index(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + (ord(ch) - 64)
+    return n - 1
+
+def parse_range(range_name):
+    """'Tab'!A2:Z1000 -> (tab, row0, col0, row1, col1); row1/col1 None means open-ended"""
+    if '!' in range_name:
+        tab, cells = range_name.rsplit('!', 1)
+    else:
+        tab, cells = range_name, ''
+    tab = tab.strip()
+    if tab.startswith("'") and tab.endswith("'"):
+        tab = tab[1:-1].replace("''", "'")
+    if not cells:
+        return tab, 0, 0, None, None
+    start, _, end = cells.partition(':')
+    m1 = _A1.match(start)
+    r0 = int(m1.group(2)) - 1 if m1.group(2) else 0
+    c0 = _col_index(m1.group(1)) if m1.group(1) else 0
+    if not end:
+        # A single cell (A1) anchors writes; reads of it return one cell
+        return tab, r0, c0, (r0 if m1.group(2) else None), (c0 if m1.group(1) else None)
+    m2 = _A1.match(end)
+    r1 = int(m2.group(2)) - 1 if m2.group(2) else None
+    c1 = _col_index(m2.group(1)) if m2.group(1) else None
+    return tab, r0, c0, r1, c1
+
+class _Request:
+    def __init__(self, backend, method, fn):
+        self._backend = backend
+        self._method = method
+        self._fn = fn
+
+    def execute(self, num_retries=0):
+        return self._backend._call(self._method, self._fn)
+
+class FakeValues:
+    def __init__(self, backend):
+        self._b = backend
+
+    def get(self, spreadsheetId, range, **kwargs):
+        return _Request(self._b, 'values.get', lambda: self._b._read(spreadsheetId, range))
+
+    def batchGet(self, spreadsheetId, ranges, **kwargs):
+        return _Request(self._b, 'values.batchGet', lambda: {
+            'spreadsheetId': spreadsheetId,
+            'valueRanges': [self._b._read(spreadsheetId, r) for r in ranges]})
+
+    def update(self, spreadsheetId, range, body, valueInputOption='RAW', **kwargs):
+        return _Request(self._b, 'values.update', lambda: self._b._write(spreadsheetId, range, body.get('values', [])))
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        def run():
+            results = [self._b._write(spreadsheetId, d['range'], d.get('values', [])) for d in body.get('data', [])]
+            return {'spreadsheetId': spreadsheetId, 'totalUpdatedCells': sum(r['updatedCells'] for r in results), 'responses': results}
+        return _Request(self._b, 'values.batchUpdate', run)
+
+    def append(self, spreadsheetId, range, body, valueInputOption='RAW', **kwargs):
+        return _Request(self._b, 'values.append', lambda: self._b._append(spreadsheetId, range, body.get('values', [])))
+
+    def clear(self, spreadsheetId, range, body=None, **kwargs):
+        return _Request(self._b, 'values.clear', lambda: self._b._clear(spreadsheetId, range))
+
+    def batchClear(self, spreadsheetId, body, **kwargs):
+        return _Request(self._b, 'values.batchClear', lambda: {
+            'spreadsheetId': spreadsheetId,
+            'clearedRanges': [self._b._clear(spreadsheetId, r)['clearedRange'] for r in body.get('ranges', [])]})
+
+class FakeSpreadsheets:
+    def __init__(self, backend):
+        self._b = backend
+
+    def values(self):
+        return FakeValues(self._b)
+
+    def get(self, spreadsheetId, **kwargs):
+        def run():
+            tabs = self._b._book(spreadsheetId)
+            return {'spreadsheetId': spreadsheetId,
+                    'sheets': [{'properties': {'title': t, 'sheetId': i},
+                                'developerMetadata': self._b._tab_metadata(spreadsheetId, t)} for i, t in enumerate(tabs)]}
+        return _Request(self._b, 'spreadsheets.get', run)
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        return _Request(self._b, 'spreadsheets.batchUpdate', lambda: self._b._batch_update(spreadsheetId, body))
+
+class FakeSheetsService:
+    """Drop-in for build('sheets', 'v4', ...) backed by in-memory tabs.
+
+    latency: seconds slept per call (or a callable(method) -> seconds)
+    quota_error_rate: probability that a call raises HttpError 429
+    fail_every: raise HttpError 429 on every Nth call (0 disables)
+    """
+
+    def __init__(self, latency=0.0, quota_error_rate=0.0, fail_every=0, seed=None):
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self.fail_every = fail_every
+        self.calls = collections.Counter()
+        self.rows_read = 0
+        self.rows_written = 0
+        self._books = {}
+        # (spreadsheet id, tab) -> {key: value}; kept apart from _books so
+        # benches that restore a book keep its tabs' metadata
+        self._metadata = {}
+        self._lock = threading.RLock()
+        self._rng = random.Random(seed)
+        self._n = 0
+
+    # --- googleapiclient surface ---
+
+    def spreadsheets(self):
+        return FakeSpreadsheets(self)
+
+    # --- REST surface (httpx.MockTransport handler) ---
+
+    async def rest_handler(self, request):
+        req = self._rest_request(request)
+        fail, delay = self._admit(req._method)
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            return httpx.Response(200, json=self._run(fail, req._fn))
+        except HttpError as e:
+            return httpx.Response(e.resp.status, content=e.content, headers={'Content-Type': 'application/json'})
+
+    def _rest_request(self, request):
+        """/v4/spreadsheets/{id}[:verb] and /v4/spreadsheets/{id}/values[/{range}][:verb] -> _Request"""
+        path = request.url.raw_path.split(b'?')[0].decode().split('/spreadsheets/', 1)[1]
+        parts = [unquote(p) for p in path.split('/')]
+        params = request.url.params
+        body = json.loads(request.content) if request.content else {}
+        sheets, values = FakeSpreadsheets(self), FakeValues(self)
+        spreadsheet_id, _, verb = parts[0].partition(':')
+        if len(parts) == 1:
+            return sheets.batchUpdate(spreadsheet_id, body) if verb == 'batchUpdate' else sheets.get(spreadsheet_id)
+        if parts[1] == 'values:batchGet':
+            return values.batchGet(spreadsheet_id, params.get_list('ranges'))
+        if parts[1] == 'values:batchUpdate':
+            return values.batchUpdate(spreadsheet_id, body)
+        target = parts[2]
+        if target.endswith(':append'):
+            return values.append(spreadsheet_id, target[:-len(':append')], body)
+        if target.endswith(':clear'):
+            return values.clear(spreadsheet_id, target[:-len(':clear')])
+        if request.method == 'PUT':
+            return values.update(spreadsheet_id, target, body)
+        return values.get(spreadsheet_id, target)
+
+    # --- Test helpers ---
+
+    def seed(self, spreadsheet_id, tab, rows):
+        with self._lock:
+            self._book(spreadsheet_id)[tab] = [list(r) for r in rows]
+
+    def rows(self, spreadsheet_id, tab):
+        with self._lock:
+            return [list(r) for r in self._book(spreadsheet_id).get(tab, [])]
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.rows_read = 0
+            self.rows_written = 0
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    # --- Internals ---
+
+    def _book(self, spreadsheet_id):
+        return self._books.setdefault(spreadsheet_id, {})
+
+    def _call(self, method, fn):
+        fail, delay = self._admit(method)
+        if delay:
+            time.sleep(delay)
+        return self._run(fail, fn)
+
+    def _admit(self, method):
+        """Counts a call; (fail with 429, seconds to wait first)"""
+        with self._lock:
+            self.calls[method] += 1
+            self._n += 1
+            n = self._n
+            fail = (self.fail_every and n % self.fail_every == 0) or \
+                   (self.quota_error_rate and self._rng.random() < self.quota_error_rate)
+        return fail, (self.latency(method) if callable(self.latency) else self.latency)
+
+    def _run(self, fail, fn):
+        if fail:
+            resp = httplib2.Response({'status': 429})
+            resp.reason = 'Too Many Requests'
+            raise HttpError(resp, b'{"error": {"code": 429, "message": "Quota exceeded (fake)", "status": "RESOURCE_EXHAUSTED"}}')
+        with self._lock:
+            return fn()
+
+    def _tab(self, spreadsheet_id, tab):
+        book = self._book(spreadsheet_id)
+        if tab not in book:
+            resp = httplib2.Response({'status': 400})
+            resp.reason = 'Bad Request'
+            raise HttpError(resp, f'{{"error": {{"code": 400, "message": "Unable to parse range: {tab}"}}}}'.encode())
+        return book[tab]
+
+    def _read(self, spreadsheet_id, range_name):
+        tab, r0, c0, r1, c1 = parse_range(range_name)
+        rows = self._tab(spreadsheet_id, tab)
+        end = len(rows) if r1 is None else min(len(rows), r1 + 1)
+        out = []
+        for row in rows[r0:end]:
+            cells = row[c0:] if c1 is None else row[c0:c1 + 1]
+            while cells and cells[-1] in ('', None): cells = cells[:-1]
+            out.append([str(v) if not isinstance(v, str) else v for v in cells])
+        # Sheets drops trailing empty rows
+        while out and not out[-1]: out.pop()
+        self.rows_read += len(out)
+        result = {'range': range_name, 'majorDimension': 'ROWS'}
+        if out: result['values'] = out
+        return result
+
+    def _write(self, spreadsheet_id, range_name, values):
+        tab, r0, c0, _, _ = parse_range(range_name)
+        rows = self._tab(spreadsheet_id, tab)
+        while len(rows) < r0 + len(values): rows.append([])
+        cells = 0
+        for i, new in enumerate(values):
+            row = rows[r0 + i]
+            if len(row) < c0: row.extend([''] * (c0 - len(row)))
+            row[c0:c0 + len(new)] = [self._store(v) for v in new]
+            cells += len(new)
+        self.rows_written += len(values)
+        return {'updatedRange': range_name, 'updatedRows': len(values), 'updatedCells': cells}
+
+    def _append(self, spreadsheet_id, range_name, values):
+        tab, r0, c0, _, _ = parse_range(range_name)
+        rows = self._tab(spreadsheet_id, tab)
+        # Append after the last non-empty row of the table
+        last = len(rows)
+        while last > 0 and not any(v not in ('', None) for v in rows[last - 1]): last -= 1
+        del rows[last:]
+        start = max(last, r0)
+        while len(rows) < start: rows.append([])
+        for new in values:
+            rows.append([''] * c0 + [self._store(v) for v in new])
+        self.rows_written += len(values)
+        return {'updates': {'updatedRange': range_name, 'updatedRows': len(values)}}
+
+    def _clear(self, spreadsheet_id, range_name):
+        tab, r0, c0, r1, c1 = parse_range(range_name)
+        rows = self._tab(spreadsheet_id, tab)
+        end = len(rows) if r1 is None else min(len(rows), r1 + 1)
+        for i in range(r0, end):
+            row = rows[i]
+            stop = len(row) if c1 is None else min(len(row), c1 + 1)
+            for j in range(c0, stop): row[j] = ''
+        while rows and not any(v not in ('', None) for v in rows[-1]): rows.pop()
+        return {'clearedRange': range_name}
+
+    def _tab_metadata(self, spreadsheet_id, tab):
+        return [{'metadataKey': k, 'metadataValue': v, 'location': {'locationType': 'SHEET'}}
+                for k, v in self._metadata.get((spreadsheet_id, tab), {}).items()]
+
+    def _batch_update(self, spreadsheet_id, body):
+        book = self._book(spreadsheet_id)
+        replies = []
+        for req in body.get('requests', []):
+            if 'addSheet' in req:
+                title = req['addSheet']['properties']['title']
+                if title in book:
+                    resp = httplib2.Response({'status': 400})
+                    resp.reason = 'Bad Request'
+                    raise HttpError(resp, f'{{"error": {{"code": 400, "message": "A sheet with the name \\"{title}\\" already exists."}}}}'.encode())
+                book[title] = []
+                self._metadata.pop((spreadsheet_id, title), None)
+                replies.append({'addSheet': {'properties': {'title': title, 'sheetId': len(book) - 1}}})
+            elif 'createDeveloperMetadata' in req:
+                meta = req['createDeveloperMetadata']['developerMetadata']
+                title = list(book)[meta['location']['sheetId']]
+                self._metadata.setdefault((spreadsheet_id, title), {})[meta['metadataKey']] = meta['metadataValue']
+                replies.append({'createDeveloperMetadata': {'developerMetadata': meta}})
+            elif 'updateDeveloperMetadata' in req:
+                update = req['updateDeveloperMetadata']
+                for f in update['dataFilters']:
+                    lookup = f['developerMetadataLookup']
+                    title = list(book)[lookup['metadataLocation']['sheetId']]
+                    tab_meta = self._metadata.get((spreadsheet_id, title), {})
+                    if lookup['metadataKey'] in tab_meta:
+                        tab_meta[lookup['metadataKey']] = update['developerMetadata']['metadataValue']
+                replies.append({'updateDeveloperMetadata': {}})
+            elif 'deleteDimension' in req:
+                rng = req['deleteDimension']['range']
+                rows = book[list(book)[rng['sheetId']]]
+                if rng.get('dimension') == 'ROWS': del rows[rng['startIndex']:rng['endIndex']]
+                replies.append({})
+            else:
+                replies.append({})
+        return {'spreadsheetId': spreadsheet_id, 'replies': replies}
+
+    @staticmethod
+    def _store(value):
+        # USER_ENTERED / RAW both come back as display strings on read
+        if isinstance(value, bool): return 'TRUE' if value else 'FALSE'
+        if value is None: return ''
+        return value
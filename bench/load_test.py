@@ -0,0 +1,328 @@
+"""Concurrent multi-rep load test for the sync API.
+
+Serves the Flask app on a local threaded server (or, with --server asgi, the
+async app on uvicorn) backed by bench/fake_sheets.py and lets N simulated
+reps hammer it: logins, small upsert syncs (a few price
+edits, a customer edit and a new order) and occasional overwrite syncs that
+push the rep's last pulled snapshot back, the way the app does. Reports
+throughput, p50/p95/p99 latency and error rates per operation, plus lost
+updates: acknowledged writes that are not in the sheet at the end.
+
+    python bench/load_test.py --reps 10,50,100 --ops 20 --latency-ms 50 --out load_report.json
+    python bench/load_test.py --server asgi --reps 100,300 --latency-ms 50
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import socket
+import platform
+import datetime
+import threading
+import collections
+import urllib.error
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+if BENCH_DIR not in sys.path:
+    sys.path.insert(0, BENCH_DIR)
+
+# bench_sync points PARTFLOW_DB_PATH at a temp dir before the app is imported
+from bench_sync import SPREADSHEET_ID, dataset, seed_sheets, make_order
+from fake_sheets import FakeSheetsService
+
+DEFAULT_MIX = 'login=0.15,upsert=0.75,overwrite=0.10'
+PASSWORD = 'load-test-pass'
+
+# --- Local server ---
+
+def start_server(app):
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.shutdown, f"http://127.0.0.1:{server.server_port}"
+
+def start_asgi_server(app):
+    import uvicorn
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = uvicorn.Server(uvicorn.Config(app, log_level='warning', backlog=4096))
+    thread = threading.Thread(target=server.run, kwargs={'sockets': [sock]}, daemon=True)
+    thread.start()
+    while not server.started: time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return stop, f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+def post(base_url, path, payload, api_key=None, timeout=120):
+    """(status, body or None); never raises for HTTP or socket errors"""
+    headers = {'Content-Type': 'application/json'}
+    if api_key: headers['X-API-KEY'] = api_key
+    req = urllib.request.Request(base_url + path, data=json.dumps(payload).encode(), headers=headers, method='POST')
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return resp.status, json.loads(resp.read() or b'null')
+    except urllib.error.HTTPError as e:
+        try: body = json.loads(e.read() or b'null')
+        except ValueError: body = None
+        return e.code, body
+    except Exception:
+        return 0, None
+
+# --- Simulated rep ---
+
+class Ledger:
+    """Last acknowledged value per owned entity, plus values sent since then.
+    A write counts as lost if the final sheet holds neither."""
+
+    def __init__(self):
+        self.acked = {}
+        self.unacked = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def sent(self, key, value):
+        with self._lock:
+            self.unacked[key].add(value)
+
+    def ack(self, key, value):
+        with self._lock:
+            self.acked[key] = value
+            self.unacked[key].clear()
+
+    def lost(self, key, final):
+        if key not in self.acked: return False
+        return final != self.acked[key] and final not in self.unacked[key]
+
+class Rep:
+    def __init__(self, index, ctx):
+        self.index = index
+        self.ctx = ctx
+        self.username = f"loadrep{index}"
+        self.rng = random.Random(ctx['seed'] * 1000 + index)
+        n_reps = ctx['reps']
+        self.own_items = [i for i in ctx['items'] if int(i['item_id'].split('-')[1]) % n_reps == index]
+        self.own_customers = [c for c in ctx['customers'] if int(c['customer_id'].split('-')[1]) % n_reps == index]
+        self.snapshot = None
+        self.pending = {'items': {}, 'customers': {}, 'orders': {}}
+        self.seq = 0
+
+    def record(self, kind, started, status, body):
+        ok = status == 200 and isinstance(body, dict) and body.get('success') is not False
+        self.ctx['results'].append((kind, (time.perf_counter() - started) * 1000, status, ok))
+        return ok
+
+    def register(self):
+        started = time.perf_counter()
+        status, body = post(self.ctx['url'], '/register', {"username": self.username, "password": PASSWORD, "full_name": f"Load Rep {self.index}"})
+        # 400 "already exists" is fine when sweeping several rep counts
+        self.record('register', started, 200 if status == 400 else status, body if status != 400 else {})
+
+    def login(self):
+        started = time.perf_counter()
+        status, body = post(self.ctx['url'], '/login', {"username": self.username, "password": PASSWORD})
+        self.record('login', started, status, body)
+
+    def _edit(self):
+        ledger = self.ctx['ledger']
+        self.seq += 1
+        for item in self.rng.sample(self.own_items, min(len(self.own_items), self.rng.randint(1, 3))):
+            # Prices, not stock: the server takes stock from its ledger, not from pushes
+            edited = dict(item, unit_value=float(self.index * 100000 + self.seq), updated_at=_now())
+            self.pending['items'][item['item_id']] = edited
+        if self.own_customers:
+            cust = self.rng.choice(self.own_customers)
+            self.pending['customers'][cust['customer_id']] = dict(cust, address=f"{self.seq} Rep {self.index} Road", updated_at=_now())
+        order = make_order(self.ctx['next_order'](), len(self.ctx['items']), len(self.ctx['customers']))
+        order['order_id'] = f"load-{self.index}-{self.seq}"
+        for line in order['lines']: line['order_id'] = order['order_id']
+        order['rep_id'] = str(self.index)
+        self.pending['orders'][order['order_id']] = order
+        for iid, item in self.pending['items'].items(): ledger.sent(('item', iid), item['unit_value'])
+        for cid, cust in self.pending['customers'].items(): ledger.sent(('customer', cid), cust['address'])
+        for oid in self.pending['orders']: ledger.sent(('order', oid), True)
+
+    def sync(self, mode):
+        self._edit()
+        if mode == 'overwrite':
+            # The app pushes its whole local DB: last pull + own unsynced edits
+            items = {i['item_id']: i for i in self.snapshot['items']}
+            items.update(self.pending['items'])
+            customers = {c['customer_id']: c for c in self.snapshot['customers']}
+            customers.update(self.pending['customers'])
+            orders = {o['order_id']: o for o in self.snapshot['orders']}
+            orders.update(self.pending['orders'])
+            payload = {"items": list(items.values()), "customers": list(customers.values()), "orders": list(orders.values())}
+        else:
+            payload = {k: list(v.values()) for k, v in self.pending.items()}
+        payload.update({"spreadsheetId": SPREADSHEET_ID, "mode": mode})
+
+        started = time.perf_counter()
+        status, body = post(self.ctx['url'], '/sync', payload, self.ctx['api_key'])
+        if not self.record(f"sync.{mode}", started, status, body): return
+
+        ledger = self.ctx['ledger']
+        for iid, item in self.pending['items'].items(): ledger.ack(('item', iid), item['unit_value'])
+        for cid, cust in self.pending['customers'].items(): ledger.ack(('customer', cid), cust['address'])
+        for oid in self.pending['orders']: ledger.ack(('order', oid), True)
+        self.pending = {'items': {}, 'customers': {}, 'orders': {}}
+        self.snapshot = {"items": body.get('pulledItems', []), "customers": body.get('pulledCustomers', []),
+                         "orders": body.get('pulledOrders', [])}
+
+    def run(self, ops, weights, think):
+        self.register()
+        self.login()
+        kinds, probs = zip(*weights.items())
+        for _ in range(ops):
+            kind = self.rng.choices(kinds, probs)[0]
+            if kind == 'login': self.login()
+            elif kind == 'overwrite' and self.snapshot is not None: self.sync('overwrite')
+            else: self.sync('upsert')
+            if think: time.sleep(self.rng.uniform(0, think))
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+# --- Report ---
+
+def percentile(sorted_values, pct):
+    if not sorted_values: return None
+    k = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return round(sorted_values[k], 2)
+
+def summarize(results, elapsed):
+    by_kind = collections.defaultdict(list)
+    for kind, ms, status, ok in results:
+        by_kind[kind].append((ms, status, ok))
+    ops = {}
+    for kind, rows in sorted(by_kind.items()):
+        latencies = sorted(ms for ms, _, _ in rows)
+        errors = [status for _, status, ok in rows if not ok]
+        ops[kind] = {
+            "count": len(rows),
+            "errors": len(errors),
+            "error_rate": round(len(errors) / len(rows), 4),
+            "status_codes": dict(sorted(collections.Counter(str(s) for _, s, _ in rows).items())),
+            "latency_ms": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+                           "p99": percentile(latencies, 99), "max": round(latencies[-1], 2)}
+        }
+    total = len(results)
+    return {
+        "ops_total": total,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_ops_s": round(total / elapsed, 2) if elapsed else None,
+        "error_rate": round(sum(1 for r in results if not r[3]) / total, 4) if total else 0,
+        "ops": ops
+    }
+
+def count_lost_updates(fake, ledger):
+    import sheet_rows
+    items = {i['item_id']: i for i in sheet_rows.parse_inventory_rows(fake.rows(SPREADSHEET_ID, 'Inventory'))}
+    customers = {c['customer_id']: c for c in sheet_rows.parse_customer_rows(fake.rows(SPREADSHEET_ID, 'Customers'))}
+    orders = {o['order_id'] for o in sheet_rows.parse_order_rows(fake.rows(SPREADSHEET_ID, 'Orders'), fake.rows(SPREADSHEET_ID, 'OrderLines'))}
+    lost = collections.Counter()
+    checked = collections.Counter()
+    for (kind, key) in list(ledger.acked):
+        checked[kind] += 1
+        if kind == 'item': final = items[key]['unit_value'] if key in items else None
+        elif kind == 'customer': final = customers[key]['address'] if key in customers else None
+        else: final = key in orders or None
+        if ledger.lost((kind, key), final): lost[kind] += 1
+    return {"checked": dict(sorted(checked.items())), "lost": {k: lost.get(k, 0) for k in sorted(checked)},
+            "lost_total": sum(lost.values())}
+
+# --- Driver ---
+
+def run_level(index, fake, url, n_reps, n_items, ops, weights, think, seed):
+    items, customers, orders = dataset(n_items)
+    fake._books.pop(SPREADSHEET_ID, None)
+    seed_sheets(fake, items, customers, orders)
+    fake.reset_counters()
+
+    counter = iter(range(len(orders), 10 ** 9))
+    counter_lock = threading.Lock()
+    def next_order():
+        with counter_lock: return next(counter)
+
+    ctx = {"url": url, "api_key": index.API_KEY, "reps": n_reps, "items": items, "customers": customers,
+           "seed": seed, "results": [], "ledger": Ledger(), "next_order": next_order}
+    reps = [Rep(i, ctx) for i in range(n_reps)]
+    threads = [threading.Thread(target=r.run, args=(ops, weights, think)) for r in reps]
+    started = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - started
+
+    report = {"reps": n_reps, "ops_per_rep": ops, **summarize(ctx['results'], elapsed)}
+    report["lost_updates"] = count_lost_updates(fake, ctx['ledger'])
+    report["sheets"] = {"calls": dict(sorted(fake.calls.items())), "calls_total": fake.total_calls,
+                        "rows_read": fake.rows_read, "rows_written": fake.rows_written}
+    return report
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        if kind.strip() not in ('login', 'upsert', 'overwrite'):
+            raise argparse.ArgumentTypeError(f"unknown operation in mix: {kind!r}")
+        weights[kind.strip()] = float(weight)
+    return weights
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--reps', default='5,25,100', help='comma separated numbers of concurrent reps')
+    parser.add_argument('--ops', type=int, default=20, help='operations per rep (after register + login)')
+    parser.add_argument('--items', type=int, default=2000, help='inventory size (customers = n/5, orders = n/2)')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'operation weights, default {DEFAULT_MIX}')
+    parser.add_argument('--think-ms', type=float, default=0.0, help='max random pause between a rep\'s operations')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated per-call Sheets latency')
+    parser.add_argument('--quota-error-rate', type=float, default=0.0, help='fraction of Sheets calls failing with 429')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask', help='index.py on werkzeug, or asgi.py on uvicorn')
+    parser.add_argument('--out', help='write JSON here instead of stdout')
+    args = parser.parse_args(argv)
+
+    import index
+    fake = FakeSheetsService(latency=args.latency_ms / 1000.0, quota_error_rate=args.quota_error_rate, seed=args.seed)
+    index.get_sheets_service = lambda: index.traced_service(fake)
+    if args.server == 'asgi':
+        import httpx
+        import asgi
+        from sheets_async import AsyncSheets
+        asgi._sheets = AsyncSheets(transport=httpx.MockTransport(fake.rest_handler), base_url='http://fake-sheets/v4/spreadsheets')
+        stop, url = start_asgi_server(asgi.app)
+    else:
+        stop, url = start_server(index.app)
+    try:
+        levels = [run_level(index, fake, url, int(n), args.items, args.ops, args.mix, args.think_ms / 1000.0, args.seed)
+                  for n in args.reps.split(',') if n.strip()]
+    finally:
+        stop()
+
+    report = {
+        "meta": {
+            "generated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "server": args.server,
+            "items": args.items,
+            "mix": args.mix,
+            "think_ms": args.think_ms,
+            "latency_ms": args.latency_ms,
+            "quota_error_rate": args.quota_error_rate
+        },
+        "levels": levels
+    }
+    out = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { Customer, Item, Order, OrderLine, Payment, PaymentType } from '../types';
 import { db } from '../services/db';
+import { stockService } from '../services/stock';
 import { generateUUID } from '../utils/uuid';
 import { Html5QrcodeScanner } from 'html5-qrcode';
 import { useAuth } from '../context/AuthContext';
@@ -244,6 +245,20 @@ export const OrderBuilder: React.FC<OrderBuilderProps> = ({ onCancel, onOrderCre
             sync_status: 'pending'
         };
 
+        // Hold the stock on the server first: another rep may have just sold it
+        const stockSheetId = db.stockSheetId();
+        if (stockSheetId) {
+            const reservation = await stockService.reserve(stockSheetId, orderId, finalLines);
+            if (!reservation.ok) {
+                const names = reservation.shortfalls.map(s => {
+                    const item = items.find(i => i.item_id === s.item_id);
+                    return `${item ? item.item_display_name : s.item_id} (${s.available} left)`;
+                });
+                showToast(`Not enough stock: ${names.join(', ')}`, "error");
+                return;
+            }
+        }
+
         // If editing, restore original stock first
         if (editingOrder && settings.stock_tracking_enabled) {
             for (const line of editingOrder.lines) {
@@ -260,6 +275,7 @@ export const OrderBuilder: React.FC<OrderBuilderProps> = ({ onCancel, onOrderCre
 
         // Save Order (DB handles balance updates)
         await db.saveOrder(newOrder);
+        if (stockSheetId) await stockService.commit(stockSheetId, orderId, finalLines);
         showToast(editingOrder ? "Order updated!" : "Sale confirmed!", "success");
         
         setShowPaymentModal(false);
@@ -1,5 +1,7 @@
 export const API_CONFIG = {
     // Replace with your Vercel URL
     BACKEND_URL: 'https://partflow-pro-akila.vercel.app',
-    BACKEND_KEY: 'partflow_secret_token_2026_v2'
+    BACKEND_KEY: 'partflow_secret_token_2026_v2',
+    // Column arrays instead of object arrays on /sync (see utils/columnar.ts); opt-in
+    COLUMNAR_SYNC: false
 };
@@ -1,8 +1,8 @@
 import Dexie, { Table } from 'dexie';
 import { Customer, Item, Order, OrderLine, CompanySettings, SyncStats, User, Payment, StockAdjustment } from '../types';
-import { sheetsService } from './sheets';
-import { jsonToCsv, downloadCsv } from '../utils/csv';
-import { generateSKU } from '../utils/skuGenerator';
+import { sheetsService, SyncPayment, SyncPatch, PatchConflict } from './sheets';
+import { stockService } from './stock';
+import { generateUUID } from '../utils/uuid';
 import SEED_DATA from '../src/config/seed-data.json';
 import APP_SETTINGS from '../src/config/app-settings.json';
 import USER_CONFIG from '../src/config/users.json';
@@ -12,6 +12,8 @@ const STORAGE_KEYS = {
   INIT: 'fieldaudit_initialized_v8', // Force re-init for V8 (Delivery Tracking)
   LAST_SYNC: 'fieldaudit_last_sync',
   USER: 'fieldaudit_current_user',
+  SYNC_ATTEMPT: 'fieldaudit_sync_attempt', // Idempotency-Key of the push not yet confirmed
+  PENDING_PATCHES: 'fieldaudit_pending_patches', // Field patches of synced orders, not sent yet
   // Legacy keys (will be migrated from)
   LEGACY_CUSTOMERS: 'fieldaudit_customers',
   LEGACY_ITEMS: 'fieldaudit_items',
@@ -255,6 +257,12 @@ class LocalDB {
     }
   }
 
+  // Spreadsheet whose server-side stock ledger tracks this device's sales, if any
+  stockSheetId(): string | null {
+    const settings = this.cache.settings;
+    return settings.stock_tracking_enabled && settings.google_sheet_id ? settings.google_sheet_id : null;
+  }
+
   // Critical: Used during order confirmation
   async updateStock(itemId: string, qtyDelta: number): Promise<void> {
     const index = this.cache.items.findIndex(i => i.item_id === itemId);
@@ -274,16 +282,9 @@ class LocalDB {
   async saveOrder(order: Order): Promise<void> {
     const index = this.cache.orders.findIndex(o => o.order_id === order.order_id);
     
-    // Auto-calculate payment status if not set
-    const paid = order.paid_amount || 0;
-    const due = order.net_total - paid;
-    const status: any = due <= 0.5 ? 'paid' : (paid > 0 ? 'partial' : 'unpaid'); // 0.5 tolerance
-
     const orderToSave = { 
         ...order, 
-        paid_amount: paid,
-        balance_due: due,
-        payment_status: status,
+        ...this.paymentFields(order),
         delivery_status: order.delivery_status || 'pending',
         sync_status: 'pending' as const, 
         updated_at: new Date().toISOString() 
@@ -298,17 +299,26 @@ class LocalDB {
     await this.recalcCustomerBalance(order.customer_id);
   }
 
+  // Auto-calculate payment status from what has been paid
+  private paymentFields(order: Order): Pick<Order, 'paid_amount' | 'balance_due' | 'payment_status'> {
+    const paid = order.paid_amount || 0;
+    const due = order.net_total - paid;
+    const status: any = due <= 0.5 ? 'paid' : (paid > 0 ? 'partial' : 'unpaid'); // 0.5 tolerance
+    return { paid_amount: paid, balance_due: due, payment_status: status };
+  }
+
   async addPayment(payment: Payment): Promise<void> {
       const orderIndex = this.cache.orders.findIndex(o => o.order_id === payment.order_id);
       if (orderIndex === -1) throw new Error("Order not found");
 
       const order = this.cache.orders[orderIndex];
       
-      // Add payment
+      // Add payment (the payment itself goes up through the Payments log)
       order.payments = [...(order.payments || []), payment];
       order.paid_amount = order.payments.reduce((sum, p) => sum + p.amount, 0);
       
-      await this.saveOrder(order);
+      await this.patchOrder(order, this.paymentFields(order));
+      await this.recalcCustomerBalance(order.customer_id);
   }
 
   async updateDeliveryStatus(orderId: string, status: any, notes?: string): Promise<void> {
@@ -317,10 +327,7 @@ class LocalDB {
 
       const order = this.cache.orders[index];
       const oldStatus = order.delivery_status;
-      order.delivery_status = status;
       if (notes !== undefined) order.delivery_notes = notes;
-      order.updated_at = new Date().toISOString();
-      order.sync_status = 'pending';
 
       // Logical Fix: Restore stock if delivery failed or cancelled
       // only if it wasn't already failed/cancelled (to prevent double restoration)
@@ -328,20 +335,81 @@ class LocalDB {
           order.lines.forEach(async line => {
               await this.updateStock(line.item_id, line.quantity);
           });
+          const sheetId = this.stockSheetId();
+          if (sheetId) await stockService.release(sheetId, order.order_id);
       } 
       // If moving BACK to an active state, re-deduce stock
       else if ((status !== 'failed' && status !== 'cancelled') && (oldStatus === 'failed' || oldStatus === 'cancelled')) {
           order.lines.forEach(async line => {
               await this.updateStock(line.item_id, -line.quantity);
           });
+          const sheetId = this.stockSheetId();
+          if (sheetId) await stockService.commit(sheetId, order.order_id, order.lines);
       }
 
-      await this.db.orders.put(order);
+      await this.patchOrder(order, { delivery_status: status });
       
       // Update Customer Balance (Failed/Cancelled orders removed from balance)
       await this.recalcCustomerBalance(order.customer_id);
   }
 
+  // --- Field Patches ---
+  // A synced order changed in a few fields (delivery, payments) sends just
+  // those, checked on the server against the updated_at the sheet had; an
+  // order not synced yet still goes up whole.
+
+  private readPatches(): SyncPatch[] {
+      try {
+          return JSON.parse(localStorage.getItem(STORAGE_KEYS.PENDING_PATCHES) || '[]');
+      } catch {
+          return [];
+      }
+  }
+
+  private writePatches(patches: SyncPatch[]) {
+      if (patches.length) localStorage.setItem(STORAGE_KEYS.PENDING_PATCHES, JSON.stringify(patches));
+      else localStorage.removeItem(STORAGE_KEYS.PENDING_PATCHES);
+  }
+
+  private async patchOrder(order: Order, fields: Partial<Order>): Promise<void> {
+      const base = order.updated_at;
+      const updated_at = new Date().toISOString();
+      Object.assign(order, fields, { updated_at });
+      if (order.sync_status !== 'pending') {
+          const patches = this.readPatches();
+          const queued = patches.find(p => p.entity === 'order' && p.id === order.order_id);
+          // Later changes join the queued patch, which keeps the base the sheet has
+          if (queued) Object.assign(queued.fields, fields, { updated_at });
+          else patches.push({ entity: 'order', id: order.order_id, fields: { ...fields, updated_at }, base_updated_at: base || '' });
+          this.writePatches(patches);
+      }
+      await this.db.orders.put(order);
+  }
+
+  // After a sync: sent patches are done, a stale one is rebased on the row the
+  // sheet has now (and goes up next sync), one for a row gone is dropped
+  private settlePatches(sent: SyncPatch[], conflicts: PatchConflict[], onLog?: (msg: string) => void): SyncPatch[] {
+      const key = (p: { entity: string; id: string }) => `${p.entity}:${p.id}`;
+      const sentAt = new Map(sent.map(p => [key(p), p.fields.updated_at]));
+      const conflictOf = new Map(conflicts.map(c => [key(c), c]));
+      const remaining = this.readPatches().flatMap(p => {
+          const conflict = conflictOf.get(key(p));
+          if (conflict?.reason === 'missing') {
+              if (onLog) onLog(`Dropped changes to ${p.entity} ${p.id}: it is no longer in the sheet.`);
+              return [];
+          }
+          if (conflict) {
+              if (onLog) onLog(`${p.entity} ${p.id} was changed elsewhere; your changes were reapplied on top.`);
+              return [{ ...p, base_updated_at: conflict.updated_at || '' }];
+          }
+          if (!sentAt.has(key(p))) return [p];
+          // Changed again while the sync ran: the rest goes on top of what was sent
+          return sentAt.get(key(p)) === p.fields.updated_at ? [] : [{ ...p, base_updated_at: sentAt.get(key(p))! }];
+      });
+      this.writePatches(remaining);
+      return remaining;
+  }
+
   private async recalcCustomerBalance(customerId: string) {
       // Find all unpaid orders for this customer
       // Filter out 'failed' and 'cancelled' delivery statuses as requested
@@ -376,6 +444,8 @@ class LocalDB {
               order.lines.forEach(async line => {
                   await this.updateStock(line.item_id, line.quantity); // Positive qty to add back
               });
+              const sheetId = this.stockSheetId();
+              if (sheetId) await stockService.release(sheetId, order.order_id);
           }
 
           // Delete from Cache
@@ -407,6 +477,8 @@ class LocalDB {
       }
 
       await this.updateStock(adjustment.item_id, qtyDelta);
+      const sheetId = this.stockSheetId();
+      if (sheetId && qtyDelta !== 0) await stockService.adjust(sheetId, adjustment.adjustment_id, adjustment.item_id, qtyDelta);
   }
 
   // --- Settings ---
@@ -425,7 +497,7 @@ class LocalDB {
     return {
       pendingCustomers: this.cache.customers.filter(c => c.sync_status === 'pending').length,
       pendingItems: this.cache.items.filter(i => i.sync_status === 'pending').length,
-      pendingOrders: this.cache.orders.filter(o => o.sync_status === 'pending').length,
+      pendingOrders: this.cache.orders.filter(o => o.sync_status === 'pending').length + this.readPatches().length,
       pendingAdjustments: this.cache.adjustments.filter(a => a.sync_status === 'pending').length,
       last_sync
     };
@@ -512,10 +584,10 @@ class LocalDB {
         throw new Error("Google Sheet ID not configured. Please enter it in the Sync Dashboard.");
     }
 
-    if (onLog) onLog("Creating local backup (CSV)...");
-    const currentItems = this.getItems();
-    const csvData = jsonToCsv(currentItems);
-    downloadCsv(csvData, `inventory_backup_${new Date().toISOString().split('T')[0]}.csv`);
+    // No local CSV backup: the server snapshots every tab after the sync (GET /snapshots)
+
+    // Stock commits/releases made offline go first, so the pull below reflects them
+    if (settings.stock_tracking_enabled) await stockService.flushOutbox(onLog);
 
     // Use Cache for current state
     const customers = this.getCustomers();
@@ -523,18 +595,33 @@ class LocalDB {
     
     const orders = this.getOrders();
     const pendingOrders = orders.filter(o => o.sync_status === 'pending');
+    const patches = this.readPatches();
+    const patchedOrders = new Set(patches.filter(p => p.entity === 'order').map(p => p.id));
 
     const items = this.getItems();
     const pendingItems = mode === 'overwrite' ? items : items.filter(i => i.sync_status === 'pending');
 
+    // Append-only on the server: ids it already has are skipped
+    const pendingAdjustments = this.cache.adjustments.filter(a => a.sync_status === 'pending');
+    const payments: SyncPayment[] = orders
+        .filter(o => o.sync_status === 'pending' || patchedOrders.has(o.order_id))
+        .flatMap(o => (o.payments || []).map(p => ({ ...p, customer_id: o.customer_id })));
+
     console.log("DEBUG: Pending Customers for Sync:", pendingCustomers);
 
+    const autoSku = !!settings.auto_sku_enabled;
+    const idempotencyKey = this.syncAttemptKey(settings.google_sheet_id, mode, autoSku, pendingCustomers, pendingOrders, pendingItems, pendingAdjustments, patches);
     const result = await sheetsService.syncData(
         settings.google_sheet_id,
         pendingCustomers,
         pendingOrders,
         pendingItems,
-        mode
+        mode,
+        idempotencyKey,
+        pendingAdjustments,
+        payments,
+        patches,
+        autoSku
     );
 
     if (onLog && result.logs) {
@@ -559,6 +646,11 @@ class LocalDB {
         });
     }
 
+    if (pendingAdjustments.length > 0) {
+        pendingAdjustments.forEach(a => { a.sync_status = 'synced'; });
+        await this.db.stockAdjustments.bulkPut(pendingAdjustments);
+    }
+
     if (pendingOrders.length > 0) {
         await this.db.transaction('rw', this.db.orders, async () => {
             pendingOrders.forEach(o => {
@@ -574,36 +666,7 @@ class LocalDB {
     if (result.pulledItems) {
         if (onLog) onLog(`Replacing local inventory with ${result.pulledItems.length} items from cloud.`);
         
-        // Auto-Generate Missing SKUs (Logic: V5)
-        if (settings.auto_sku_enabled) {
-            const processedItems = result.pulledItems.map(item => {
-                // If Item Number is missing or empty, generate it
-                if (!item.item_number || item.item_number.trim() === '') {
-                    return item; 
-                }
-                return item;
-            });
-
-            // Sequential generation to handle duplicates within the batch
-            const existingSKUs = new Set<string>(
-                result.pulledItems
-                    .map(i => i.item_number)
-                    .filter(sku => sku && sku.trim() !== '')
-            );
-
-            for (let i = 0; i < processedItems.length; i++) {
-                const item = processedItems[i];
-                if (!item.item_number || item.item_number.trim() === '') {
-                    const newSku = generateSKU(item.item_display_name, Array.from(existingSKUs));
-                    item.item_number = newSku;
-                    item.sync_status = 'pending'; // Mark as pending so it syncs back
-                    item.updated_at = new Date().toISOString();
-                    existingSKUs.add(newSku); // Add to set for next iterations
-                }
-            }
-            result.pulledItems = processedItems;
-        }
-
+        // Missing SKUs were filled in by the server (autoSku)
         await this.db.transaction('rw', this.db.items, async () => {
              await this.db.items.clear();
              await this.db.items.bulkPut(result.pulledItems!);
@@ -634,8 +697,40 @@ class LocalDB {
         this.cache.orders = result.pulledOrders;
     }
 
+    // Patches still to go are kept on the pulled rows
+    const unsent = this.settlePatches(patches, result.patchConflicts || [], onLog);
+    for (const p of unsent) {
+        const order = this.cache.orders.find(o => o.order_id === p.id);
+        if (p.entity !== 'order' || !order) continue;
+        Object.assign(order, p.fields);
+        await this.db.orders.put(order);
+    }
+
+    localStorage.removeItem(STORAGE_KEYS.SYNC_ATTEMPT);
     localStorage.setItem(STORAGE_KEYS.LAST_SYNC, new Date().toISOString());
   }
+
+  // Resending the same pending rows (the last response never arrived) reuses
+  // the key; any change to them, the mode or autoSku starts a new one (the
+  // server refuses a key resent with a different body)
+  private syncAttemptKey(sheetId: string, mode: string, autoSku: boolean, customers: Customer[], orders: Order[], items: Item[], adjustments: StockAdjustment[], patches: SyncPatch[]): string {
+      const fingerprint = [
+          sheetId, mode, String(autoSku),
+          customers.map(c => `${c.customer_id}@${c.updated_at}`).join(','),
+          orders.map(o => `${o.order_id}@${o.updated_at}`).join(','),
+          items.map(i => `${i.item_id}@${i.updated_at}`).join(','),
+          adjustments.map(a => a.adjustment_id).join(','),
+          patches.map(p => `${p.entity}:${p.id}@${p.fields.updated_at}`).join(',')
+      ].join('|');
+      const saved = localStorage.getItem(STORAGE_KEYS.SYNC_ATTEMPT);
+      if (saved) {
+          const attempt = JSON.parse(saved);
+          if (attempt.fingerprint === fingerprint) return attempt.key;
+      }
+      const key = generateUUID();
+      localStorage.setItem(STORAGE_KEYS.SYNC_ATTEMPT, JSON.stringify({ key, fingerprint }));
+      return key;
+  }
 }
 
 export const db = new LocalDB();
\ No newline at end of file
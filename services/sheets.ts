@@ -1,5 +1,6 @@
-import { Customer, Item, Order, OrderLine } from '../types';
+import { Customer, Item, Order, OrderLine, Payment, StockAdjustment } from '../types';
 import { API_CONFIG } from '../config';
+import { COLUMNAR_MIME, toColumnar, fromColumnar } from '../utils/columnar';
 
 interface SheetsSyncResult {
   success: boolean;
@@ -7,11 +8,33 @@ interface SheetsSyncResult {
   pulledItems?: Item[];
   pulledCustomers?: Customer[];
   pulledOrders?: Order[];
+  patchConflicts?: PatchConflict[];
   logs?: string[];
 }
 
+// Payments go up on their own (append-only Payments tab) with their order's customer
+export type SyncPayment = Payment & { customer_id: string };
+
+// A few fields of a row the sheet already has (api/patches.py). Applied only
+// while the sheet's row is still at base_updated_at.
+export interface SyncPatch {
+  entity: 'order' | 'customer' | 'item';
+  id: string;
+  fields: Record<string, unknown> & { updated_at: string };
+  base_updated_at: string;
+}
+
+export interface PatchConflict {
+  entity: SyncPatch['entity'];
+  id: string;
+  // stale: the row changed since base_updated_at (now at updated_at); missing: no such row
+  reason: 'stale' | 'missing';
+  updated_at: string | null;
+}
+
 const BACKEND_URL = API_CONFIG.BACKEND_URL;
 const BACKEND_KEY = API_CONFIG.BACKEND_KEY;
+const COLUMNAR = API_CONFIG.COLUMNAR_SYNC;
 
 class SheetsService {
   private currentLogs: string[] = [];
@@ -26,7 +49,12 @@ class SheetsService {
     customers: Customer[], 
     orders: Order[],
     items: Item[] = [],
-    mode: 'upsert' | 'overwrite' = 'upsert'
+    mode: 'upsert' | 'overwrite' = 'upsert',
+    idempotencyKey?: string,
+    adjustments: StockAdjustment[] = [],
+    payments: SyncPayment[] = [],
+    patches: SyncPatch[] = [],
+    autoSku: boolean = false
   ): Promise<SheetsSyncResult> {
     this.currentLogs = [];
     try {
@@ -35,28 +63,50 @@ class SheetsService {
       const response = await fetch(`${BACKEND_URL}/sync`, {
           method: 'POST',
           headers: {
-              'Content-Type': 'application/json',
-              'X-API-KEY': BACKEND_KEY
+              'Content-Type': COLUMNAR ? COLUMNAR_MIME : 'application/json',
+              'Accept': COLUMNAR ? COLUMNAR_MIME : 'application/json',
+              'X-API-KEY': BACKEND_KEY,
+              // Same key when this push is resent: the server will not write it twice
+              ...(idempotencyKey ? { 'Idempotency-Key': idempotencyKey } : {})
           },
           body: JSON.stringify({
               spreadsheetId,
-              customers,
-              orders,
-              items,
+              customers: COLUMNAR ? toColumnar(customers) : customers,
+              orders: COLUMNAR ? toColumnar(orders, ['lines']) : orders,
+              items: COLUMNAR ? toColumnar(items) : items,
+              adjustments: COLUMNAR ? toColumnar(adjustments) : adjustments,
+              payments: COLUMNAR ? toColumnar(payments) : payments,
+              patches,
+              // Items without a SKU get one from the server's counters (api/skus.py)
+              autoSku,
               mode
           })
       });
 
       const data = await response.json();
+      const pulledItems = fromColumnar<Item>(data.pulledItems);
+      const pulledCustomers = fromColumnar<Customer>(data.pulledCustomers);
+      const pulledOrders = fromColumnar<Order>(data.pulledOrders);
       
       if (!response.ok) {
           throw new Error(data.message || "Backend request failed");
       }
 
       this.addLog("Backend sync successful.");
-      this.addLog(`Fetched ${data.pulledItems?.length || 0} items from cloud.`);
-      this.addLog(`Fetched ${data.pulledCustomers?.length || 0} customers from cloud.`);
-      this.addLog(`Fetched ${data.pulledOrders?.length || 0} orders from cloud.`);
+      if (data.replayed) {
+          this.addLog("Changes were already saved by an earlier attempt; fetched the latest data only.");
+      }
+      if (data.stale) {
+          // Sheets is down: the server answered from its last good pull and queued our changes
+          this.addLog(`Google Sheets unavailable: showing cloud data from ${data.stale.ageSeconds}s ago.${data.queued ? ' Changes are queued on the server.' : ''}`);
+      }
+      this.addLog(`Fetched ${pulledItems?.length || 0} items from cloud.`);
+      this.addLog(`Fetched ${pulledCustomers?.length || 0} customers from cloud.`);
+      this.addLog(`Fetched ${pulledOrders?.length || 0} orders from cloud.`);
+
+      if (data.patches) {
+          this.addLog(`Patched ${data.patches.applied} record(s); ${data.patches.conflicts.length} conflict(s).`);
+      }
 
       if (data.debug) {
           this.addLog(`Cloud Schema Check: Customers(${data.debug.customer_header_len} cols), Orders(${data.debug.order_header_len} cols)`);
@@ -64,9 +114,10 @@ class SheetsService {
 
       return { 
           success: true, 
-          pulledItems: data.pulledItems, 
-          pulledCustomers: data.pulledCustomers,
-          pulledOrders: data.pulledOrders,
+          pulledItems, 
+          pulledCustomers,
+          pulledOrders,
+          patchConflicts: data.patches?.conflicts || [],
           logs: this.currentLogs 
       };
     } catch (err: any) {
@@ -0,0 +1,119 @@
+import { OrderLine } from '../types';
+import { API_CONFIG } from '../config';
+
+// Server-side stock (api/stock_ledger.py). The server holds an order's
+// quantities before it is confirmed so two reps cannot sell the same last
+// unit; the local stock counts stay as an optimistic display.
+//
+// Commits, releases and adjustments that cannot reach the server (offline)
+// wait in a localStorage outbox and are sent before the next sync. Every call
+// names the order's full quantities (or the adjustment id), so sending one
+// twice changes nothing.
+
+export interface StockShortfall {
+  item_id: string;
+  requested: number;
+  available: number;
+}
+
+export interface ReserveResult {
+  ok: boolean;
+  // Server not reachable: the sale goes ahead on local stock
+  offline?: boolean;
+  shortfalls: StockShortfall[];
+}
+
+type StockAction = 'commit' | 'release' | 'adjust';
+
+interface OutboxEntry {
+  action: StockAction;
+  body: Record<string, unknown>;
+}
+
+const BACKEND_URL = API_CONFIG.BACKEND_URL;
+const BACKEND_KEY = API_CONFIG.BACKEND_KEY;
+const OUTBOX_KEY = 'fieldaudit_stock_outbox';
+
+const toLines = (lines: OrderLine[]) => lines.map(l => ({ item_id: l.item_id, quantity: l.quantity }));
+
+class StockService {
+  private async post(action: string, body: Record<string, unknown>): Promise<{ status: number; data: any }> {
+    const response = await fetch(`${BACKEND_URL}/stock/${action}`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-API-KEY': BACKEND_KEY
+        },
+        body: JSON.stringify(body)
+    });
+    return { status: response.status, data: await response.json() };
+  }
+
+  private readOutbox(): OutboxEntry[] {
+    try {
+      return JSON.parse(localStorage.getItem(OUTBOX_KEY) || '[]');
+    } catch {
+      return [];
+    }
+  }
+
+  private writeOutbox(entries: OutboxEntry[]) {
+    if (entries.length) localStorage.setItem(OUTBOX_KEY, JSON.stringify(entries));
+    else localStorage.removeItem(OUTBOX_KEY);
+  }
+
+  private async send(action: StockAction, body: Record<string, unknown>): Promise<void> {
+    try {
+      const { status, data } = await this.post(action, body);
+      // 4xx: the server will never take it (e.g. item not tracked yet); retrying will not help
+      if (status >= 500) throw new Error(data.message || `Stock ${action} failed`);
+    } catch (err: any) {
+      console.warn(`[Stock] ${action} queued: ${err.message}`);
+      this.writeOutbox([...this.readOutbox(), { action, body }]);
+    }
+  }
+
+  async reserve(spreadsheetId: string, orderId: string, lines: OrderLine[]): Promise<ReserveResult> {
+    try {
+      const { status, data } = await this.post('reserve', { spreadsheetId, orderId, lines: toLines(lines) });
+      if (status === 409) return { ok: false, shortfalls: data.shortfalls || [] };
+      if (status >= 400) throw new Error(data.message || 'Stock reservation failed');
+      return { ok: true, shortfalls: [] };
+    } catch (err: any) {
+      console.warn(`[Stock] Reservation skipped: ${err.message}`);
+      return { ok: true, offline: true, shortfalls: [] };
+    }
+  }
+
+  commit(spreadsheetId: string, orderId: string, lines: OrderLine[]): Promise<void> {
+    return this.send('commit', { spreadsheetId, orderId, lines: toLines(lines) });
+  }
+
+  release(spreadsheetId: string, orderId: string): Promise<void> {
+    return this.send('release', { spreadsheetId, orderId });
+  }
+
+  adjust(spreadsheetId: string, adjustmentId: string, itemId: string, delta: number): Promise<void> {
+    return this.send('adjust', { spreadsheetId, adjustmentId, itemId, delta });
+  }
+
+  // Sends queued calls in order; stops at the first that still cannot get through
+  async flushOutbox(onLog?: (msg: string) => void): Promise<void> {
+    const entries = this.readOutbox();
+    if (!entries.length) return;
+    let sent = 0;
+    for (const entry of entries) {
+      try {
+        const { status, data } = await this.post(entry.action, entry.body);
+        if (status >= 500) throw new Error(data.message || `Stock ${entry.action} failed`);
+      } catch (err: any) {
+        break;
+      }
+      sent++;
+    }
+    this.writeOutbox([...entries.slice(sent), ...this.readOutbox().slice(entries.length)]);
+    if (onLog) onLog(`Sent ${sent} of ${entries.length} queued stock updates.`);
+  }
+}
+
+export const stockService = new StockService();
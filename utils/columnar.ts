@@ -0,0 +1,48 @@
+// Columnar /sync encoding, the counterpart of api/wire.py.
+// A list of records travels as column names plus rows of values, so keys
+// are not repeated for every row. `nested` gives the columns of list-valued
+// fields (order lines). A null cell means the field is absent.
+export const COLUMNAR_MIME = 'application/vnd.partflow.columnar+json';
+
+export interface Columnar {
+  columns: string[];
+  nested?: Record<string, string[]>;
+  rows: any[][];
+}
+
+const columnsOf = (records: any[]): string[] => {
+  const seen = new Set<string>();
+  records.forEach(r => Object.keys(r).forEach(k => seen.add(k)));
+  return Array.from(seen);
+};
+
+export function toColumnar(records: any[], nestedFields: string[] = []): Columnar {
+  const columns = columnsOf(records);
+  const nested: Record<string, string[]> = {};
+  nestedFields.forEach(field => {
+    nested[field] = columnsOf(records.flatMap(r => Array.isArray(r[field]) ? r[field] : []));
+  });
+  const rows = records.map(r => columns.map(c => {
+    const value = r[c];
+    if (nested[c] && Array.isArray(value)) return value.map((v: any) => nested[c].map(n => v[n]));
+    return value === undefined ? null : value;
+  }));
+  return nestedFields.length ? { columns, nested, rows } : { columns, rows };
+}
+
+// Accepts either shape, so an older server's object arrays still decode
+export function fromColumnar<T>(data: Columnar | T[] | undefined): T[] | undefined {
+  if (!data || Array.isArray(data)) return data;
+  const { columns, nested = {}, rows } = data;
+  return rows.map(row => {
+    const record: any = {};
+    columns.forEach((c, i) => {
+      const value = row[i];
+      if (value === null || value === undefined) return;
+      record[c] = nested[c] && Array.isArray(value)
+        ? value.map((v: any[]) => Object.fromEntries(nested[c].map((n, j) => [n, v[j]]).filter(([, x]) => x !== null)))
+        : value;
+    });
+    return record as T;
+  });
+}
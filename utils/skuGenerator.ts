@@ -1,3 +1,5 @@
+// Suggests a SKU for the item form. At sync the server allocates SKUs for
+// items still without one from its own counters, same scheme (api/skus.py).
 export const generateSKU = (description: string, existingSKUs: string[]): string => {
     if (!description) return '';
 